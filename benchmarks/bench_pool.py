@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Measures `WalletPool` throughput against the fake daemon and wallet executables.
+
+Example:
+    python benchmarks/bench_pool.py --wallets 1000 --max-running 20 --duration 120 --workers
+
+Reports wallets synced per hour, idle slot time, payment detection latency percentiles
+and the time of draining the pool at the end.
+Detection latency is the time from mining a block with a payment to the `wallet_synced`
+handler of the receiving wallet.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from monero.seed import Seed
+from monerowalletpool import WalletsManager, WalletPool, SyncScheduler
+from monerowalletpool.concurrency import AdaptiveConcurrency
+from monerowalletpool.staging import IOBudget, StagingArea
+from monerowalletpool.supervisor import FailureSupervisor
+from monerowalletpool.tracing import Tracer
+from benchmarks.fakes import FakeDaemon, FAKE_WALLET_RPC, FAKE_WALLET_CLI, write_wallet
+
+_log = logging.getLogger(__name__)
+
+
+class BenchmarkFinished(Exception):
+    pass
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100.0), len(values) - 1)]
+
+
+class BenchPool(WalletPool):
+    def __init__(self, manager, daemon, duration, port_range, **kwargs):
+        self.rpc_port_range = port_range
+        self.daemon_fake = daemon
+        self.duration = duration
+        self.started_at = None
+        self.synced_count = 0
+        self.failed_count = 0
+        self.busy_time = 0.0
+        self.latencies = []
+        self.ready_times = []
+        self._detected = {}     # address: height of the last detected payment
+        kwargs.setdefault('scheduler', SyncScheduler())
+        super(BenchPool, self).__init__(manager, **kwargs)
+
+    def main_loop_cycle(self):
+        if self.started_at is None:
+            self.started_at = time.time()
+        elif time.time() - self.started_at > self.duration:
+            raise BenchmarkFinished()
+
+    def wallet_synced(self, ctrl):
+        now = time.time()
+        self.synced_count += 1
+        last = self._detected.get(ctrl.address, 0)
+        for transfer in self.daemon_fake.transfers.get(str(ctrl.address), []):
+            if last < transfer['height'] <= ctrl.height:
+                self.latencies.append(now - transfer['timestamp'])
+        self._detected[ctrl.address] = max(last, ctrl.height or 0)
+        ctrl.shut_down = True
+
+    def wallet_closed(self, ctrl):
+        self.busy_time += ctrl.running_time.total_seconds()
+        if ctrl.ready_time is not None:
+            self.ready_times.append(ctrl.ready_time.total_seconds())
+
+    def wallet_failed(self, ctrl):
+        self.failed_count += 1
+        if ctrl.running_time is not None:
+            self.busy_time += ctrl.running_time.total_seconds()
+
+
+def make_wallets(directory, count, height):
+    addresses = []
+    for i in range(count):
+        address = Seed().public_address(net='stage')
+        write_wallet(os.path.join(directory, str(address)), address, height)
+        addresses.append(address)
+    return addresses
+
+
+def run(args):
+    os.environ['FAKE_STARTUP_DELAY'] = str(args.startup_delay)
+    os.environ['FAKE_SYNC_SPEED'] = str(args.sync_speed)
+    os.environ['FAKE_FAILURE_RATE'] = str(args.failure_rate)
+    daemon = FakeDaemon(height=args.height, block_time=args.block_time,
+            payments_per_block=args.payments_per_block)
+    daemon.start()
+    with tempfile.TemporaryDirectory() as walletdir:
+        for address in make_wallets(walletdir, args.wallets, args.height - args.behind):
+            daemon.add_address(address)
+        staging = None
+        if args.staging:
+            budget = IOBudget(args.io_budget * 1e6) if args.io_budget else None
+            staging = StagingArea(os.path.join(walletdir, 'staging'), budget=budget)
+        manager = WalletsManager(directory=walletdir, net='stagenet',
+                cmd_rpc=FAKE_WALLET_RPC, cmd_cli=FAKE_WALLET_CLI, log_dir=walletdir,
+                staging=staging, daemon_host='127.0.0.1', daemon_port=daemon.port)
+        concurrency = None
+        if args.adaptive:
+            concurrency = AdaptiveConcurrency(ceiling=args.max_running, interval=args.adaptive)
+        supervisor = None
+        if args.backoff is not None:
+            supervisor = FailureSupervisor(base_delay=args.backoff)
+        pool = BenchPool(manager, daemon, args.duration,
+                (args.port_base, args.port_base + 10 * args.max_running + 10 + args.spares),
+                max_running=args.max_running, use_workers=args.workers, concurrency=concurrency,
+                spare_workers=args.spares, supervisor=supervisor,
+                tracer=Tracer(path=args.trace) if args.trace else None,
+                daemon_host='127.0.0.1', daemon_port=daemon.port)
+        for address in manager.iter_wallets():
+            pool.schedule(address)
+        try:
+            pool.main_loop()
+        except BenchmarkFinished:
+            pass
+        elapsed = time.time() - pool.started_at
+        running = len(pool.running)
+        drain_started = time.time()
+        drained = pool.drain()
+        drain_time = time.time() - drain_started
+        if staging is not None:
+            staging.close()
+    daemon.stop()
+    slot_time = elapsed * pool.max_running
+    return {
+        'wallets': args.wallets,
+        'max_running': pool.max_running,
+        'elapsed': elapsed,
+        'synced': pool.synced_count,
+        'failed': pool.failed_count,
+        'quarantined': len(supervisor.quarantined) if supervisor is not None else 0,
+        'wallets_per_hour': pool.synced_count / elapsed * 3600,
+        'idle_slot_ratio': max(slot_time - pool.busy_time, 0) / slot_time,
+        'payments': len(daemon.mined),
+        'detected': len(pool.latencies),
+        'latency_p50': percentile(pool.latencies, 50),
+        'latency_p99': percentile(pool.latencies, 99),
+        'ready_p50': percentile(pool.ready_times, 50),
+        'daemon_requests': daemon.requests,
+        'drained': running if drained else 0,
+        'drain_seconds': drain_time,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--wallets', type=int, default=100)
+    parser.add_argument('--max-running', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=60, help='seconds')
+    parser.add_argument('--workers', action='store_true', help='use long-lived RPC workers')
+    parser.add_argument('--height', type=int, default=100000, help='starting daemon height')
+    parser.add_argument('--behind', type=int, default=100, help='initial wallet lag in blocks')
+    parser.add_argument('--block-time', type=float, default=5)
+    parser.add_argument('--payments-per-block', type=int, default=5)
+    parser.add_argument('--startup-delay', type=float, default=0.3)
+    parser.add_argument('--sync-speed', type=float, default=500, help='blocks per second')
+    parser.add_argument('--failure-rate', type=float, default=0)
+    parser.add_argument('--spares', type=int, default=0,
+            help='number of pre-started idle RPC workers')
+    parser.add_argument('--adaptive', type=float, metavar='INTERVAL',
+            help='tune the number of running wallets up to --max-running every INTERVAL seconds')
+    parser.add_argument('--staging', action='store_true',
+            help='open the wallets from a staging area with atomic write-back')
+    parser.add_argument('--io-budget', type=float, metavar='MB/S',
+            help='throttle the write-back of staged wallets')
+    parser.add_argument('--backoff', type=float, metavar='SECONDS',
+            help='retry failed wallets after SECONDS, doubling, and quarantine repeated failures')
+    parser.add_argument('--trace', metavar='PATH',
+            help='stream the wallet lifecycle spans to PATH as Chrome trace-event JSON')
+    parser.add_argument('--port-base', type=int, default=28090)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+            format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    result = run(args)
+    for key, value in result.items():
+        print('{:18s} {}'.format(key, round(value, 3) if isinstance(value, float) else value))
+    return result
+
+
+if __name__ == '__main__':
+    main()
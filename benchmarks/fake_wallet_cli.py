@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""Fake monero-wallet-cli, see fakes.py"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import cli_main
+
+if __name__ == '__main__':
+    cli_main(sys.argv[1:])
@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""Fake monero-wallet-rpc, see fakes.py"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from benchmarks.fakes import rpc_main
+
+if __name__ == '__main__':
+    rpc_main(sys.argv[1:])
@@ -0,0 +1,536 @@
+"""Stand-ins for `monerod`, `monero-wallet-rpc` and `monero-wallet-cli`, so the pool can be
+measured and tested without the real binaries, the network and the blockchain.
+
+`FakeDaemon` runs in-process. It mines a block every `block_time` seconds and may send payments
+to registered addresses. The blocks and transactions it serves carry real outputs to those
+addresses, detectable with the view keys. The wallet stand-ins are the `fake_wallet_rpc.py` and
+`fake_wallet_cli.py` executables, to be passed as `cmd_rpc` and `cmd_cli` of `WalletsManager`.
+They keep a wallet as a small JSON file and are configured by environment variables:
+
+    FAKE_STARTUP_DELAY  seconds before the RPC server starts listening (default 0.1)
+    FAKE_SYNC_SPEED     blocks scanned per second (default 1000)
+    FAKE_FAILURE_RATE   probability of failing at start or on opening a wallet (default 0)
+"""
+import argparse
+import http.server
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+import monero.address
+import requests
+import varint
+from monero import ed25519
+from monero.keccak import keccak_256
+
+_log = logging.getLogger(__name__)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_WALLET_RPC = os.path.join(HERE, 'fake_wallet_rpc.py')
+FAKE_WALLET_CLI = os.path.join(HERE, 'fake_wallet_cli.py')
+
+
+def env_config():
+    return {
+        'startup_delay': float(os.environ.get('FAKE_STARTUP_DELAY', 0.1)),
+        'sync_speed': float(os.environ.get('FAKE_SYNC_SPEED', 1000)),
+        'failure_rate': float(os.environ.get('FAKE_FAILURE_RATE', 0)),
+    }
+
+
+def write_wallet(path, address, height):
+    """Writes the fake wallet cache and keys files."""
+    for fname in (path, '{}.keys'.format(path)):
+        tmpname = '{}.tmp'.format(fname)
+        with open(tmpname, 'w') as fp:
+            json.dump({'address': str(address), 'height': height}, fp)
+        os.replace(tmpname, fname)
+
+
+def read_wallet(path):
+    """Returns the contents of a fake wallet. Uninitialized wallets have only the keys file."""
+    if not os.path.exists(path):
+        path = '{}.keys'.format(path)
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+
+def _hash_to_scalar(data):
+    return ed25519.scalar_reduce(keccak_256(data).digest())
+
+
+def fake_transaction(address, amount, seed, fee=10 ** 8, subaddress=False):
+    """Returns the JSON of an RCT transaction paying `amount` to the address in its only
+    output, as decoded by the daemon. The transaction key is derived from `seed` bytes."""
+    address = monero.address.address(str(address))
+    view = bytes.fromhex(address.view_key())
+    spend = bytes.fromhex(address.spend_key())
+    r = _hash_to_scalar(b'fake tx key' + seed)
+    # subaddress transactions have the key multiplied by the spend key of the recipient
+    pubkey = ed25519.scalarmult(r, spend) if subaddress else ed25519.scalarmult_B(r)
+    r8 = ed25519.scalar_add(r, r)
+    r8 = ed25519.scalar_add(r8, r8)
+    r8 = ed25519.scalar_add(r8, r8)
+    derivation = ed25519.scalarmult(r8, view)
+    index = varint.encode(0)
+    hs = _hash_to_scalar(derivation + index)
+    output_key = ed25519.edwards_add(ed25519.scalarmult_B(hs), spend)
+    view_tag = keccak_256(b'view_tag' + derivation + index).digest()[:1]
+    amount_bytes = amount.to_bytes(8, 'little')
+    mask = keccak_256(b'amount' + hs).digest()[:8]
+    y = _hash_to_scalar(b'commitment_mask' + hs)
+    commitment = ed25519.edwards_add(ed25519.scalarmult_B(y),
+            ed25519.scalarmult_H(ed25519.scalar_reduce(amount_bytes)))
+    return {
+        'version': 2,
+        'unlock_time': 0,
+        'vin': [{'key': {'amount': 0, 'key_offsets': [], 'k_image': '00' * 32}}],
+        'vout': [{'amount': 0, 'target': {'tagged_key': {
+            'key': output_key.hex(), 'view_tag': view_tag.hex()}}}],
+        'extra': [1] + list(pubkey),
+        'rct_signatures': {
+            'type': 6,
+            'txnFee': fee,
+            'ecdhInfo': [{'amount': bytes(a ^ b for a, b in zip(amount_bytes, mask)).hex()}],
+            'outPk': [commitment.hex()],
+        },
+    }
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super(RPCError, self).__init__(message)
+        self.code = code
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.server.rpc.stopped:
+            # drop kept-alive connections of a stopped server
+            self.close_connection = True
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        data = json.loads(self.rfile.read(length) or b'{}')
+        if self.path == '/json_rpc':
+            try:
+                result = {'id': data.get('id'), 'jsonrpc': '2.0',
+                        'result': self.server.rpc.call(data['method'], data.get('params') or {})}
+            except RPCError as e:
+                result = {'id': data.get('id'), 'jsonrpc': '2.0',
+                        'error': {'code': e.code, 'message': str(e)}}
+        elif self.path in self.server.rpc.paths:
+            result = self.server.rpc.paths[self.path](data)
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JSONRPCServer(object):
+    """A JSON-RPC 2.0 server dispatching `method` to `rpc_<method>` of the instance."""
+    paths = {}
+    stopped = False
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.rpc = self
+        self.port = self.httpd.server_address[1]
+
+    def call(self, method, params):
+        try:
+            handler = getattr(self, 'rpc_{}'.format(method))
+        except AttributeError:
+            raise RPCError(-32601, 'Method not found')
+        return handler(**params) if isinstance(params, dict) else handler(*params)
+
+    def start(self):
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped = True
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FakeDaemon(JSONRPCServer):
+    """A daemon stand-in mining a block every `block_time` seconds. Each block carries
+    `payments_per_block` payments to random addresses of those registered by `add_address`.
+    Mined payments are recorded in `mined` as `(address, height, mined_at)` tuples."""
+    block_time = 120
+    start_height = 1000
+    payments_per_block = 0
+
+    def __init__(self, port=0, height=None, block_time=None, payments_per_block=None,
+            net='stagenet', seed=None):
+        super(FakeDaemon, self).__init__(port)
+        self.start_height = height if height is not None else self.start_height
+        self.block_time = block_time or self.block_time
+        self.payments_per_block = payments_per_block if payments_per_block is not None \
+                else self.payments_per_block
+        self.net = net
+        self.started = time.time()
+        self.addresses = []
+        self.transfers = {}     # address: list of transfers
+        self.mined = []
+        self._mined_height = self.start_height
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.blocks = {}        # height: txids of payments
+        self._replaced = {}     # height: number of times the block has been replaced
+        self._payments = {}     # txid: transfer
+        self.paths = {'/get_height': self.get_height, '/get_transactions': self.get_transactions}
+
+    def call(self, method, params):
+        self.requests += 1
+        return super(FakeDaemon, self).call(method, params)
+
+    def add_address(self, address):
+        with self._lock:
+            self.addresses.append(str(address))
+
+    def timestamp(self, height):
+        return int(self.started + (height - self.start_height) * self.block_time)
+
+    def height(self):
+        height = self.start_height + int((time.time() - self.started) / self.block_time)
+        with self._lock:
+            while self._mined_height < height:
+                self._mined_height += 1
+                self._mine(self._mined_height)
+        return height
+
+    def _mine(self, height):
+        if not self.addresses:
+            return
+        for i in range(self.payments_per_block):
+            address = self._random.choice(self.addresses)
+            transfer = {
+                'address': address,
+                'amount': self._random.randint(1, 10 ** 12),
+                'fee': 10 ** 8,
+                'height': height,
+                'timestamp': self.timestamp(height),
+                'txid': '{:064x}'.format(self._random.getrandbits(256)),
+                'payment_id': '0000000000000000',
+                'type': 'in',
+                'unlock_time': 0,
+                'subaddr_index': {'major': 0, 'minor': 0},
+            }
+            self.transfers.setdefault(address, []).append(transfer)
+            self.blocks.setdefault(height, []).append(transfer['txid'])
+            self._payments[transfer['txid']] = transfer
+            self.mined.append((address, height, self.timestamp(height)))
+
+    def block_hash(self, height):
+        return '{:064x}'.format(height + (self._replaced.get(height, 0) << 128))
+
+    def reorganize(self, fork):
+        """Replaces the blocks from height `fork` on with others carrying new payments."""
+        tip = self.height()
+        with self._lock:
+            for height in range(fork, tip):
+                self._replaced[height] = self._replaced.get(height, 0) + 1
+                for txid in self.blocks.pop(height, []):
+                    transfer = self._payments.pop(txid)
+                    self.transfers[transfer['address']].remove(transfer)
+                self.mined = [m for m in self.mined if m[1] != height]
+                self._mine(height)
+
+    def get_height(self, data):
+        self.requests += 1
+        return {'height': self.height(), 'status': 'OK'}
+
+    def rpc_get_info(self):
+        return {'height': self.height(), 'target_height': 0, 'status': 'OK',
+                'mainnet': self.net == 'mainnet', 'stagenet': self.net == 'stagenet',
+                'testnet': self.net == 'testnet'}
+
+    def rpc_get_block_count(self):
+        return {'count': self.height(), 'status': 'OK'}
+
+    def rpc_get_block_headers_range(self, start_height, end_height):
+        return {'status': 'OK', 'headers': [
+            {'height': h, 'hash': self.block_hash(h), 'timestamp': self.timestamp(h)}
+            for h in range(start_height, end_height + 1)]}
+
+    def rpc_get_block(self, height=None, hash=None, **kwargs):
+        if height is None or height >= self.height():
+            raise RPCError(-2, 'Requested block height too big')
+        with self._lock:
+            txids = list(self.blocks.get(height, []))
+        miner_tx = {'version': 2, 'unlock_time': height + 60, 'vin': [{'gen': {'height': height}}],
+                'vout': [], 'extra': [], 'rct_signatures': {'type': 0}}
+        return {'status': 'OK', 'blob': '', 'json': json.dumps({
+            'major_version': 16, 'minor_version': 16, 'timestamp': self.timestamp(height),
+            'miner_tx': miner_tx, 'tx_hashes': txids}), 'block_header': {
+                'height': height, 'hash': self.block_hash(height),
+                'prev_hash': self.block_hash(height - 1), 'timestamp': self.timestamp(height),
+                'miner_tx_hash': '{:064x}'.format(height + (1 << 255)), 'major_version': 16,
+                'minor_version': 16, 'difficulty': 1, 'nonce': 0, 'orphan_status': False,
+                'reward': 0}}
+
+    def get_transactions(self, data):
+        self.requests += 1
+        txs = []
+        for txid in data.get('txs_hashes', []):
+            with self._lock:
+                transfer = self._payments.get(txid)
+            if transfer is None:
+                continue
+            tx = fake_transaction(transfer['address'], transfer['amount'],
+                    bytes.fromhex(txid), fee=transfer['fee'])
+            txs.append({'tx_hash': txid, 'as_hex': '', 'as_json': json.dumps(tx),
+                    'in_pool': False, 'block_height': transfer['height'],
+                    'block_timestamp': transfer['timestamp'], 'output_indices': [0]})
+        return {'status': 'OK', 'txs': txs}
+
+    def rpc_fake_transfers(self, address, min_height=0, max_height=None):
+        """Returns transfers to the address within heights (min_height, max_height]."""
+        self.height()
+        with self._lock:
+            return {'transfers': [t for t in self.transfers.get(address, [])
+                if t['height'] > min_height and (max_height is None or t['height'] <= max_height)]}
+
+
+class FakeWalletRPC(JSONRPCServer):
+    """A `monero-wallet-rpc` stand-in. Opened wallet catches up with the daemon at `sync_speed`
+    blocks per second. Heights are stored in the wallet file on `store`, `close_wallet`,
+    `stop_wallet` and on termination."""
+
+    def __init__(self, port, daemon_address, wallet_dir=None, sync_speed=1000, failure_rate=0):
+        super(FakeWalletRPC, self).__init__(port)
+        self.daemon_url = 'http://{}/json_rpc'.format(daemon_address)
+        self.wallet_dir = wallet_dir
+        self.sync_speed = sync_speed
+        self.failure_rate = failure_rate
+        self.wallet = None
+        self._daemon_height = (0, 0)
+        self._session = requests.Session()
+        self._lock = threading.Lock()
+
+    def _daemon(self, method, **params):
+        rsp = self._session.post(self.daemon_url, json={
+            'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params}, timeout=10)
+        return rsp.json()['result']
+
+    def daemon_height(self):
+        checked, height = self._daemon_height
+        if time.time() - checked > 0.2:
+            height = self._daemon('get_info')['height']
+            self._daemon_height = (time.time(), height)
+        return height
+
+    def open(self, path):
+        data = read_wallet(path)
+        self.wallet = {'path': path, 'address': data['address'],
+                'height': data['height'], 'opened_at': time.time()}
+
+    def height(self):
+        wallet = self._wallet()
+        scanned = int(self.sync_speed * (time.time() - wallet['opened_at']))
+        return max(wallet['height'], min(self.daemon_height(), wallet['height'] + scanned))
+
+    def save(self):
+        if self.wallet is not None:
+            write_wallet(self.wallet['path'], self.wallet['address'], self.height())
+
+    def _wallet(self):
+        if self.wallet is None:
+            raise RPCError(-13, 'No wallet file')
+        return self.wallet
+
+    def rpc_get_version(self):
+        return {'version': 65562}
+
+    def rpc_open_wallet(self, filename, password=''):
+        if random.random() < self.failure_rate:
+            raise RPCError(-1, 'Failed to open wallet (simulated)')
+        with self._lock:
+            self.save()
+            self.open(os.path.join(self.wallet_dir, filename))
+        return {}
+
+    def rpc_close_wallet(self, autosave_current=True):
+        with self._lock:
+            if autosave_current:
+                self.save()
+            self.wallet = None
+        return {}
+
+    def rpc_store(self):
+        self.save()
+        return {}
+
+    def rpc_set_daemon(self, address='', trusted=False, **kwargs):
+        self._wallet()
+        self.daemon_url = 'http://{}/json_rpc'.format(address)
+        self._daemon_height = (0, 0)
+        return {}
+
+    def rpc_stop_wallet(self):
+        with self._lock:
+            self.save()
+            self.wallet = None
+        threading.Thread(target=self.httpd.shutdown).start()
+        return {}
+
+    def rpc_refresh(self, start_height=None):
+        return {'blocks_fetched': 0, 'received_money': False}
+
+    def rpc_get_accounts(self, **kwargs):
+        return {'subaddress_accounts': [{
+            'account_index': 0, 'base_address': self._wallet()['address'], 'label': 'Primary account',
+            'balance': 0, 'unlocked_balance': 0}]}
+
+    def rpc_getaddress(self, account_index=0, address_index=None):
+        return {'address': self._wallet()['address'], 'addresses': [
+            {'address': self._wallet()['address'], 'address_index': 0, 'label': '', 'used': True}]}
+    rpc_get_address = rpc_getaddress
+
+    def rpc_getheight(self):
+        return {'height': self.height()}
+    rpc_get_height = rpc_getheight
+
+    def _transfers(self, min_height=0):
+        return self._daemon('fake_transfers', address=self._wallet()['address'],
+                min_height=min_height, max_height=self.height())['transfers']
+
+    def rpc_getbalance(self, account_index=0, **kwargs):
+        height = self.height()
+        transfers = self._transfers()
+        balance = sum(t['amount'] for t in transfers)
+        unlocked = sum(t['amount'] for t in transfers if height - t['height'] >= 10)
+        return {'balance': balance, 'unlocked_balance': unlocked, 'per_subaddress': [{
+            'address': self._wallet()['address'], 'address_index': 0, 'account_index': 0,
+            'balance': balance, 'unlocked_balance': unlocked, 'label': '', 'num_unspent_outputs': 0}]}
+    rpc_get_balance = rpc_getbalance
+
+    def rpc_get_transfers(self, **params):
+        result = {}
+        height = self.height()
+        if params.get('in'):
+            min_height = params.get('min_height', 0) if params.get('filter_by_height') else 0
+            transfers = self._transfers(min_height)
+            if params.get('max_height'):
+                transfers = [t for t in transfers if t['height'] <= params['max_height']]
+            for t in transfers:
+                t['confirmations'] = height - t['height']
+            result['in'] = transfers
+        if params.get('pool'):
+            result['pool'] = []
+        return result
+
+
+def _common_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--daemon-address', default='127.0.0.1:18081')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--log-file')
+    parser.add_argument('--log-level')
+    parser.add_argument('--trusted-daemon', action='store_true')
+    parser.add_argument('--stagenet', action='store_true')
+    parser.add_argument('--testnet', action='store_true')
+    return parser
+
+
+def rpc_main(argv):
+    parser = _common_parser()
+    parser.add_argument('--wallet-file')
+    parser.add_argument('--wallet-dir')
+    parser.add_argument('--rpc-bind-port', type=int, required=True)
+    parser.add_argument('--disable-rpc-login', action='store_true')
+    args, _ = parser.parse_known_args(argv)
+    config = env_config()
+    if random.random() < config['failure_rate']:
+        print('Error: failed to start (simulated)', file=sys.stderr)
+        sys.exit(1)
+    time.sleep(config['startup_delay'])
+    server = FakeWalletRPC(args.rpc_bind_port, args.daemon_address,
+            wallet_dir=args.wallet_dir, sync_speed=config['sync_speed'],
+            failure_rate=config['failure_rate'])
+    if args.wallet_file:
+        server.open(args.wallet_file)
+
+    def _terminate(signum, frame):
+        server.save()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, _terminate)
+    print('Starting wallet RPC server', flush=True)
+    server.httpd.serve_forever()
+    server.httpd.server_close()
+
+
+def cli_main(argv):
+    parser = _common_parser()
+    parser.add_argument('--generate-from-view-key')
+    parser.add_argument('--generate-from-spend-key')
+    parser.add_argument('--generate-new-wallet')
+    parser.add_argument('--use-english-language-names', action='store_true')
+    args, _ = parser.parse_known_args(argv)
+    config = env_config()
+    net = 'test' if args.testnet else 'stage' if args.stagenet else 'main'
+    print('Logging to {}'.format(args.log_file), flush=True)
+
+    def _daemon_height():
+        rsp = requests.post('http://{}/json_rpc'.format(args.daemon_address), json={
+            'jsonrpc': '2.0', 'id': 0, 'method': 'get_info'}, timeout=10)
+        return rsp.json()['result']['height']
+
+    def _is_key(key):
+        try:
+            return len(bytes.fromhex(key)) == 32
+        except ValueError:
+            return False
+
+    from monero.seed import Seed
+    if args.generate_new_wallet:
+        print('List of available languages for your wallet\'s seed:\n1 : English', flush=True)
+        sys.stdin.readline()
+        address = Seed().public_address(net=net)
+        write_wallet(args.generate_new_wallet, address, _daemon_height())
+        print('Generated new wallet: {}'.format(address), flush=True)
+    else:
+        if args.generate_from_spend_key:
+            wfile = args.generate_from_spend_key
+            key = sys.stdin.readline().strip()
+            sys.stdin.readline()    # language
+            if not _is_key(key):
+                print('Error: failed to parse spend key secret key', flush=True)
+                sys.exit(1)
+            address = Seed(key).public_address(net=net)
+        else:
+            wfile = args.generate_from_view_key
+            address = sys.stdin.readline().strip()
+            key = sys.stdin.readline().strip()
+            if not _is_key(key) or random.random() < config['failure_rate']:
+                print('Error: failed to verify view key secret key', flush=True)
+                sys.exit(1)
+        height = int(sys.stdin.readline().strip() or 0)
+        write_wallet(wfile, address, height)
+        daemon_height = _daemon_height()
+        time.sleep(max(daemon_height - height, 0) / config['sync_speed'])
+        write_wallet(wfile, address, daemon_height)
+        print('Refresh done, blocks received: {}'.format(daemon_height - height), flush=True)
+        print('Balance: 0.000000000000, unlocked balance: 0.000000000000', flush=True)
+    # wait for the controlling process to close the input
+    while sys.stdin.readline():
+        pass
@@ -0,0 +1,43 @@
+import logging
+import sys
+from monerowalletpool import WalletsManager, read_wallet_records
+
+_log = logging.getLogger(__name__)
+
+if __name__ == '__main__':
+    def usage():
+        print('Usage: {} <directory> <records.csv|records.jsonl|-> [daemonhost:port] [workers]'.format(
+                *sys.argv), file=sys.stderr)
+        sys.exit(1)
+
+    def progress(address, result, done):
+        if isinstance(result, Exception):
+            _log.error('{:6d} {} failed: {}'.format(done, address, result))
+        else:
+            _log.info('{:6d} {} {}'.format(done, address, result))
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    if len(sys.argv) < 3 or len(sys.argv) > 5:
+        usage()
+    host = '127.0.0.1'
+    port = 18081
+    workers = 4
+    try:
+        if len(sys.argv) >= 4:
+            host, port = sys.argv[3].split(':')
+            port = int(port)
+        if len(sys.argv) == 5:
+            workers = int(sys.argv[4])
+    except:
+        usage()
+    manager = WalletsManager(
+            directory=sys.argv[1],
+            net='stagenet',
+            daemon_host=host,
+            daemon_port=port)
+    stream = sys.stdin if sys.argv[2] == '-' else open(sys.argv[2], 'r')
+    with stream:
+        result = manager.bulk_create(read_wallet_records(stream), workers=workers, progress=progress)
+    _log.info('Created: {}, skipped: {}, failed: {}'.format(
+            len(result.created), len(result.skipped), len(result.failed)))
+    sys.exit(1 if result.failed else 0)
@@ -1,10 +1,9 @@
-import collections
-import itertools
 import logging
-import monero
+import monero.numbers
 import os
 import sys
-from monerowalletpool import WalletsManager, WalletPool
+from monerowalletpool import WalletsManager, WalletPool, SyncScheduler
+from monerowalletpool.transfers import TransferStream, CallbackSink
 
 _log = logging.getLogger(__name__)
 
@@ -13,24 +12,26 @@ class DirPool(WalletPool):
     Each wallet file is supposed to be named by its master address.
     """
     def __init__(self, manager, **kwargs):
-        addresses = manager.list_wallets()
-        self._addresses = itertools.cycle(addresses)
-        _log.info('Pool has {} addresses.'.format(len(addresses)))
+        kwargs.setdefault('scheduler', SyncScheduler())
+        kwargs.setdefault('transfers', TransferStream(
+            [CallbackSink(self.new_transfers)], flush_interval=0))
         super(DirPool, self).__init__(manager, **kwargs)
-
-    def next_addr(self):
-        return next(self._addresses)
+        for addr in manager.iter_wallets():
+            self.schedule(addr)
+        _log.info('Pool has {} addresses.'.format(len(self.scheduler)))
 
     def wallet_started(self, ctrl):
         _log.info('Started: {}'.format(self.shortaddr(ctrl.address)))
 
+    def new_transfers(self, batch):
+        for transfer in batch:
+            _log.info('{} {:7s} {:4.12f} {}'.format(
+                    self.shortaddr(transfer['address']),
+                    transfer['type'],
+                    monero.numbers.from_atomic(transfer['amount']),
+                    transfer['txid']))
+
     def wallet_synced(self, ctrl):
-        _log.info('{} Incoming: [{}]'.format(
-                self.shortaddr(ctrl.address),
-                ','.join(map(lambda p: '{:4.12f}'.format(p.amount), ctrl.wallet.incoming()))))
-        _log.info('{} Outgoing: [{}]'.format(
-                self.shortaddr(ctrl.address),
-                ','.join(map(lambda p: '{:4.12f}'.format(p.amount), ctrl.wallet.outgoing()))))
         ctrl.shut_down = True
 
 if __name__ == '__main__':
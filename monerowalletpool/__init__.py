@@ -1,14 +1,26 @@
 import collections
+import concurrent.futures
+import contextlib
+import csv
 import datetime
+import functools
+import heapq
 import itertools
+import json
 import logging
 import monero
 import monero.backends.jsonrpc
+import monero.daemon
+import monero.wallet
 import os
+import queue
 import re
 import requests
+import selectors
 import shutil
 import signal
+import socket
+import sqlite3
 import subprocess
 import sys
 import tempfile
@@ -28,6 +40,227 @@ class WalletCreationError(CommunicationError):
     pass
 
 
+class RPCTimeoutError(CommunicationError):
+    """The wallet RPC server hasn't become ready in time."""
+    pass
+
+
+class AddressMismatchError(CommunicationError):
+    """The wallet file holds another wallet than the expected one."""
+    pass
+
+
+# Environment variable marking the processes spawned by a pool with `process_token()` of the
+# pool process, so those left behind by a crashed pool can be told apart from others.
+OWNER_ENV = 'MONEROWALLETPOOL_OWNER'
+
+
+def process_token(pid=None):
+    """Returns a string identifying the process `pid` (the current one by default) as
+    `pid:start_time`, so a reused pid won't match, or `None` if it isn't running. Without
+    `/proc`, the pid alone is returned."""
+    pid = pid or os.getpid()
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except FileNotFoundError:
+        return None
+    except OSError:
+        return str(pid)
+    if fields[0] == 'Z':
+        return None
+    # the 22nd field, starttime
+    return '{}:{}'.format(pid, fields[19])
+
+
+def owner_env():
+    """Returns the environment for processes spawned by this one, marked with `OWNER_ENV`."""
+    return dict(os.environ, **{OWNER_ENV: process_token()})
+
+
+def trace_span(tracer, name, address=None, **args):
+    """Returns a span of the phase `name` from `tracer` (see `monerowalletpool.tracing.Tracer`),
+    or a no-op context manager if it's `None`."""
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.span(name, address, **args)
+
+
+def traced(name):
+    """Decorates a method taking the wallet address first, tracing its calls as phase `name`
+    with the `tracer` of the object."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, address, *args, **kwargs):
+            with trace_span(self.tracer, name, address):
+                return method(self, address, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def backoff(initial, maximum, factor=2, timeout=None):
+    """Yields delays growing exponentially from `initial` up to `maximum`. Stops once their sum
+    would exceed `timeout`."""
+    delay = initial
+    total = 0
+    while timeout is None or total + delay <= timeout:
+        yield delay
+        total += delay
+        delay = min(delay * factor, maximum)
+
+
+def wait_rpc_ready(backend, is_alive, delays):
+    """Probes RPC server until it answers. Returns `True` when ready, `False` if the delays
+    were exhausted and `None` if the process has died."""
+    for delay in itertools.chain([0], delays):
+        time.sleep(delay)
+        if not is_alive():
+            return None
+        try:
+            backend.raw_request('get_version')
+            return True
+        except requests.exceptions.ConnectionError:
+            pass
+    return False
+
+
+class OutputBuffer(object):
+    """Keeps the last `size` bytes of a child process output, as drained by `OutputPump`.
+    Complete lines are matched against `patterns` (bytes regular expressions) and the first
+    match of each is kept in `matches`, keyed by the pattern."""
+    size = 65536
+
+    def __init__(self, size=None, patterns=()):
+        self.size = size or self.size
+        self.patterns = [re.compile(p) for p in patterns]
+        # lines are screened by a single regex, individual patterns run only on a hit
+        self._screen = re.compile(b'|'.join(b'(?:' + p.pattern + b')' for p in self.patterns)) \
+                if self.patterns else None
+        self.matches = collections.OrderedDict()
+        self.closed = False
+        self._data = bytearray()
+        self._partial = b''
+        self._changed = threading.Condition()
+
+    def feed(self, chunk):
+        with self._changed:
+            self._data += chunk
+            if len(self._data) > self.size:
+                del self._data[:len(self._data) - self.size]
+            if self._screen is not None:
+                lines = (self._partial + chunk).split(b'\n')
+                self._partial = lines.pop()[-self.size:]
+                self._match(lines)
+            self._changed.notify_all()
+
+    def _match(self, lines):
+        for line in lines:
+            if not self._screen.search(line):
+                continue
+            for pattern in self.patterns:
+                if pattern.pattern in self.matches:
+                    continue
+                match = pattern.search(line)
+                if match:
+                    self.matches[pattern.pattern] = match.group(0).decode('utf-8', 'replace')
+
+    def close(self):
+        """Marks the end of output."""
+        with self._changed:
+            if self._partial and self._screen is not None:
+                self._match([self._partial])
+            self._partial = b''
+            self.closed = True
+            self._changed.notify_all()
+
+    def getvalue(self):
+        with self._changed:
+            return bytes(self._data)
+
+    def wait_for(self, *patterns, timeout=None):
+        """Blocks until one of the patterns, which must be among those given to the
+        constructor, has matched. Returns `(pattern, matched_text)` of the earliest match,
+        or `None` if the output has ended or the timeout passed without a match."""
+        def _found():
+            for pattern, text in self.matches.items():
+                if pattern in patterns:
+                    return pattern, text
+        with self._changed:
+            self._changed.wait_for(lambda: self.closed or _found(), timeout)
+            return _found()
+
+    def wait(self, timeout=None):
+        """Blocks until the output ends. Returns the buffered output."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.closed, timeout)
+            return bytes(self._data)
+
+
+class OutputPump(threading.Thread):
+    """A thread draining stdout and stderr of all attached child processes with `selectors`,
+    so no child ever blocks on a full pipe and no thread is spent per child.
+    Normally the shared instance returned by `OutputPump.default()` is used."""
+    _default = None
+    _default_lock = threading.Lock()
+    chunk_size = 65536
+
+    def __init__(self):
+        super(OutputPump, self).__init__(name='output-pump', daemon=True)
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._pending = collections.deque()
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def default(cls):
+        """Returns the shared pump, started on first use."""
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def attach(self, popen, size=None, patterns=()):
+        """Starts draining the output pipes of a `subprocess.Popen` object into a new
+        `OutputBuffer`, which is returned and set as `output` attribute of the object."""
+        output = popen.output = OutputBuffer(size=size, patterns=patterns)
+        streams = [s for s in (popen.stdout, popen.stderr) if s is not None]
+        if not streams:
+            output.close()
+            return output
+        output._open_streams = len(streams)
+        for stream in streams:
+            self._pending.append((stream, output))
+        with self._start_lock:
+            if not self.is_alive():
+                self.start()
+        os.write(self._wakeup_w, b'\0')
+        return output
+
+    def run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.fileobj == self._wakeup_r:
+                    os.read(self._wakeup_r, 4096)
+                    while self._pending:
+                        stream, output = self._pending.popleft()
+                        self._selector.register(stream, selectors.EVENT_READ, output)
+                    continue
+                try:
+                    chunk = os.read(key.fd, self.chunk_size)
+                except OSError:
+                    chunk = b''
+                if chunk:
+                    key.data.feed(chunk)
+                    continue
+                self._selector.unregister(key.fileobj)
+                key.fileobj.close()
+                key.data._open_streams -= 1
+                if not key.data._open_streams:
+                    key.data.close()
+
+
 class DaemonClient(object):
     daemon_host = '127.0.0.1'
     daemon_port = 18081
@@ -46,32 +279,321 @@ class DaemonClient(object):
         return self.daemon
 
 
+class TipTracker(DaemonClient, threading.Thread):
+    """A thread tracking the daemon chain height, shared by all controllers of a pool, so the
+    daemon gets one height request per `poll_interval` regardless of the number of wallets.
+    Heights may also be pushed with `update()`, e.g. from a block notification subscriber.
+    `height` is 0 until the first successful poll or update.
+    If `balancer` is given (see `monerowalletpool.daemons.DaemonBalancer`), every poll checks
+    all of its daemons and takes the highest height.
+    """
+    poll_interval = 10
+    height = 0
+    latency = None
+    metrics = None
+    balancer = None
+
+    def __init__(self, poll_interval=None, metrics=None, balancer=None, **kwargs):
+        self.poll_interval = poll_interval or self.poll_interval
+        self.metrics = metrics if metrics is not None else self.metrics
+        self.balancer = balancer if balancer is not None else self.balancer
+        self._changed = threading.Condition()
+        self._listeners = []
+        self._stopping = threading.Event()
+        super(TipTracker, self).__init__(name='tip', daemon=True, **kwargs)
+        self.connect_daemon()
+
+    def subscribe(self, callback):
+        """Registers a callable to be called with the new height whenever the tip moves."""
+        self._listeners.append(callback)
+
+    def update(self, height):
+        """Sets new height and wakes up all waiting threads if it has changed."""
+        with self._changed:
+            if height == self.height:
+                return False
+            self.height = height
+            self._changed.notify_all()
+        for callback in self._listeners:
+            callback(height)
+        return True
+
+    def poll(self):
+        try:
+            started = time.time()
+            if self.balancer is not None:
+                height = self.balancer.check()
+                self.latency = self.balancer.latency
+            else:
+                height = self.daemon.height()
+                self.latency = time.time() - started
+            if self.metrics is not None:
+                self.metrics.daemon_latency.observe(self.latency)
+            self.update(height)
+        except Exception as e:
+            _log.error('Cannot get daemon height: {}'.format(e))
+        return self.height
+
+    def wait_for_change(self, height, timeout=None, stop=None):
+        """Blocks until the tip differs from given height or the timeout passes, or until
+        the `stop` event, if given, is set; whoever sets it must call `wake()`.
+        Returns the current height."""
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self.height != height or self._stopping.is_set()
+                        or (stop is not None and stop.is_set()), timeout)
+            return self.height
+
+    def wake(self):
+        """Makes the waiting threads check their `stop` events."""
+        with self._changed:
+            self._changed.notify_all()
+
+    def run(self):
+        while not self._stopping.wait(self.poll_interval):
+            self.poll()
+
+    def stop_tracking(self):
+        """Stops polling and releases all threads waiting for a change."""
+        self._stopping.set()
+        with self._changed:
+            self._changed.notify_all()
+
+
+BulkResult = collections.namedtuple('BulkResult', ['created', 'skipped', 'failed'])
+
+
+def read_wallet_records(stream):
+    """Parses wallet records from a text stream, one per line, either as JSON objects with
+    `address`, `viewkey`, `spendkey` and `restore_height` keys or as CSV rows in that order.
+    A CSV header line is skipped. Restore height may be a number or a `YYYY-MM-DD` date.
+    Yields `(address, viewkey, spendkey, restore_height)` tuples."""
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            data = json.loads(line)
+            fields = [data.get(k) for k in ('address', 'viewkey', 'spendkey', 'restore_height')]
+        else:
+            fields = next(csv.reader([line]))
+            if fields[0].strip() == 'address':
+                continue
+            fields = [(f.strip() or None) for f in fields] + [None] * (4 - len(fields))
+        address, viewkey, spendkey, restore = fields[:4]
+        if isinstance(restore, str):
+            if '-' in restore:
+                restore = datetime.datetime.strptime(restore, '%Y-%m-%d').date()
+            else:
+                restore = int(restore)
+        yield monero.address.Address(address), viewkey, spendkey, restore
+
+
+class DateHeightIndex(DaemonClient):
+    """Finds blockchain heights for dates by bisecting block header timestamps. Every timestamp
+    fetched is kept in a table, so lookups of nearby dates need few or no daemon requests.
+    If `path` is given, the table is stored there as JSON and reloaded on next run.
+    """
+    margin = 720    # about a day of blocks, covers timestamp skew and timezones
+
+    def __init__(self, path=None, margin=None, **kwargs):
+        self.path = path
+        self.margin = margin if margin is not None else self.margin
+        self._timestamps = {}   # height: timestamp
+        self._lock = threading.Lock()
+        if self.path and os.path.exists(self.path):
+            with open(self.path, 'r') as fp:
+                self._timestamps = {int(h): ts for h, ts in json.load(fp).items()}
+        super(DateHeightIndex, self).__init__(**kwargs)
+        self.connect_daemon()
+
+    def timestamp(self, height):
+        """Returns UNIX timestamp of the block at given height."""
+        if height not in self._timestamps:
+            self._timestamps[height] = self.daemon.headers(height)[0]['timestamp']
+        return self._timestamps[height]
+
+    def height(self, date):
+        """Returns the height of the last block before given date or datetime (UTC if naive),
+        lowered by `margin` blocks."""
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime(date.year, date.month, date.day)
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        stamp = date.timestamp()
+        with self._lock:
+            lo, hi = 0, self.daemon.height() - 1
+            # narrow the range down with the known timestamps
+            for known in sorted(self._timestamps):
+                if known > hi:
+                    break
+                if self._timestamps[known] < stamp:
+                    lo = known
+                else:
+                    hi = known
+                    break
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.timestamp(mid) < stamp:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            self.save()
+        return max(lo - self.margin, 0)
+
+    def save(self):
+        if not self.path:
+            return
+        tmpfile = '{}.tmp'.format(self.path)
+        with open(tmpfile, 'w') as fp:
+            json.dump(self._timestamps, fp)
+        os.replace(tmpfile, self.path)
+
+
+class WalletIndex(object):
+    """Index of wallet files in a directory, with network and initialization flag of each
+    address. The directory is scanned again only when its mtime changes, and then only new
+    entries are parsed. If `path` is given, the index is kept in SQLite database there,
+    so it survives restarts; otherwise it lives in memory.
+    """
+    batch_size = 1000
+
+    def __init__(self, directory, path=None):
+        self.directory = directory
+        self.path = path or ':memory:'
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        if self.path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS wallets ('
+            'address TEXT PRIMARY KEY, net TEXT, initialized INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS wallets_net ON wallets (net, initialized)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+        self._db.commit()
+
+    def _get_meta(self, key):
+        row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _net(address):
+        try:
+            addr = monero.address.Address(address)
+        except ValueError:
+            return None
+        if hasattr(addr, 'is_mainnet'):
+            if addr.is_mainnet():
+                return 'mainnet'
+            elif addr.is_stagenet():
+                return 'stagenet'
+            return 'testnet'
+        # monero-python >= 0.8 replaced is_*net() with net property
+        return '{}net'.format(addr.net)
+
+    def update(self):
+        """Rescans the directory if it has changed since the last scan."""
+        with self._lock:
+            stat = os.stat(self.directory)
+            scanned = self._get_meta('scanned')
+            if self._get_meta('mtime') == stat.st_mtime_ns and scanned is not None \
+                    and scanned > stat.st_mtime_ns + 1e9:
+                # changes within the last second may not alter mtime on coarse filesystems
+                return False
+            scanned = time.time_ns()
+            names = set(entry.name for entry in os.scandir(self.directory))
+            keys = set(name[:-5] for name in names if name.endswith('.keys'))
+            known = dict(self._db.execute('SELECT address, initialized FROM wallets'))
+            with self._db:
+                self._db.executemany('DELETE FROM wallets WHERE address = ?',
+                        ((addr,) for addr in known.keys() - keys))
+                self._db.executemany('INSERT INTO wallets VALUES (?, ?, ?)',
+                        ((addr, self._net(addr), int(addr in names)) for addr in keys - known.keys()))
+                self._db.executemany('UPDATE wallets SET initialized = ? WHERE address = ?',
+                        ((int(addr in names), addr) for addr in keys & known.keys()
+                            if known[addr] != int(addr in names)))
+                self._db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (('mtime', stat.st_mtime_ns), ('scanned', scanned)))
+            return True
+
+    def addresses(self, net):
+        """Yields addresses of given network, uninitialized wallets first."""
+        last = (-1, '')
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT initialized, address FROM wallets WHERE net = ? AND '
+                    '(initialized > ? OR (initialized = ? AND address > ?)) '
+                    'ORDER BY initialized, address LIMIT ?',
+                    (net, last[0], last[0], last[1], self.batch_size)).fetchall()
+            for row in rows:
+                yield row[1]
+            if len(rows) < self.batch_size:
+                return
+            last = rows[-1]
+
+    def close(self):
+        self._db.close()
+
+
 class WalletsManager(DaemonClient):
-    """Manages a directory of wallets. Can list, create, open and generate wallets."""
+    """Manages a directory of wallets. Can list, create, open and generate wallets.
+    If `staging` is given (see `monerowalletpool.staging.StagingArea`), the RPC servers open
+    the wallets from there instead of the directory.
+    If `tracer` is given (see `monerowalletpool.tracing.Tracer`), wallet creation and spawning
+    of RPC servers are traced there."""
     directory = '.'
     cmd_cli = 'monero-wallet-cli'
     cmd_rpc = 'monero-wallet-rpc'
     net = 'mainnet'
     log_dir = '.'
     log_level = 1
+    date_index_file = None
+    date_index = None
+    index_file = None
+    index = None
+    pump = None
+    staging = None
+    tracer = None
+    error_pattern = br'Error:.*'    # wallet CLI error messages
 
     def __init__(self, directory=None, net=None, cmd_cli=None, cmd_rpc=None, rpc_port_range=None,
-            log_dir=None, log_level=None, **kwargs):
+            log_dir=None, log_level=None, date_index_file=None, index_file=None, pump=None,
+            staging=None, tracer=None, **kwargs):
         self.directory = directory or self.directory
         self.cmd_cli = cmd_cli or self.cmd_cli
         self.cmd_rpc = cmd_rpc or self.cmd_rpc
         self.net = net or self.net
         self.log_dir = log_dir or self.log_dir
         self.log_level = log_level if log_level is not None else self.log_level
+        self.date_index_file = date_index_file or self.date_index_file
+        self.index_file = index_file or self.index_file
+        self.pump = pump or self.pump or OutputPump.default()
+        self.staging = staging if staging is not None else self.staging
+        self.tracer = tracer if tracer is not None else self.tracer
         assert self.net in ('mainnet', 'stagenet', 'testnet')
         assert os.path.exists(self.directory) and os.path.isdir(self.directory)
+        self.index = WalletIndex(self.directory, path=self.index_file)
+        self._creating = {}     # address: Popen of the CLI process creating the wallet
+        self._creating_lock = threading.Lock()
         super(WalletsManager, self).__init__(**kwargs)
+        self.date_index = DateHeightIndex(path=self.date_index_file, **self.daemon_connection_params())
+
+    def restore_height(self, restore):
+        """Returns blockchain height to restore a wallet from. `restore` may be a height,
+        a date or `None` for the beginning of the chain."""
+        if restore is None:
+            return 0
+        if isinstance(restore, datetime.date):
+            return self.date_index.height(restore)
+        return int(restore)
 
-    def _common_args(self, log_file=None):
-        args = ['--password', '',
-                '--daemon-address', '%s:%s' % (self.daemon_host, self.daemon_port),
+    def _common_args(self, log_file=None, password=True, daemon_address=None):
+        args = ['--password', ''] if password else []
+        args.extend(['--daemon-address',
+                daemon_address or '%s:%s' % (self.daemon_host, self.daemon_port),
                 '--trusted-daemon',
-                '--log-level', str(self.log_level)]
+                '--log-level', str(self.log_level)])
         args.append('--log-file')
         if log_file:
             args.append(os.path.join(self.log_dir, log_file))
@@ -83,54 +605,70 @@ class WalletsManager(DaemonClient):
             args.append('--testnet')
         return args
 
-    def _shutdown(self, wpopen):
-        out, err = wpopen.communicate()
-        _log.debug('stdout: %s' % out.decode())
-        _log.debug('stderr: %s' % err.decode())
-        tmout = 0
-        while not wpopen.poll():
-            time.sleep(1)
-            tmout += 1
-            if tmout >= 10:
-                wpopen.kill()
-                break
-        return out, err
+    def _spawn(self, args, patterns=()):
+        """Starts a process with its output drained by the pump. Returns its Popen object
+        with `output` attribute holding the `OutputBuffer`."""
+        _log.debug(' '.join(args))
+        wpopen = subprocess.Popen(args, bufsize=0, env=owner_env(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.pump.attach(wpopen, patterns=patterns)
+        return wpopen
+
+    def _shutdown(self, wpopen, timeout=10):
+        """Closes the input of CLI process and waits for it to exit. Returns its output."""
+        wpopen.stdin.close()
+        try:
+            wpopen.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            wpopen.kill()
+            wpopen.wait()
+        out = wpopen.output.wait()
+        _log.debug('output: %s' % out.decode('utf-8', 'replace'))
+        return out
+
+    def _expect(self, wpopen, *patterns, error=WalletCreationError):
+        """Waits for CLI process to print a line matching one of the patterns. Returns
+        `(pattern, matched_text)`. If the process reports an error or exits instead, it is shut
+        down and the `error` exception is raised."""
+        found = wpopen.output.wait_for(self.error_pattern, *patterns)
+        if found is None or found[0] == self.error_pattern:
+            out = self._shutdown(wpopen)
+            raise error(found[1] if found is not None else
+                    'Wallet CLI exited with code {} before printing {}: {}'.format(
+                    wpopen.returncode, b' or '.join(patterns).decode(),
+                    out[-256:].decode('utf-8', 'replace')))
+        return found
+
+    def iter_wallets(self, parse=False):
+        """Yields addresses of wallets that are available to this manager, uninitialized
+        wallets first. Addresses are strings unless `parse` is set.
+        """
+        self.index.update()
+        for addr in self.index.addresses(self.net):
+            yield monero.address.Address(addr) if parse else addr
 
     def list_wallets(self):
         """Returns a sequence of wallet addresses that are available to this manager.
         Uninitialized wallets will be first in the sequence.
         """
-        addresses = collections.deque()
-        for i in os.listdir(self.directory):
-            # scan the directory for *.keys files, assume that * is the address
-            if not i.endswith('.keys'):
-                continue
-            try:
-                addr = monero.address.Address(i.replace('.keys', ''))
-            except ValueError:
-                pass
-            if self.net == 'mainnet' and not addr.is_mainnet() \
-                or self.net == 'stagenet' and not addr.is_stagenet() \
-                or self.net == 'testnet' and not addr.is_testnet():
-                continue
-            if os.path.exists(os.path.join(self.directory, str(addr))):
-                addresses.append(addr)
-            else:
-                # wallet is not initialized (only .keys file), add it at the beginning
-                addresses.appendleft(addr)
-        return addresses
+        return collections.deque(self.iter_wallets(parse=True))
 
     def wallet_exists(self, address):
         return os.path.exists(os.path.join(self.directory, '{}.keys'.format(address)))
 
-    def create_wallet(self, address, viewkey, spendkey, wait_for_sync=False):
-        """Creates a wallet."""
+    @traced('create')
+    def create_wallet(self, address, viewkey, spendkey, wait_for_sync=False, restore_height=None,
+            daemon_address=None):
+        """Creates a wallet. The `restore_height` may be a height or a date of wallet creation.
+        If not given, the wallet will be scanned from the beginning of the chain.
+        The `daemon_address` (`host:port`) overrides the daemon of the manager."""
         def _check_error(bs):
             error_re = re.compile(r'(Error:.*)').search(bs.decode('utf-8'))
             if error_re:
                 raise WalletCreationError(error_re.groups()[0])
 
         assert viewkey is not None or spendkey is not None
+        height = self.restore_height(restore_height)
         with tempfile.TemporaryDirectory() as wdir:
             wfile = os.path.join(wdir, 'wallet')
             _log.debug('Wallet file: %s' % wfile)
@@ -140,37 +678,28 @@ class WalletsManager(DaemonClient):
             else:
                 args.append('--generate-from-view-key')
             args.append(wfile)
-            args.extend(self._common_args("{:s}-create.log".format(address)))
-            _log.debug(' '.join(args))
-            wcreate = subprocess.Popen(args, bufsize=0,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out = b''
-            i = 0
-            while b'Logging' not in out:
-                out = wcreate.stdout.readline()
-                if i < 10:  # don't flood if something fails
-                    _log.debug('stdout: %s' % out)
-                i += 1
-            if spendkey:
-                wcreate.stdin.write(b'%s\n' % str(spendkey).encode('ascii'))    # key
-                wcreate.stdin.write(b'1\n')                                     # English language
-                wcreate.stdin.write(b'0\n')                                     # refresh from 0
-            else:
-                wcreate.stdin.write(b'%s\n' % str(address).encode('ascii'))     # address
-                wcreate.stdin.write(b'%s\n' % str(viewkey).encode('ascii'))     # key
-                wcreate.stdin.write(b'0\n')                                     # refresh from 0
-            if wait_for_sync:
-                oldchunk = b''
-                while True:
-                    chunk = wcreate.stdout.read(64)
-                    out = oldchunk + chunk
-                    _check_error(out)
-                    if b'Refresh done' in out or b'Balance' in out:
-                        break
-                    _log.debug('stdout: %s' % chunk)
-                    time.sleep(0)
-                    oldchunk = chunk
-            out, _ = self._shutdown(wcreate)
+            args.extend(self._common_args("{:s}-create.log".format(address),
+                    daemon_address=daemon_address))
+            wcreate = self._spawn(args, patterns=(
+                    b'Logging', self.error_pattern, b'Refresh done', b'Balance'))
+            with self._creating_lock:
+                self._creating[str(address)] = wcreate
+            try:
+                self._expect(wcreate, b'Logging')
+                if spendkey:
+                    wcreate.stdin.write(b'%s\n' % str(spendkey).encode('ascii'))    # key
+                    wcreate.stdin.write(b'1\n')                                     # English language
+                    wcreate.stdin.write(b'%d\n' % height)                           # restore height
+                else:
+                    wcreate.stdin.write(b'%s\n' % str(address).encode('ascii'))     # address
+                    wcreate.stdin.write(b'%s\n' % str(viewkey).encode('ascii'))     # key
+                    wcreate.stdin.write(b'%d\n' % height)                           # restore height
+                if wait_for_sync:
+                    self._expect(wcreate, b'Refresh done', b'Balance')
+                out = self._shutdown(wcreate)
+            finally:
+                with self._creating_lock:
+                    self._creating.pop(str(address), None)
             if not os.path.exists(wfile):
                 _check_error(out)
                 raise WalletCreationError('Unknown error')
@@ -179,6 +708,62 @@ class WalletsManager(DaemonClient):
             shutil.move(kfile, os.path.join(self.directory, '%s.keys' % str(address)))
             return address
 
+    def kill_creation(self, address):
+        """Kills the CLI process creating wallet `address`, if any, making `create_wallet()`
+        raise `WalletCreationError`. May be called from any thread. Returns `True` if there
+        was such process."""
+        with self._creating_lock:
+            wcreate = self._creating.get(str(address))
+        if wcreate is None:
+            return False
+        _log.warning('Killing the CLI process creating wallet {}.'.format(address))
+        wcreate.kill()
+        return True
+
+    def bulk_create(self, records, workers=4, wait_for_sync=False, progress=None):
+        """Creates wallets from an iterable of `(address, viewkey, spendkey, restore_height)`
+        records, running up to `workers` wallet CLI processes at once. Wallets which already
+        exist are skipped, so an interrupted import may be resumed with the same input.
+        The `progress` callable, if given, is called after each record with
+        `(address, result, done_count)` where result is `'created'`, `'skipped'` or the exception.
+        Returns a `BulkResult` of created and skipped addresses and `(address, exception)` failures.
+        """
+        result = BulkResult([], [], [])
+        slots = threading.BoundedSemaphore(workers * 2)   # don't read ahead the whole input
+        lock = threading.Lock()
+
+        def _create(address, viewkey, spendkey, restore_height):
+            try:
+                self.create_wallet(address, viewkey, spendkey,
+                        wait_for_sync=wait_for_sync, restore_height=restore_height)
+                _done(address, 'created')
+            except Exception as e:
+                _log.error('Cannot create wallet {}: {}'.format(address, e))
+                _done(address, e)
+            finally:
+                slots.release()
+
+        def _done(address, outcome):
+            with lock:
+                if outcome == 'created':
+                    result.created.append(address)
+                elif outcome == 'skipped':
+                    result.skipped.append(address)
+                else:
+                    result.failed.append((address, outcome))
+                done = len(result.created) + len(result.skipped) + len(result.failed)
+            if progress is not None:
+                progress(address, outcome, done)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for address, viewkey, spendkey, restore_height in records:
+                if self.wallet_exists(address):
+                    _done(address, 'skipped')
+                    continue
+                slots.acquire()
+                executor.submit(_create, address, viewkey, spendkey, restore_height)
+        return result
+
     def generate_wallet(self):
         """Generates a random wallet and returns the address."""
         with tempfile.TemporaryDirectory() as wdir:
@@ -188,22 +773,12 @@ class WalletsManager(DaemonClient):
                     '--use-english-language-names']
             args.extend(['--generate-new-wallet', wfile])
             args.extend(self._common_args("generate.log"))
-            _log.debug(' '.join(args))
-            wcreate = subprocess.Popen(args, bufsize=0,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            out = b''
-            while b'English' not in out:
-                out = wcreate.stdout.readline()
-                _log.debug('stdout: %s' % out)
+            generated = br'Generated new wallet:\s[^\s]+'
+            wcreate = self._spawn(args, patterns=(b'English', generated, self.error_pattern))
+            self._expect(wcreate, b'English', error=CommunicationError)
             wcreate.stdin.write(b'1\n')
-            while b'Generated' not in out:
-                out = wcreate.stdout.readline()
-                _log.debug('stdout: %s' % out)
-            addr_re = re.compile(r'Generated new wallet:\s([^\s]+)').search(out.decode('utf-8'))
-            if not addr_re:
-                wcreate.kill()
-                raise CommunicationError('Cannot find address')
-            address = monero.address.Address(addr_re.groups()[0])
+            _, out = self._expect(wcreate, generated, error=CommunicationError)
+            address = monero.address.Address(out.split()[-1])
             _log.debug('Address: %s' % address)
             self._shutdown(wcreate)
             kfile = '%s.keys' % wfile
@@ -211,16 +786,321 @@ class WalletsManager(DaemonClient):
             shutil.move(kfile, os.path.join(self.directory, '%s.keys' % str(address)))
             return address
 
-    def open_wallet(self, address, port):
-        """Starts RPC server for the wallet and returns its Popen object."""
+    def rpc_directory(self):
+        """Returns the directory the RPC servers open wallets from: the staging area,
+        if any, or the wallet directory."""
+        return self.staging.path if self.staging is not None else self.directory
+
+    def open_wallet_args(self, address, port, daemon_address=None):
+        """Returns the command line of RPC server for the wallet."""
         args = [self.cmd_rpc,
-                '--wallet-file', os.path.join(self.directory, str(address)),
+                '--wallet-file', os.path.join(self.rpc_directory(), str(address)),
                 '--rpc-bind-port', str(port),
                 '--disable-rpc-login']
-        args.extend(self._common_args("{:s}.log".format(address)))
-        _log.debug(' '.join(args))
-        return subprocess.Popen(args, bufsize=0,
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        args.extend(self._common_args("{:s}.log".format(address), daemon_address=daemon_address))
+        return args
+
+    @traced('spawn')
+    def open_wallet(self, address, port, daemon_address=None):
+        """Starts RPC server for the wallet and returns its Popen object. The output of the
+        process is kept in `output` attribute of the object, see `OutputBuffer`."""
+        return self._spawn(self.open_wallet_args(address, port, daemon_address=daemon_address))
+
+    def start_worker(self, port):
+        """Starts RPC server with no wallet open, serving the whole wallet directory
+        (or the staging area). Returns its Popen object."""
+        args = [self.cmd_rpc,
+                '--wallet-dir', self.rpc_directory(),
+                '--rpc-bind-port', str(port),
+                '--disable-rpc-login']
+        args.extend(self._common_args("worker-{:d}.log".format(port), password=False))
+        return self._spawn(args)
+
+
+class PortAllocator(object):
+    """Hands out RPC ports of `range(start, stop)`, verifying each one by binding it first,
+    so ports taken by other programs or leftover processes are skipped. Released ports go to
+    the end of the free list, giving the sockets of stopped processes time to clear."""
+    host = '127.0.0.1'
+
+    def __init__(self, start, stop, host=None):
+        self.host = host or self.host
+        self._free = collections.deque(range(start, stop))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._free)
+
+    def is_free(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # binds like the wallet RPC server does
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, port))
+            return True
+        except OSError:
+            return False
+        finally:
+            sock.close()
+
+    def acquire(self):
+        """Returns a free port. Raises `CommunicationError` if there's none."""
+        with self._lock:
+            for i in range(len(self._free)):
+                port = self._free.popleft()
+                if self.is_free(port):
+                    return port
+                _log.warning('Port {} is in use, skipping.'.format(port))
+                self._free.append(port)
+        raise CommunicationError('No free port in the RPC port range.')
+
+    def release(self, port):
+        with self._lock:
+            if port is not None and port not in self._free:
+                self._free.append(port)
+
+
+class RPCWorker(object):
+    """A long-lived `monero-wallet-rpc` process started with `--wallet-dir`. Wallets are
+    switched by `open_wallet`/`close_wallet` RPC calls instead of spawning a process for each.
+    Exposes fields:
+        * `port` - the RPC port of the process,
+        * `address` - the address of currently open wallet or `None`.
+    """
+    address = None
+    # readiness probing backoff, see `backoff()`
+    init_delay = 0.05
+    init_max_delay = 2
+    init_timeout = 120
+    stop_timeout = 10
+
+    def __init__(self, manager, port):
+        self.manager = manager
+        self.port = port
+        self._wallet_rpc = self.manager.start_worker(port)
+        self.backend = monero.backends.jsonrpc.JSONRPCWallet(port=port)
+
+    def is_alive(self):
+        return self._wallet_rpc.poll() is None
+
+    def wait_ready(self):
+        """Blocks until the RPC server answers requests."""
+        ready = wait_rpc_ready(self.backend, self.is_alive,
+                backoff(self.init_delay, self.init_max_delay, timeout=self.init_timeout))
+        if ready is None:
+            self._wallet_rpc.wait()
+            raise CommunicationError('Worker on port {} has stopped with exit code {}\n' \
+                    'output:\n{}\n'.format(self.port, self._wallet_rpc.returncode,
+                    self._wallet_rpc.output.wait().decode('utf-8', 'replace')))
+        if not ready:
+            raise CommunicationError('Could not connect to worker on port {} in {} sec.'.format(
+                self.port, self.init_timeout))
+
+    def open_wallet(self, address):
+        self.wait_ready()
+        self.backend.raw_request('open_wallet', {'filename': str(address), 'password': ''})
+        self.address = address
+
+    def close_wallet(self):
+        self.backend.raw_request('close_wallet', {'autosave_current': True})
+        self.address = None
+
+    def set_daemon(self, daemon_address):
+        """Points the open wallet to another daemon. Opening a wallet resets it to the daemon
+        the process has been started with."""
+        self.backend.raw_request('set_daemon', {'address': daemon_address, 'trusted': True})
+
+    def stop(self, timeout=None):
+        """Stops the process through RPC, which stores the open wallet. Terminates it if RPC
+        fails and kills it if it's still running after `timeout` (`stop_timeout` by default)."""
+        if self.is_alive():
+            try:
+                self.backend.raw_request('stop_wallet')
+            except Exception as e:
+                _log.debug('Worker on port {} failed to stop: {}'.format(self.port, e))
+                self._wallet_rpc.terminate()
+        try:
+            self._wallet_rpc.wait(timeout=timeout if timeout is not None else self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            self._wallet_rpc.kill()
+            self._wallet_rpc.wait()
+
+
+class SyncScheduler(object):
+    """A priority queue of addresses waiting to be synced. The most stale wallet comes first,
+    where staleness is scored as:
+
+        weight * (block_weight * blocks_behind_tip + time_weight * seconds_since_last_sync)
+
+    Wallets of unknown height count as being behind by the whole chain. Wallets which have
+    already reached the tip are parked and not returned until the tip moves.
+    Addresses returned by `pop()` are checked out and get back into the queue with `done()`
+    once synced or with `requeue()` otherwise.
+    Addresses rejected by the `owns` filter of `pop()` are set aside until `release_foreign()`.
+    """
+    block_weight = 1.0
+    time_weight = 1.0 / 120     # one block per two minutes
+
+    def __init__(self, block_weight=None, time_weight=None):
+        self.block_weight = block_weight if block_weight is not None else self.block_weight
+        self.time_weight = time_weight if time_weight is not None else self.time_weight
+        self.tip = 0
+        self._wallets = {}      # address: [weight, height, synced_at, token]
+        self._queues = {}       # weight: heap of (key, token, address)
+        self._parked = set()
+        self._foreign = set()
+        self._checked_out = set()
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._wallets) - len(self._checked_out)
+
+    def __contains__(self, address):
+        return address in self._wallets
+
+    def _key(self, wallet):
+        weight, height, synced_at, _ = wallet
+        return self.block_weight * (height or 0) + self.time_weight * (synced_at or 0)
+
+    def _push(self, address):
+        wallet = self._wallets[address]
+        wallet[3] = next(self._tokens)
+        heapq.heappush(
+            self._queues.setdefault(wallet[0], []),
+            (self._key(wallet), wallet[3], address))
+
+    def score(self, address, now=None):
+        weight, height, synced_at, _ = self._wallets[address]
+        now = now or time.time()
+        return weight * (
+            self.block_weight * max(self.tip - (height or 0), 0)
+            + self.time_weight * (now - (synced_at or 0)))
+
+    def add(self, address, weight=1.0, height=None, synced_at=None):
+        """Adds the address to the queue or updates its weight and sync state."""
+        with self._lock:
+            wallet = self._wallets.setdefault(address, [weight, None, None, None])
+            wallet[0] = weight
+            wallet[1] = height if height is not None else wallet[1]
+            wallet[2] = synced_at if synced_at is not None else wallet[2]
+            self._parked.discard(address)
+            self._foreign.discard(address)
+            if address not in self._checked_out:
+                self._push(address)
+
+    def remove(self, address):
+        with self._lock:
+            self._wallets.pop(address, None)
+            self._parked.discard(address)
+            self._foreign.discard(address)
+            self._checked_out.discard(address)
+
+    def set_tip(self, height):
+        """Updates the daemon height. Parked wallets get back into the queue if it has moved."""
+        with self._lock:
+            if height <= self.tip:
+                return
+            self.tip = height
+            parked, self._parked = self._parked, set()
+            for address in parked:
+                self._push(address)
+
+    def release_foreign(self):
+        """Gets the addresses set aside by `pop()` back into the queue, e.g. when the ownership
+        of addresses changes."""
+        with self._lock:
+            foreign, self._foreign = self._foreign, set()
+            for address in foreign:
+                self._push(address)
+
+    def pop(self, owns=None):
+        """Checks out and returns the most stale address or `None` if there's nothing to sync.
+        If `owns` is given, addresses for which it returns false are skipped and set aside."""
+        now = time.time()
+        with self._lock:
+            while True:
+                best, best_score = None, None
+                for weight, heap in self._queues.items():
+                    # drop entries invalidated by later updates
+                    while heap and (heap[0][2] not in self._wallets
+                            or self._wallets[heap[0][2]][3] != heap[0][1]):
+                        heapq.heappop(heap)
+                    if heap:
+                        score = self.score(heap[0][2], now)
+                        if best_score is None or score > best_score:
+                            best, best_score = weight, score
+                if best is None:
+                    return None
+                _, _, address = heapq.heappop(self._queues[best])
+                self._wallets[address][3] = None
+                height = self._wallets[address][1]
+                if self.tip and height is not None and height >= self.tip:
+                    # nothing new since the last sync
+                    self._parked.add(address)
+                    continue
+                if owns is not None and not owns(address):
+                    self._foreign.add(address)
+                    continue
+                self._checked_out.add(address)
+                return address
+
+    def checkout(self, address):
+        """Checks out the address out of order, e.g. for a requested sync. Addresses unknown
+        to the scheduler are ignored."""
+        with self._lock:
+            if address in self._wallets:
+                # invalidates the queued entry
+                self._wallets[address][3] = None
+                self._parked.discard(address)
+                self._foreign.discard(address)
+                self._checked_out.add(address)
+
+    def done(self, address, height=None, synced_at=None):
+        """Returns a synced address into the queue, optionally with the height it reached."""
+        self._return(address, height, synced_at or time.time())
+
+    def requeue(self, address, height=None):
+        """Returns a checked out address that hasn't been synced, e.g. after a failure or when
+        it couldn't be started. It keeps the time of its last sync and so its staleness."""
+        self._return(address, height, None)
+
+    def _return(self, address, height, synced_at):
+        with self._lock:
+            self._checked_out.discard(address)
+            if address not in self._wallets:
+                return
+            wallet = self._wallets[address]
+            wallet[1] = height if height is not None else wallet[1]
+            wallet[2] = synced_at if synced_at is not None else wallet[2]
+            self._push(address)
+
+
+class SyncPacing(object):
+    """Spaces the checks of a syncing wallet by the estimated time it needs to catch up with
+    the daemon, within `sync_min_sleep` and `sync_max_sleep` seconds. Subclasses keep the last
+    seen wallet height in `height`."""
+    treat_as_synced_height_diff = 1
+    sync_min_sleep = 0.2
+    sync_max_sleep = 10
+    height = None
+    _sync_sample = None
+    _sync_delay = 0
+
+    def sync_delay(self, daemon_height, now=None):
+        """Estimates the time until the wallet catches up with the daemon, from the pace of
+        height changes since the previous call. With no progress seen, backs off exponentially."""
+        now = now or time.time()
+        last, self._sync_sample = self._sync_sample, (now, self.height)
+        if last is None or self.height <= last[1] or now <= last[0]:
+            self._sync_delay = min(
+                self._sync_delay * 2 if self._sync_delay else self.sync_min_sleep,
+                self.sync_max_sleep)
+            return self._sync_delay
+        velocity = (self.height - last[1]) / (now - last[0])
+        behind = daemon_height - self.treat_as_synced_height_diff - self.height
+        self._sync_delay = max(self.sync_min_sleep, min(behind / velocity, self.sync_max_sleep))
+        return self._sync_delay
 
 
 WALLET_STARTING = 'starting'
@@ -232,134 +1112,514 @@ WALLET_CLOSED = 'closed'
 WALLET_FAILED = 'failed'
 
 
-class WalletController(DaemonClient, threading.Thread):
+class WalletController(SyncPacing, DaemonClient, threading.Thread):
     """A thread that controls running wallet. Needs a daemon connection to determine whether
     wallet height is up to date (synced). Exposes fields:
         * `status` - indicates the state of the wallet, where `WALLET_SYNCED` means a running and
           fully synced wallet,
         * `wallet` - the `monero.wallet.Wallet` object that allows talking to wallet API.
+        * `backend` - the `monero.backends.jsonrpc.JSONRPCWallet` of the wallet, for raw calls.
         * `shut_down` - a flag which causes the wallet to shut down gracefully once set to `True`.
         * `start_time` - a datetime.datetime stamp of intialization time.
         * `running_time` - a datetime.timedelta period of running, once it reaches terminal status.
+        * `worker` - the `RPCWorker` the wallet is opened in, or `None` if the controller
+          spawns its own `monero-wallet-rpc` process. Unless `reuse_worker` is set, the worker
+          gets stopped along with the wallet.
+        * `height` - the wallet height as last seen by the controller.
+        * `sync_time` - a datetime.timedelta period from starting to reaching `WALLET_SYNCED`.
+        * `ready_time` - a datetime.timedelta period from spawning (or opening in a worker)
+          the wallet RPC to getting the wallet ready.
+        * `scan_rate` - the average number of blocks per second scanned while syncing.
+        * `scanned_blocks` - the number of blocks scanned while syncing.
+        * `node` - the `monerowalletpool.daemons.DaemonNode` the wallet syncs from, or `None`
+          for the daemon of the manager.
+        * `priority` - the priority of the sync, higher for requested syncs, see
+          `WalletPool.request_sync()`.
+        * `error` - the exception the wallet has failed with, if any.
+    If `events` queue is given, every status change is put there as `(controller, status)` tuple.
+    If `tip` is given, the daemon height is taken from that shared `TipTracker` instead of
+    connecting to the daemon directly.
+    If `transfers` is given (see `monerowalletpool.transfers.TransferStream`), new transfers
+    of the wallet are collected there before it's reported synced.
+    If `snapshots` is given (see `monerowalletpool.snapshots.SnapshotCache`), a snapshot of
+    the wallet is taken there before it's reported synced.
+    If `tracer` is given (see `monerowalletpool.tracing.Tracer`), the phases of the wallet
+    lifecycle are traced there.
     """
-    status = WALLET_STARTING
+    _status = WALLET_STARTING
+    events = None
     wallet = None
-    shut_down = False   # set from external thread to stop this WalletController
+    backend = None
+    transfers = None
+    snapshots = None
+    tracer = None
+    error = None
     sync_new = True     # whether to wait for created wallets to sync fully
-    treat_as_synced_height_diff = 1
-    # The following specifies retries * sleep for opening a wallet.
-    # Default 100 sec may fail on fresh wallets. Don't panic.
-    init_sleep = 10
-    init_retries = 10
+    # The RPC server is probed with delays growing from `init_delay` up to `init_max_delay`,
+    # for `init_timeout` sec in total. Fresh wallets may take long to open. Don't panic.
+    init_delay = 0.05
+    init_max_delay = 5
+    init_timeout = 200
+    # seconds for the wallet RPC to store the wallet and exit before getting killed, unless
+    # `close_deadline` (a UNIX timestamp) is set by a draining pool
+    stop_timeout = 10
+    close_deadline = None
     start_time = None       # datetime.datetime of starting
     running_time = None     # datetime.timedelta of running time
     keys = (None, None)
+    worker = None
+    tip = None
+    sync_time = None
+    ready_time = None
+    scan_rate = None
+    scanned_blocks = 0
+    metrics = None
+    node = None
+    priority = 0
+    reuse_worker = True
 
     def __init__(self, address, port, manager, **kwargs):
         self.port = port
         self.address = address
         self.manager = manager
         self.keys = kwargs.pop('keys', self.keys)
+        self.worker = kwargs.pop('worker', self.worker)
+        self.events = kwargs.pop('events', self.events)
+        self.tip = kwargs.pop('tip', self.tip)
+        self.metrics = kwargs.pop('metrics', self.metrics)
         self.sync_new = kwargs.pop('sync_new', self.sync_new)
+        self.node = kwargs.pop('node', self.node)
+        self.transfers = kwargs.pop('transfers', self.transfers)
+        self.snapshots = kwargs.pop('snapshots', self.snapshots)
+        self.tracer = kwargs.pop('tracer', self.tracer)
+        self.priority = kwargs.pop('priority', self.priority)
+        self.reuse_worker = kwargs.pop('reuse_worker', self.reuse_worker)
+        self._switch_node = None
+        self._close_started = None
+        self._shut_down = threading.Event()
         self.start_time = datetime.datetime.now()
-        super(WalletController, self).__init__(name=str(address), **kwargs)
-        self.connect_daemon()
+        super(WalletController, self).__init__(name=str(address), daemon=True, **kwargs)
+        if self.tip is None:
+            self.connect_daemon()
+
+    def daemon_height(self):
+        """Returns the daemon height, or `None` while the tip tracker hasn't got it yet."""
+        if self.tip is not None:
+            return self.tip.height or None
+        return self.daemon.height()
+
+    def target_height(self, daemon_height):
+        """Returns the height the wallet can reach: that of the chain, unless the daemon node
+        it syncs from lags behind, as the balancer allows up to `max_lag` blocks."""
+        if self.node is not None and self.node.height is not None:
+            return min(daemon_height, self.node.height)
+        return daemon_height
+
+    def wait_sync(self, daemon_height):
+        """Waits before the next wallet height check."""
+        delay = self.sync_delay(daemon_height)
+        if self.tip is not None:
+            self.tip.wait_for_change(daemon_height, timeout=delay, stop=self._shut_down)
+        else:
+            self._shut_down.wait(delay)
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        if self.events is not None:
+            self.events.put((self, status))
+
+    @property
+    def shut_down(self):
+        return self._shut_down.is_set()
+
+    @shut_down.setter
+    def shut_down(self, value):
+        # set from external thread to stop this WalletController
+        if value:
+            self._shut_down.set()
+            if self.tip is not None:
+                # wakes up the wait for the tip
+                self.tip.wake()
+        else:
+            self._shut_down.clear()
+
+    def daemon_address(self):
+        return self.node.address if self.node is not None else None
+
+    def switch_daemon(self, node):
+        """Makes the wallet sync from another daemon. May be called from other threads,
+        the switch happens on the next height check."""
+        self._switch_node = node
+
+    def set_daemon(self, node):
+        self.backend.raw_request('set_daemon', {'address': node.address, 'trusted': True})
+        _log.info('Wallet {} switched to daemon {}.'.format(self.address, node.address))
+        self.node = node
+
+    def span(self, name, **args):
+        """Returns a context manager tracing the phase `name` of the wallet."""
+        return trace_span(self.tracer, name, self.address, **args)
 
     def run(self):
         _log.debug('run(): {}'.format(self.address))
-        self.init()
+        if not self.init():
+            return
         try:
-            while self.daemon.height() > self.wallet.height() + self.treat_as_synced_height_diff:
-                time.sleep(10)
+            with self.span('sync_wait'):
+                synced = self.sync()
+            if not synced:
+                # closing stores the progress made so far
+                return
+            self.sync_time = datetime.datetime.now() - self.start_time
+            if self.transfers is not None:
+                try:
+                    with self.span('collect'):
+                        self.transfers.collect(self.address, self.backend)
+                except Exception as e:
+                    _log.error('Cannot collect transfers of {}: {}'.format(self.address, e))
+            if self.snapshots is not None:
+                try:
+                    with self.span('snapshot'):
+                        self.snapshots.take(self.address, self.backend)
+                except Exception as e:
+                    _log.error('Cannot take snapshot of {}: {}'.format(self.address, e))
             self.status = WALLET_SYNCED
-            while not self.shut_down:
-                time.sleep(1)
+            self._shut_down.wait()
         finally:
             self.close()
 
+    def sync(self):
+        """Waits until the wallet catches up with the daemon. Returns `True` once synced,
+        `False` if shut down before."""
+        first_check = None
+        while True:
+            if self._switch_node is not None:
+                node, self._switch_node = self._switch_node, None
+                self.set_daemon(node)
+            started = time.time()
+            self.height = self.wallet.height()
+            if self.metrics is not None:
+                self.metrics.wallet_latency.observe(time.time() - started)
+            first_check = first_check or (started, self.height)
+            daemon_height = self.daemon_height()
+            if daemon_height is None:
+                # the first poll of the tip has failed, nothing to compare with
+                if self.shut_down:
+                    return False
+                self.tip.wait_for_change(0, timeout=self.sync_max_sleep, stop=self._shut_down)
+                continue
+            if self.target_height(daemon_height) <= self.height + self.treat_as_synced_height_diff:
+                break
+            if self.shut_down:
+                return False
+            self.wait_sync(daemon_height)
+        if self.height > first_check[1]:
+            self.scanned_blocks = self.height - first_check[1]
+            self.scan_rate = (self.height - first_check[1]) / (started - first_check[0])
+        return True
+
     def is_alive(self):
+        if self.worker is not None:
+            return self.worker.is_alive()
         if self._wallet_rpc.poll() is None:
             _log.debug('Wallet {} is alive.'.format(self.address))
             return True
         return False
 
     def init(self):
+        """Creates the wallet if needed and opens it. Returns `True` if the wallet is ready."""
         if not self.manager.wallet_exists(self.address):
             _log.info('Wallet {} doesn\'t exist.'.format(self.address))
             if self.keys[0] or self.keys[1]:
                 self.status = WALLET_CREATING
-                self.manager.create_wallet(self.address, *self.keys, wait_for_sync=self.sync_new)
+                viewkey, spendkey = self.keys[:2]
+                restore_height = self.keys[2] if len(self.keys) > 2 else None
+                try:
+                    self.manager.create_wallet(self.address, viewkey, spendkey,
+                            wait_for_sync=self.sync_new, restore_height=restore_height,
+                            daemon_address=self.daemon_address())
+                except Exception as e:
+                    _log.error('Cannot create wallet {}: {}'.format(self.address, e))
+                    self.error = e
+                    self.status = WALLET_FAILED
+                    return False
                 self.status = WALLET_STARTING
             else:
                 _log.error('No keys for wallet {}. Cannot generate.'.format(self.address))
                 self.status = WALLET_FAILED
-                return
-        self._wallet_rpc = self.manager.open_wallet(self.address, self.port)
-        try:
-            retries = 0
-            while True:
-                if not self.is_alive():
-                    out, err = self._wallet_rpc.communicate()
-                    raise RuntimeError('Wallet {} has stopped with exit code {}\n' \
-                            'stdout:\n{}\nstderr:\n{}\n'.format(
-                            self.address, self._wallet_rpc.returncode, out.decode(), err.decode()))
-                try:
-                    wallet = monero.wallet.Wallet(
-                        monero.backends.jsonrpc.JSONRPCWallet(port=self.port))
-                    break
-                except requests.exceptions.ConnectionError:
-                    if retries >= 10:
-                        self.status = WALLET_FAILED
-                        raise CommunicationError('Could not connect to wallet RPC in 10 retries.')
-                    retries += 1
-                time.sleep(20)
-            waddr = wallet.address()
-            if waddr != self.address:
+                return False
+        if self.manager.staging is not None:
+            try:
+                with self.span('stage'):
+                    self.manager.staging.stage(self.manager.directory, self.address)
+            except Exception as e:
+                _log.error('Cannot stage wallet {}: {}'.format(self.address, e))
+                self.manager.staging.discard(self.address)
                 self.status = WALLET_FAILED
-                raise CommunicationError('Wallet address {} is not the same as address passed in constructor: {}'\
-                        .format(waddr, self.address))
-            self.wallet = wallet
-            self.status = WALLET_SYNCING
+                return False
+        if self.worker is not None:
+            self.init_worker()
+            return True
+        self._spawn_time = time.time()
+        self._wallet_rpc = self.manager.open_wallet(self.address, self.port,
+                daemon_address=self.daemon_address())
+        try:
+            backend = self.backend = monero.backends.jsonrpc.JSONRPCWallet(port=self.port)
+            with self.span('rpc_ready'):
+                ready = wait_rpc_ready(backend, lambda: not self.shut_down and self.is_alive(),
+                        backoff(self.init_delay, self.init_max_delay, timeout=self.init_timeout))
+            if ready is None and self.shut_down:
+                self.close()
+                return False
+            if ready is None:
+                self._wallet_rpc.wait()
+                raise RuntimeError('Wallet {} has stopped with exit code {}\n' \
+                        'output:\n{}\n'.format(self.address, self._wallet_rpc.returncode,
+                        self._wallet_rpc.output.wait().decode('utf-8', 'replace')))
+            if not ready:
+                # closing publishes the failure once the RPC server has stopped
+                raise RPCTimeoutError('Could not connect to wallet RPC in {} sec.'.format(
+                    self.init_timeout))
+            self.check_wallet(monero.wallet.Wallet(backend))
         except Exception as e:
+            self.error = e
             self.close(final_status=WALLET_FAILED)
             raise
+        return True
+
+    def init_worker(self):
+        self._spawn_time = time.time()
+        self.backend = self.worker.backend
+        try:
+            with self.span('open', port=self.worker.port):
+                self.worker.open_wallet(self.address)
+            if self.node is not None:
+                self.worker.set_daemon(self.node.address)
+            self.check_wallet(monero.wallet.Wallet(self.worker.backend))
+        except Exception as e:
+            self.error = e
+            self.close(final_status=WALLET_FAILED)
+            raise
+
+    def check_wallet(self, wallet):
+        with self.span('address_check'):
+            waddr = wallet.address()
+        if waddr != self.address:
+            raise AddressMismatchError('Wallet address {} is not the same as address passed in constructor: {}'\
+                    .format(waddr, self.address))
+        self.ready_time = datetime.timedelta(seconds=time.time() - self._spawn_time)
+        self.wallet = wallet
+        self.status = WALLET_SYNCING
 
     def close(self, final_status=WALLET_CLOSED):
+        self._close_started = time.monotonic_ns()
         self.status = WALLET_CLOSING
-        if not self.is_alive():
-            self._wallet_rpc.terminate()
-        tmout = 0
-        while not self._wallet_rpc.poll():
-            time.sleep(1)
-            tmout += 1
-            if tmout >= 10:
-                self._wallet_rpc.kill()
-                break
+        if self.worker is not None:
+            if self.reuse_worker:
+                self.close_worker(final_status)
+            else:
+                # stopping stores the wallet
+                self.worker.stop(timeout=self.close_timeout())
+                self.closed(final_status)
+            return
+        if self.is_alive():
+            try:
+                # stores the wallet before exiting
+                monero.backends.jsonrpc.JSONRPCWallet(
+                    port=self.port, timeout=max(self.close_timeout(), 0.1)).raw_request('stop_wallet')
+            except Exception as e:
+                _log.debug('Wallet {} failed to stop: {}'.format(self.address, e))
+                self._wallet_rpc.terminate()
+        try:
+            self._wallet_rpc.wait(timeout=self.close_timeout())
+        except subprocess.TimeoutExpired:
+            _log.warning('Wallet {} has not stopped in time, killing.'.format(self.address))
+            self._wallet_rpc.kill()
+            self._wallet_rpc.wait()
+        self.closed(final_status)
+
+    def closed(self, final_status):
+        """Writes back the staged wallet files, if any, and sets the final status."""
+        staging = self.manager.staging
+        if staging is not None and staging.is_staged(self.address):
+            try:
+                # while draining, getting the data stored beats the I/O budget
+                with self.span('write_back'):
+                    staging.write_back(self.manager.directory, self.address,
+                            throttle=self.close_deadline is None)
+            except Exception as e:
+                _log.error('Cannot write back wallet {}, keeping it staged: {}'.format(
+                        self.address, e))
+        if self.tracer is not None and self._close_started is not None:
+            self.tracer.record('close', self._close_started, time.monotonic_ns(), self.address,
+                    {'status': final_status})
         self.status = final_status
         self.running_time = datetime.datetime.now() - self.start_time
 
+    def close_timeout(self):
+        """Returns the number of seconds left for closing."""
+        if self.close_deadline is None:
+            return self.stop_timeout
+        return max(self.close_deadline - time.time(), 0)
+
+    def close_worker(self, final_status):
+        if self.worker.address is not None:
+            try:
+                self.worker.close_wallet()
+            except Exception as e:
+                # the worker is in unknown state, don't let it serve other wallets
+                _log.error('Worker on port {} failed to close wallet {}: {}'.format(
+                    self.worker.port, self.address, e))
+                self.worker.stop()
+        self.closed(final_status)
+
+
+class SyncRequest(object):
+    """A request for immediate sync of a wallet, as returned by `WalletPool.request_sync()`.
+    Once resolved, `status` is `WALLET_SYNCED` (with `height` of the wallet), `WALLET_FAILED`,
+    `WALLET_CLOSED` if the pool has been stopped, `EXPIRED` if the deadline has passed,
+    `FOREIGN` if the wallet is owned by another instance of a sharded pool, or `QUARANTINED`
+    if the wallet has been quarantined by the supervisor after repeated failures."""
+    EXPIRED = 'expired'
+    FOREIGN = 'foreign'
+    QUARANTINED = 'quarantined'
+    status = None
+    height = None
+
+    def __init__(self, address, priority=1, deadline=None):
+        self.address = address
+        self.priority = priority
+        self.deadline = deadline
+        self._resolved = threading.Event()
+
+    def resolve(self, status, height=None):
+        self.status = status
+        self.height = height
+        self._resolved.set()
+
+    @property
+    def resolved(self):
+        return self._resolved.is_set()
+
+    def wait(self, timeout=None):
+        """Blocks until the request is resolved. Returns `True` if it is."""
+        return self._resolved.wait(timeout)
+
 
 class WalletPool(DaemonClient):
     """Runs a pool of wallets in given directory. This class should not be run directly
     but subclassed and equipped in some of the event handling methods:
     `main_loop_cycle`, `next_addr`, `wallet_started`, `wallet_synced`, `wallet_closed`
+
+    With `use_workers` set, the pool keeps `max_running` long-lived `RPCWorker` processes
+    and switches wallets within them, instead of spawning a process for each wallet.
+    With `spare_workers`, that many idle workers are kept started in advance, so a wallet can be
+    opened in one at once instead of waiting for a process to start. Without `use_workers` each
+    spare serves one wallet and gets replaced; with it, spares stand in for dead workers and
+    fill slots added by raising `max_running`.
+
+    RPC ports are taken from `rpc_port_range` by a `PortAllocator`, skipping those in use.
+
+    If `scheduler` is given, the default `next_addr` takes addresses from it, most stale first.
+    Addresses are added to the scheduler with `schedule()`.
+
+    If `checkpoints` is given (see `monerowalletpool.checkpoints.CheckpointStore`), the pool
+    records wallet heights and timings there and restores them when scheduling addresses.
+
+    If `metrics` is given (see `monerowalletpool.metrics.PoolMetrics`), the pool and its
+    controllers report their timings and states there.
+
+    If `concurrency` is given (see `monerowalletpool.concurrency.AdaptiveConcurrency`),
+    it tunes `max_running` at runtime instead of keeping it static.
+
+    If `daemons` is given (see `monerowalletpool.daemons.DaemonBalancer`), each wallet syncs
+    from the least loaded healthy daemon, and is switched to another one if its daemon
+    falls out of rotation.
+
+    If `transfers` is given (see `monerowalletpool.transfers.TransferStream`), new transfers
+    of each synced wallet are delivered to its sinks.
+
+    If `snapshots` is given (see `monerowalletpool.snapshots.SnapshotCache`), the balance and
+    recent transfers of each synced wallet are kept there, to be queried without opening it.
+
+    If `shards` is given (see `monerowalletpool.shards.ShardCoordinator`), the pool syncs only
+    its share of the wallets, coordinating with other instances sharing the directory.
+
+    If `supervisor` is given (see `monerowalletpool.supervisor.FailureSupervisor`), failed
+    wallets are retried with exponential backoff and quarantined after repeated failures,
+    and RPC processes left over by a crashed pool are reaped on start.
+
+    If `tracer` is given (see `monerowalletpool.tracing.Tracer`), the lifecycle phases of all
+    wallets and the calls of the event handlers are traced there, and the profiler of the tracer,
+    if any, runs during the handler calls.
+
+    Syncs may be requested at any time with `request_sync()`, which starts the wallet as soon as
+    possible, preempting a running wallet of lower priority if there's no free slot.
+
+    `stop()` drains the pool, closing all wallets concurrently within `drain_timeout` seconds.
     """
     manager = None
     running = None
     rpc_port_range = (18090, 18200)     # like in range()
     max_running = 2
     main_loop_sleep_time = 5
+    drain_timeout = 30
+    draining = False
+    stopping = False
     bc_height = 0
+    use_workers = False
+    spare_workers = 0
+    scheduler = None
+    checkpoints = None
+    tip = None
+    metrics = None
+    concurrency = None
+    daemons = None
+    transfers = None
+    snapshots = None
+    shards = None
+    supervisor = None
+    tracer = None
 
-    def __init__(self, manager, max_running=None, **kwargs):
+    def __init__(self, manager, max_running=None, use_workers=None, scheduler=None,
+            checkpoints=None, metrics=None, concurrency=None, daemons=None, transfers=None,
+            snapshots=None, shards=None, spare_workers=None, supervisor=None, tracer=None,
+            **kwargs):
         self.manager = manager or self.manager
         if self.manager is None:
             raise ValueError('Cannot run pool with no WalletManager.')
-        self._rpc_port_gen = itertools.cycle(range(*self.rpc_port_range))
-        self.max_running = min(
-            max_running or self.max_running,
-            self.rpc_port_range[1] - self.rpc_port_range[0])
+        self.ports = PortAllocator(*self.rpc_port_range)
+        self.spare_workers = spare_workers if spare_workers is not None else self.spare_workers
+        self.max_running = self.slots_limit(max_running or self.max_running)
+        self.use_workers = use_workers if use_workers is not None else self.use_workers
+        self.scheduler = scheduler if scheduler is not None else self.scheduler
+        self.checkpoints = checkpoints if checkpoints is not None else self.checkpoints
+        self.metrics = metrics if metrics is not None else self.metrics
+        if self.metrics is not None:
+            self.metrics.bind(self)
+        self.concurrency = concurrency if concurrency is not None else self.concurrency
+        if self.concurrency is not None:
+            self.max_running = self.slots_limit(self.concurrency.limit)
+        self.daemons = daemons if daemons is not None else self.daemons
+        self.transfers = transfers if transfers is not None else self.transfers
+        self.snapshots = snapshots if snapshots is not None else self.snapshots
+        self.shards = shards if shards is not None else self.shards
+        self.supervisor = supervisor if supervisor is not None else self.supervisor
+        self.tracer = tracer if tracer is not None else self.tracer
+        if self.tracer is not None and self.manager.tracer is None:
+            self.manager.tracer = self.tracer
         self.running = {}
+        self._events = queue.Queue()
+        self._requests = queue.Queue()
+        self.sync_requests = {}     # address: list of unresolved SyncRequests
+        self.workers = []
+        self._idle_workers = collections.deque()
+        self.spares = collections.deque()
         super(WalletPool, self).__init__(**kwargs)
 
     def shortaddr(self, address):
@@ -372,12 +1632,84 @@ class WalletPool(DaemonClient):
     def next_addr(self):
         """Method which gets another address to be monitored. Returns address or None if no more
         addresses available at the moment. It must not block."""
+        if self.scheduler is not None:
+            return self.scheduler.pop(owns=self.shards.owns if self.shards is not None else None)
         raise NotImplementedError('Subclass {cls} to implement next_addr()'.format(cls=type(self)))
 
+    def weight_for_address(self, addr):
+        """Method returning the scheduling weight of given address. Wallets of higher weight
+        get synced more often."""
+        return 1.0
+
+    def schedule(self, addr, weight=None):
+        """Adds the address to the scheduler."""
+        if weight is None:
+            weight = self.weight_for_address(addr)
+        checkpoint = self.checkpoints.get(addr) if self.checkpoints is not None else None
+        if checkpoint is not None:
+            self.scheduler.add(addr, weight=weight,
+                    height=checkpoint.height, synced_at=checkpoint.synced_at)
+        else:
+            self.scheduler.add(addr, weight=weight)
+
+    def slots_limit(self, limit):
+        """Caps the number of running wallets by the size of RPC port range, less the ports
+        of spare workers."""
+        return min(limit,
+                self.rpc_port_range[1] - self.rpc_port_range[0] - self.spare_workers)
+
+    def adjust_concurrency(self):
+        """Lets the concurrency controller update `max_running`. Slots above a lowered limit
+        are freed as their wallets finish."""
+        limit = self.concurrency.update(self)
+        if limit is None:
+            return
+        self.max_running = self.slots_limit(limit)
+        if self.use_workers:
+            while len(self.workers) > self.max_running and self._idle_workers:
+                worker = self._idle_workers.pop()
+                self.workers.remove(worker)
+                self.stop_worker(worker)
+            self.start_workers()
+
+    def rebalance(self):
+        """Moves syncing wallets off daemons which have fallen out of rotation."""
+        for ctrl in list(self.running.values()):
+            if ctrl.node is None or ctrl.node.healthy or ctrl.status != WALLET_SYNCING:
+                continue
+            node = self.daemons.acquire()
+            if not node.healthy:
+                self.daemons.release(node)
+                continue
+            self.daemons.release(ctrl.node)
+            ctrl.node = node
+            ctrl.switch_daemon(node)
+
+    def reshard(self):
+        """Heartbeats the shard. When instances join or leave, the scheduler reconsiders
+        the addresses it has set aside and running wallets now owned elsewhere get closed."""
+        if not self.shards.update():
+            return
+        if self.scheduler is not None:
+            self.scheduler.release_foreign()
+        for addr, ctrl in self.running.items():
+            if not ctrl.shut_down and not self.shards.owns(addr):
+                _log.info('{} has moved to {}.'.format(
+                    self.shortaddr(addr), self.shards.owner(addr)))
+                ctrl.shut_down = True
+
+    def update_height(self):
+        """Refreshes `bc_height` from the tip tracker and passes it on to the scheduler."""
+        self.bc_height = self.tip.height
+        if self.scheduler is not None:
+            self.scheduler.set_tip(self.bc_height)
+
     def keys_for_address(self, addr):
         """Method returning (secret_view, secret_spend) keys for given address.
         If both keys are None, the address will be skipped.
-        If only spend key is None, a view wallet will be created as the result."""
+        If only spend key is None, a view wallet will be created as the result.
+        A third element may be added: the restore height or a `datetime.date` of wallet creation,
+        to avoid scanning the chain from the beginning."""
         return (None, None)
 
     def wallet_started(self, ctrl):
@@ -392,44 +1724,391 @@ class WalletPool(DaemonClient):
     def wallet_failed(self, ctrl):
         _log.debug('Wallet {} failed.'.format(ctrl.address))
 
+    def start_worker(self):
+        """Starts an `RPCWorker` process on a free port."""
+        worker = RPCWorker(self.manager, self.ports.acquire())
+        _log.debug('Started worker on port {}.'.format(worker.port))
+        return worker
+
+    def stop_worker(self, worker, timeout=None):
+        worker.stop(timeout)
+        self.ports.release(worker.port)
+
+    def start_spares(self):
+        """Starts workers until there are `spare_workers` idle ones in reserve."""
+        while len(self.spares) < self.spare_workers and not self.draining:
+            try:
+                self.spares.append(self.start_worker())
+            except CommunicationError as e:
+                _log.warning('Cannot start a spare worker: {}'.format(e))
+                break
+
+    def take_spare(self):
+        """Returns a live spare worker or `None` if there's none."""
+        while self.spares:
+            worker = self.spares.popleft()
+            if worker.is_alive():
+                return worker
+            _log.warning('Spare worker on port {} has died.'.format(worker.port))
+            self.stop_worker(worker)
+        return None
+
+    def start_workers(self):
+        """Starts `RPCWorker` processes until there's one for each running slot, taking
+        spares first."""
+        while len(self.workers) < self.max_running:
+            try:
+                worker = self.take_spare() or self.start_worker()
+            except CommunicationError as e:
+                _log.error('Cannot start a worker: {}'.format(e))
+                break
+            self.workers.append(worker)
+            self._idle_workers.append(worker)
+
+    def release_worker(self, worker):
+        """Returns the worker of a finished controller to the idle queue. Dead workers get
+        replaced with fresh processes, surplus ones over lowered `max_running` get stopped."""
+        if not worker.is_alive():
+            _log.warning('Worker on port {} has died, restarting.'.format(worker.port))
+            self.workers.remove(worker)
+            self.stop_worker(worker)
+            self.start_workers()
+        elif len(self.workers) > self.max_running:
+            self.workers.remove(worker)
+            self.stop_worker(worker)
+        else:
+            self._idle_workers.append(worker)
+
+    def remove_controller(self, ctrl):
+        """Cleans up after a controller which has reached terminal state."""
+        ctrl.join()
+        del self.running[ctrl.address]
+        if ctrl.worker is not None and self.use_workers:
+            self.release_worker(ctrl.worker)
+        else:
+            # a spare worker has been stopped with the wallet
+            self.ports.release(ctrl.port)
+        if ctrl.node is not None:
+            self.daemons.release(ctrl.node)
+        retry = True
+        if self.supervisor is not None:
+            if ctrl.status == WALLET_FAILED:
+                self.supervisor.failed(ctrl.address, ctrl.error)
+                # the scheduler gets it back once the backoff is over
+                retry = False
+            elif ctrl.sync_time is not None:
+                self.supervisor.succeeded(ctrl.address)
+        if self.scheduler is not None and retry:
+            if ctrl.sync_time is not None:
+                self.scheduler.done(ctrl.address, height=ctrl.height)
+            else:
+                # preempted or failed before reaching the tip
+                self.scheduler.requeue(ctrl.address, height=ctrl.height)
+        if self.shards is not None:
+            self.shards.release(ctrl.address)
+        if self.metrics is not None:
+            self.metrics.controller_finished(ctrl)
+        if self.concurrency is not None:
+            self.concurrency.finished(ctrl)
+        if self.checkpoints is not None:
+            if ctrl.status == WALLET_FAILED:
+                self.checkpoints.failed(ctrl.address)
+            elif ctrl.sync_time is not None:
+                self.checkpoints.synced(
+                        ctrl.address, ctrl.height, ctrl.sync_time.total_seconds())
+            elif ctrl.height is not None:
+                self.checkpoints.progress(ctrl.address, ctrl.height)
+
+    def start_tip(self):
+        """Starts the `TipTracker` shared by all controllers."""
+        self.tip = TipTracker(metrics=self.metrics, balancer=self.daemons,
+                **self.daemon_connection_params())
+        self.tip.poll()
+        self.tip.subscribe(self.wakeup)
+        self.tip.start()
+
+    def free_slots(self):
+        free = self.max_running - len(self.running)
+        if self.use_workers:
+            free = min(free, len(self._idle_workers))
+        return max(free, 0) if not self.draining else 0
+
+    def start_controller(self, address, priority=0):
+        """Starts a `WalletController` for the address in a free slot. Returns it or `None`
+        if there's no free port."""
+        if self.use_workers:
+            worker = self._idle_workers.popleft()
+        else:
+            worker = self.take_spare()
+        try:
+            port = worker.port if worker is not None else self.ports.acquire()
+        except CommunicationError as e:
+            _log.error('Cannot start wallet {}: {}'.format(self.shortaddr(address), e))
+            return None
+        ctrl = WalletController(
+                address,
+                port,
+                self.manager,
+                keys=self.keys_for_address(address),
+                worker=worker,
+                events=self._events,
+                tip=self.tip,
+                metrics=self.metrics,
+                node=self.daemons.acquire() if self.daemons is not None else None,
+                transfers=self.transfers,
+                snapshots=self.snapshots,
+                tracer=self.tracer,
+                priority=priority,
+                reuse_worker=self.use_workers,
+                **self.daemon_connection_params())
+        self.running[address] = ctrl
+        if self.checkpoints is not None:
+            self.checkpoints.opened(address)
+        if self.metrics is not None:
+            self.metrics.controller_started(ctrl)
+        ctrl.start()
+        self.call_handler(self.wallet_started, ctrl)
+        return ctrl
+
+    def start_wallets(self):
+        """Starts the requested syncs, then fills the free slots with wallets returned by
+        `next_addr`."""
+        self.handle_requests()
+        if self.supervisor is not None:
+            for address in self.supervisor.due():
+                if self.scheduler is not None:
+                    self.scheduler.requeue(address)
+        held = set()
+        while self.free_slots():
+            newaddr = self.next_addr()
+            if newaddr is None or newaddr in self.running or newaddr in held:
+                # don't start duplicates
+                break
+            if self.supervisor is not None and not self.supervisor.admits(newaddr):
+                held.add(newaddr)
+                continue
+            if self.shards is not None and not self.shards.acquire(newaddr):
+                # still leased by another instance; retry on the next cycle
+                if self.scheduler is not None:
+                    self.scheduler.requeue(newaddr)
+                break
+            if self.start_controller(newaddr) is None:
+                if self.shards is not None:
+                    self.shards.release(newaddr)
+                if self.scheduler is not None:
+                    self.scheduler.requeue(newaddr)
+                break
+
+    def request_sync(self, address, priority=1, deadline=None):
+        """Requests an immediate sync of the address, to be done within `deadline` seconds.
+        If there's no free slot, the running wallet of the lowest priority below `priority` gets
+        closed to make room. A request for a running wallet attaches to it.
+        May be called from any thread. Returns a `SyncRequest` to wait for."""
+        request = SyncRequest(address, priority,
+                time.time() + deadline if deadline is not None else None)
+        self._requests.put(request)
+        self.wakeup()
+        return request
+
+    def resolve_requests(self, address, status, height=None):
+        for request in self.sync_requests.pop(address, []):
+            request.resolve(status, height)
+
+    def _priority(self, address):
+        return max(r.priority for r in self.sync_requests[address])
+
+    def handle_requests(self):
+        """Takes in new sync requests, expires the overdue ones and starts the requested
+        wallets, preempting running wallets of lower priority if needed."""
+        while True:
+            try:
+                request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if self.draining:
+                request.resolve(WALLET_CLOSED)
+                continue
+            self.sync_requests.setdefault(request.address, []).append(request)
+            ctrl = self.running.get(request.address)
+            if ctrl is not None:
+                ctrl.priority = max(ctrl.priority, request.priority)
+                if ctrl.status == WALLET_SYNCED:
+                    self.resolve_requests(ctrl.address, WALLET_SYNCED, ctrl.height)
+        now = time.time()
+        for address, pending in list(self.sync_requests.items()):
+            for request in [r for r in pending if r.deadline is not None and r.deadline < now]:
+                _log.warning('Sync request of {} has expired.'.format(self.shortaddr(address)))
+                request.resolve(SyncRequest.EXPIRED)
+                pending.remove(request)
+            if not pending:
+                del self.sync_requests[address]
+        waiting = sorted((a for a in self.sync_requests if a not in self.running),
+                key=self._priority, reverse=True)
+        free = self.free_slots()
+        # wallets already shutting down will free their slots soon, unless they are being
+        # created, which doesn't stop on shutdown and may take hours with `wait_for_sync`
+        closing = sum(1 for ctrl in self.running.values()
+                if ctrl.shut_down and ctrl.status != WALLET_CREATING)
+        for address in waiting:
+            if self.shards is not None and not self.shards.owns(address):
+                self.resolve_requests(address, SyncRequest.FOREIGN)
+                continue
+            if self.supervisor is not None and self.supervisor.is_quarantined(address):
+                self.resolve_requests(address, SyncRequest.QUARANTINED)
+                continue
+            if free:
+                if self.shards is not None and not self.shards.acquire(address):
+                    continue
+                if self.start_controller(address, priority=self._priority(address)) is None:
+                    if self.shards is not None:
+                        self.shards.release(address)
+                    break
+                if self.scheduler is not None:
+                    self.scheduler.checkout(address)
+                free -= 1
+            elif closing:
+                closing -= 1
+            else:
+                victims = [c for c in self.running.values()
+                        if not c.shut_down and c.status != WALLET_CREATING]
+                victim = min(victims, key=lambda c: c.priority) if victims else None
+                if victim is None or victim.priority >= self._priority(address):
+                    break
+                _log.info('Preempting {} for {}.'.format(
+                    self.shortaddr(victim.address), self.shortaddr(address)))
+                victim.shut_down = True
+
+    def wait_events(self, timeout=None):
+        """Blocks until some controller changes status, but no longer than `timeout`
+        (`main_loop_sleep_time` by default). Returns a list of `(controller, status)` events."""
+        try:
+            events = [self._events.get(
+                timeout=timeout if timeout is not None else self.main_loop_sleep_time)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def wakeup(self, *args):
+        """Interrupts waiting for events, e.g. when the tip moves and parked wallets may
+        become eligible."""
+        self._events.put((None, None))
+
+    def handle_event(self, ctrl, status):
+        """Calls the handler for controller's status change."""
+        if ctrl is None or self.running.get(ctrl.address) is not ctrl:
+            return
+        _log.debug('{}: {}'.format(self.shortaddr(ctrl.address), status))
+        if status == WALLET_SYNCED:
+            # the wallet may have started closing in the meantime
+            if ctrl.status == WALLET_SYNCED:
+                self.resolve_requests(ctrl.address, WALLET_SYNCED, ctrl.height)
+                self.call_handler(self.wallet_synced, ctrl)
+        elif status == WALLET_CLOSED:
+            # unresolved requests stay pending and the wallet gets started again
+            self.call_handler(self.wallet_closed, ctrl)
+            self.remove_controller(ctrl)
+        elif status == WALLET_FAILED:
+            self.resolve_requests(ctrl.address, WALLET_FAILED)
+            self.call_handler(self.wallet_failed, ctrl)
+            self.remove_controller(ctrl)
+
+    def call_handler(self, handler, ctrl):
+        """Calls the event handler for the controller. With a `tracer`, the call is traced and
+        profiled, if the tracer has a profiler."""
+        if self.tracer is None:
+            return handler(ctrl)
+        with self.tracer.span('handler', ctrl.address, profile=True, handler=handler.__name__):
+            return handler(ctrl)
+
     def main_loop(self):
+        """Runs the pool until `stop()` is called, then drains it and exits."""
         signal.signal(signal.SIGINT, self.stop)
-        while True:
+        if self.supervisor is not None:
+            self.supervisor.start(self.rpc_port_range, self.manager.cmd_rpc)
+        self.start_tip()
+        if self.use_workers:
+            self.start_workers()
+        while not self.stopping:
+            self.update_height()
             self.main_loop_cycle()
-            while len(self.running) < self.max_running:
-                newaddr = self.next_addr()
-                if newaddr is None or newaddr in self.running:
-                    # don't start duplicates
-                    break
-                ctrl = WalletController(
-                        newaddr,
-                        next(self._rpc_port_gen),
-                        self.manager,
-                        keys=self.keys_for_address(newaddr),
-                        **self.daemon_connection_params())
-                self.running[newaddr] = ctrl
-                ctrl.start()
-                self.wallet_started(ctrl)
-            for addr, ctrl in list(self.running.items()):
-                _log.debug('{}: {}'.format(self.shortaddr(addr), ctrl.status))
-                if ctrl.status == WALLET_SYNCED:
-                    self.wallet_synced(ctrl)
-                elif ctrl.status == WALLET_CLOSED:
-                    self.wallet_closed(ctrl)
-                    ctrl.join()
-                    del self.running[addr]
-                elif ctrl.status == WALLET_FAILED:
-                    self.wallet_failed(ctrl)
-                    ctrl.join()
-                    del self.running[addr]
-            time.sleep(self.main_loop_sleep_time)
+            if self.concurrency is not None:
+                self.adjust_concurrency()
+            if self.daemons is not None:
+                self.rebalance()
+            if self.shards is not None:
+                self.reshard()
+            if self.transfers is not None:
+                self.transfers.flush(force=False)
+            if self.tracer is not None:
+                self.tracer.flush(force=False)
+            self.start_wallets()
+            self.start_spares()
+            for ctrl, status in self.wait_events():
+                self.handle_event(ctrl, status)
+        _log.info('Stopping the pool.')
+        self.drain()
+        sys.exit(0)
 
-    def stop(self, *args):
-        _log.info('SIGINT received, cleaning up.')
+    def drain(self, timeout=None):
+        """Stops admitting wallets and closes the running ones concurrently, syncing or not.
+        Wallets store their progress on closing; processes still running at the deadline,
+        `timeout` (`drain_timeout` by default) seconds from now, get killed, as do the CLI
+        processes of wallets still being created. Must be called from the thread running
+        `main_loop`, e.g. from a hook, but not from a signal handler; see `stop()`.
+        Returns `True` if all wallets have closed gracefully."""
+        deadline = time.time() + (timeout if timeout is not None else self.drain_timeout)
+        self.draining = True
+        _log.info('Draining {} wallet(s).'.format(len(self.running)))
+        if self.tip is not None:
+            # wakes up the controllers waiting for the tip
+            self.tip.stop_tracking()
         for addr, ctrl in self.running.items():
             _log.info('{}: {}'.format(self.shortaddr(addr), ctrl.status))
+            ctrl.close_deadline = deadline
             ctrl.shut_down = True
-        for _, ctrl in self.running.items():
-            _log.info('Waiting for {} to stop'.format(ctrl.address))
-            ctrl.join()
-        sys.exit(0)
+        while self.running and time.time() < deadline:
+            for ctrl, status in self.wait_events(timeout=max(deadline - time.time(), 0)):
+                self.handle_event(ctrl, status)
+        # the controllers are daemon threads, their CLI processes would outlive the pool
+        for addr in list(self.running):
+            self.manager.kill_creation(addr)
+        # killing at the deadline takes a moment
+        while self.running and time.time() < deadline + 1:
+            for ctrl, status in self.wait_events(timeout=max(deadline + 1 - time.time(), 0)):
+                self.handle_event(ctrl, status)
+        for addr, ctrl in self.running.items():
+            _log.error('{}: still {} after the deadline'.format(self.shortaddr(addr), ctrl.status))
+        self.handle_requests()
+        for address in list(self.sync_requests):
+            self.resolve_requests(address, WALLET_CLOSED)
+        drained = not self.running
+        workers = self.workers + list(self.spares)
+        if workers:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(workers)) as executor:
+                for worker in workers:
+                    _log.info('Stopping worker on port {}'.format(worker.port))
+                    executor.submit(self.stop_worker, worker, max(deadline - time.time(), 1))
+            self.spares.clear()
+        if self.transfers is not None:
+            self.transfers.close()
+        if self.snapshots is not None:
+            self.snapshots.close()
+        if self.checkpoints is not None:
+            self.checkpoints.close()
+        if self.daemons is not None:
+            self.daemons.close()
+        if self.shards is not None:
+            self.shards.close()
+        if self.tracer is not None:
+            self.tracer.close()
+        return drained
+
+    def stop(self, *args):
+        """Makes `main_loop` drain the pool and exit. Only sets a flag, so it's safe to call
+        from a signal handler or from other threads; draining the pool from a signal handler
+        might deadlock on the locks the interrupted code holds."""
+        self.stopping = True
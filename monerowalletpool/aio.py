@@ -0,0 +1,413 @@
+import asyncio
+import datetime
+import json
+import logging
+import time
+
+from . import (AddressMismatchError, CommunicationError, DaemonClient, PortAllocator,
+        RPCTimeoutError, SyncPacing, backoff, owner_env, WALLET_STARTING, WALLET_CREATING, WALLET_SYNCING,
+        WALLET_SYNCED, WALLET_CLOSING, WALLET_CLOSED, WALLET_FAILED)
+
+_log = logging.getLogger(__name__)
+
+
+class RPCError(CommunicationError):
+    pass
+
+
+class AsyncJSONRPC(object):
+    """Minimal JSON-RPC client over asyncio streams, one connection per request.
+    Raises `OSError` when the server cannot be connected and `RPCError` on RPC errors."""
+    timeout = 30
+
+    def __init__(self, host='127.0.0.1', port=18088, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout or self.timeout
+
+    async def post(self, path, data):
+        body = json.dumps(data).encode('utf-8')
+        reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            writer.write(
+                'POST {} HTTP/1.1\r\nHost: {}:{}\r\nContent-Type: application/json\r\n'
+                'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                    path, self.host, self.port, len(body)).encode('ascii') + body)
+            await writer.drain()
+            rsp = await asyncio.wait_for(reader.read(), self.timeout)
+        finally:
+            writer.close()
+        head, _, payload = rsp.partition(b'\r\n\r\n')
+        status = head.split(b'\r\n', 1)[0].split(b' ')
+        if len(status) < 2 or status[1] != b'200':
+            raise RPCError('Invalid HTTP status for {}: {}'.format(path, head[:64]))
+        if b'transfer-encoding: chunked' in head.lower():
+            payload = self._unchunk(payload)
+        return json.loads(payload.decode('utf-8'))
+
+    @staticmethod
+    def _unchunk(payload):
+        body = b''
+        while payload:
+            size, _, payload = payload.partition(b'\r\n')
+            size = int(size.split(b';')[0], 16)
+            if not size:
+                break
+            body += payload[:size]
+            payload = payload[size + 2:]
+        return body
+
+    async def request(self, method, params=None):
+        result = await self.post('/json_rpc',
+                {'jsonrpc': '2.0', 'id': 0, 'method': method, 'params': params or {}})
+        if 'error' in result:
+            raise RPCError('Method {} failed: {}'.format(method, result['error']))
+        return result['result']
+
+
+async def wait_rpc_ready(rpc, is_alive, delays, stopped=None):
+    """Async counterpart of `monerowalletpool.wait_rpc_ready()`. If `stopped` event is given,
+    setting it cuts the current delay short."""
+    for delay in [0] + list(delays):
+        if stopped is None:
+            await asyncio.sleep(delay)
+        else:
+            try:
+                await asyncio.wait_for(stopped.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        if not is_alive():
+            return None
+        try:
+            await rpc.request('get_version')
+            return True
+        except OSError:
+            pass
+    return False
+
+
+class AsyncWalletController(SyncPacing):
+    """Controls a running wallet as an asyncio task, talking to `monero-wallet-rpc` spawned with
+    `asyncio.create_subprocess_exec`. Exposes the same fields as `WalletController`,
+    with `rpc` being an `AsyncJSONRPC` client of the wallet instead of `wallet`.
+    Setting `shut_down` to `True` makes the wallet close."""
+    _status = WALLET_STARTING
+    sync_new = True
+    init_delay = 0.05
+    init_max_delay = 5
+    init_timeout = 200
+    close_timeout = 10
+    start_time = None
+    running_time = None
+    sync_time = None
+    ready_time = None
+    keys = (None, None)
+    error = None
+
+    def __init__(self, address, port, manager, pool, keys=None, sync_new=None):
+        self.address = address
+        self.port = port
+        self.manager = manager
+        self.pool = pool
+        self.keys = keys or self.keys
+        self.sync_new = sync_new if sync_new is not None else self.sync_new
+        self.rpc = AsyncJSONRPC(port=port)
+        self._process = None
+        self._shut_down = asyncio.Event()
+        self.start_time = datetime.datetime.now()
+
+    @property
+    def status(self):
+        return self._status
+
+    @status.setter
+    def status(self, status):
+        self._status = status
+        self.pool.events.put_nowait((self, status))
+
+    @property
+    def shut_down(self):
+        return self._shut_down.is_set()
+
+    @shut_down.setter
+    def shut_down(self, value):
+        if value:
+            self._shut_down.set()
+        else:
+            self._shut_down.clear()
+
+    def is_alive(self):
+        return self._process is not None and self._process.returncode is None
+
+    async def run(self):
+        _log.debug('run(): {}'.format(self.address))
+        try:
+            if not await self.init():
+                return
+            while True:
+                self.height = (await self.rpc.request('getheight'))['height']
+                daemon_height = self.pool.bc_height or None
+                if daemon_height is not None and \
+                        daemon_height <= self.height + self.treat_as_synced_height_diff:
+                    break
+                if self.shut_down:
+                    # closing stores the progress made so far
+                    await self.close()
+                    return
+                if daemon_height is None:
+                    # the pool hasn't got the tip yet, nothing to compare with
+                    await self.wait_sync(0, timeout=self.sync_max_sleep)
+                    continue
+                await self.wait_sync(daemon_height)
+            self.sync_time = datetime.datetime.now() - self.start_time
+            self.status = WALLET_SYNCED
+            await self._shut_down.wait()
+            await self.close()
+        except asyncio.CancelledError:
+            await self.close(final_status=WALLET_FAILED)
+            raise
+        except Exception as e:
+            _log.exception('Wallet {} failed: {}'.format(self.address, e))
+            self.error = e
+            await self.close(final_status=WALLET_FAILED)
+
+    async def wait_sync(self, daemon_height, timeout=None):
+        """Waits for the tip to move or the next height check (or `timeout`), but no longer
+        than until the wallet is shut down."""
+        if timeout is None:
+            timeout = self.sync_delay(daemon_height)
+        waits = [asyncio.ensure_future(self.pool.wait_tip(daemon_height, timeout)),
+                asyncio.ensure_future(self._shut_down.wait())]
+        try:
+            await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for wait in waits:
+                wait.cancel()
+
+    async def init(self):
+        if not self.manager.wallet_exists(self.address):
+            _log.info('Wallet {} doesn\'t exist.'.format(self.address))
+            if not (self.keys[0] or self.keys[1]):
+                _log.error('No keys for wallet {}. Cannot generate.'.format(self.address))
+                self.status = WALLET_FAILED
+                return False
+            self.status = WALLET_CREATING
+            # wallet creation is a rare, interactive CLI session; keep it off the loop
+            await asyncio.get_running_loop().run_in_executor(None, lambda: self.manager.create_wallet(
+                    self.address, self.keys[0], self.keys[1], wait_for_sync=self.sync_new,
+                    restore_height=self.keys[2] if len(self.keys) > 2 else None))
+            self.status = WALLET_STARTING
+        if self.shut_down:
+            await self.close()
+            return False
+        staging = self.manager.staging
+        if staging is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                    None, staging.stage, self.manager.directory, self.address)
+        spawned = time.time()
+        self._process = await asyncio.create_subprocess_exec(
+                *self.manager.open_wallet_args(self.address, self.port), env=owner_env(),
+                stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL)
+        ready = await wait_rpc_ready(self.rpc, lambda: not self.shut_down and self.is_alive(),
+                backoff(self.init_delay, self.init_max_delay, timeout=self.init_timeout),
+                stopped=self._shut_down)
+        if ready is None and self.shut_down:
+            await self.close()
+            return False
+        if ready is None:
+            raise CommunicationError('Wallet {} has stopped with exit code {}'.format(
+                self.address, self._process.returncode))
+        if not ready:
+            raise RPCTimeoutError('Could not connect to wallet RPC in {} sec.'.format(
+                self.init_timeout))
+        waddr = (await self.rpc.request('getaddress'))['address']
+        if waddr != str(self.address):
+            raise AddressMismatchError('Wallet address {} is not the same as address passed in constructor: {}'\
+                    .format(waddr, self.address))
+        self.ready_time = datetime.timedelta(seconds=time.time() - spawned)
+        self.status = WALLET_SYNCING
+        return True
+
+    async def close(self, final_status=WALLET_CLOSED):
+        self.status = WALLET_CLOSING
+        if self.is_alive():
+            try:
+                await asyncio.wait_for(self.rpc.request('stop_wallet'), self.close_timeout)
+            except Exception as e:
+                _log.debug('Wallet {} failed to stop: {}'.format(self.address, e))
+                self._process.terminate()
+            try:
+                await asyncio.wait_for(self._process.wait(), self.close_timeout)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        staging = self.manager.staging
+        if staging is not None and staging.is_staged(self.address):
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                        None, staging.write_back, self.manager.directory, self.address)
+            except Exception as e:
+                _log.error('Cannot write back wallet {}, keeping it staged: {}'.format(
+                        self.address, e))
+        self.running_time = datetime.datetime.now() - self.start_time
+        self.status = final_status
+
+
+class AsyncWalletPool(DaemonClient):
+    """Runs a pool of wallets as asyncio tasks, with no thread per wallet. The event handling
+    methods are the same as of `WalletPool`, but coroutines:
+    `main_loop_cycle`, `next_addr`, `keys_for_address`, `wallet_started`, `wallet_synced`,
+    `wallet_closed`, `wallet_failed`
+    """
+    manager = None
+    running = None
+    rpc_port_range = (18090, 18200)     # like in range()
+    max_running = 2
+    main_loop_sleep_time = 5
+    tip_poll_interval = 10
+    bc_height = 0
+    scheduler = None
+    controller_class = AsyncWalletController
+
+    def __init__(self, manager, max_running=None, scheduler=None, **kwargs):
+        self.manager = manager or self.manager
+        if self.manager is None:
+            raise ValueError('Cannot run pool with no WalletManager.')
+        self.max_running = min(
+            max_running or self.max_running,
+            self.rpc_port_range[1] - self.rpc_port_range[0])
+        self.scheduler = scheduler if scheduler is not None else self.scheduler
+        self.running = {}
+        self.events = None
+        self.ports = PortAllocator(*self.rpc_port_range)
+        self._stopping = False
+        super(AsyncWalletPool, self).__init__(**kwargs)
+        self.daemon_rpc = AsyncJSONRPC(host=self.daemon_host, port=self.daemon_port)
+
+    def shortaddr(self, address):
+        return str(address)[:6]
+
+    async def main_loop_cycle(self):
+        _log.debug('Running {}/{} wallet(s).'.format(len(self.running), self.max_running))
+
+    async def next_addr(self):
+        if self.scheduler is not None:
+            return self.scheduler.pop()
+        raise NotImplementedError('Subclass {cls} to implement next_addr()'.format(cls=type(self)))
+
+    async def keys_for_address(self, addr):
+        return (None, None)
+
+    async def wallet_started(self, ctrl):
+        _log.debug('Wallet {} started.'.format(ctrl.address))
+
+    async def wallet_synced(self, ctrl):
+        _log.warning('Wallet {} synced but the handler does nothing.'.format(ctrl.address))
+
+    async def wallet_closed(self, ctrl):
+        _log.debug('Wallet {} closed.'.format(ctrl.address))
+
+    async def wallet_failed(self, ctrl):
+        _log.debug('Wallet {} failed.'.format(ctrl.address))
+
+    async def poll_tip(self):
+        try:
+            height = (await self.daemon_rpc.request('get_info'))['height']
+        except (OSError, CommunicationError, asyncio.TimeoutError) as e:
+            _log.error('Cannot get daemon height: {}'.format(e))
+            return
+        if height != self.bc_height:
+            self.bc_height = height
+            if self.scheduler is not None:
+                self.scheduler.set_tip(height)
+            async with self._tip_changed:
+                self._tip_changed.notify_all()
+            self.events.put_nowait((None, None))
+
+    async def _track_tip(self):
+        while True:
+            await asyncio.sleep(self.tip_poll_interval)
+            await self.poll_tip()
+
+    async def wait_tip(self, height, timeout):
+        """Waits until the tip moves from given height or the timeout passes."""
+        try:
+            async with self._tip_changed:
+                await asyncio.wait_for(
+                    self._tip_changed.wait_for(lambda: self.bc_height != height), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def start_wallets(self):
+        while len(self.running) < self.max_running and not self._stopping:
+            newaddr = await self.next_addr()
+            if newaddr is None or newaddr in self.running:
+                # don't start duplicates
+                break
+            try:
+                port = self.ports.acquire()
+            except CommunicationError as e:
+                _log.error('Cannot start wallet {}: {}'.format(self.shortaddr(newaddr), e))
+                if self.scheduler is not None:
+                    self.scheduler.requeue(newaddr)
+                break
+            ctrl = self.controller_class(newaddr, port, self.manager, self,
+                    keys=await self.keys_for_address(newaddr))
+            self.running[newaddr] = ctrl
+            ctrl.task = asyncio.ensure_future(ctrl.run())
+            await self.wallet_started(ctrl)
+
+    async def handle_event(self, ctrl, status):
+        if ctrl is None or self.running.get(ctrl.address) is not ctrl:
+            return
+        _log.debug('{}: {}'.format(self.shortaddr(ctrl.address), status))
+        if status == WALLET_SYNCED:
+            if ctrl.status == WALLET_SYNCED:
+                await self.wallet_synced(ctrl)
+        elif status in (WALLET_CLOSED, WALLET_FAILED):
+            if status == WALLET_CLOSED:
+                await self.wallet_closed(ctrl)
+            else:
+                await self.wallet_failed(ctrl)
+            await ctrl.task
+            del self.running[ctrl.address]
+            self.ports.release(ctrl.port)
+            if self.scheduler is not None:
+                if ctrl.sync_time is not None:
+                    self.scheduler.done(ctrl.address, height=ctrl.height)
+                else:
+                    self.scheduler.requeue(ctrl.address, height=ctrl.height)
+
+    async def main_loop(self):
+        """Runs the pool until `stop()` is called."""
+        self.events = asyncio.Queue()
+        self._tip_changed = asyncio.Condition()
+        await self.poll_tip()
+        tracker = asyncio.ensure_future(self._track_tip())
+        try:
+            while not self._stopping or self.running:
+                await self.main_loop_cycle()
+                await self.start_wallets()
+                try:
+                    events = [await asyncio.wait_for(self.events.get(), self.main_loop_sleep_time)]
+                except asyncio.TimeoutError:
+                    continue
+                while not self.events.empty():
+                    events.append(self.events.get_nowait())
+                for ctrl, status in events:
+                    await self.handle_event(ctrl, status)
+        finally:
+            tracker.cancel()
+
+    def stop(self):
+        """Stops admitting wallets and closes the running ones. `main_loop` returns once
+        all of them are closed."""
+        _log.info('Stopping the pool.')
+        self._stopping = True
+        for ctrl in self.running.values():
+            ctrl.shut_down = True
+        if self.events is not None:
+            self.events.put_nowait((None, None))
+
@@ -0,0 +1,109 @@
+import collections
+import logging
+import sqlite3
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+Checkpoint = collections.namedtuple(
+    'Checkpoint', ['address', 'height', 'sync_duration', 'failures', 'opened_at', 'synced_at'])
+
+
+class CheckpointStore(object):
+    """Persistent store of per-wallet sync checkpoints, kept in SQLite database in WAL mode.
+    All records are held in memory and changes are written in batches by a background thread,
+    so the updates never block the pool's main loop on disk I/O.
+    Times are stored as UNIX timestamps, durations in seconds.
+    """
+    flush_interval = 2
+
+    def __init__(self, path, flush_interval=None):
+        self.path = path
+        self.flush_interval = flush_interval or self.flush_interval
+        self._records = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closing = False
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS checkpoints ('
+            'address TEXT PRIMARY KEY, height INTEGER, sync_duration REAL, '
+            'failures INTEGER NOT NULL DEFAULT 0, opened_at REAL, synced_at REAL)')
+        self._db.commit()
+        for row in self._db.execute('SELECT * FROM checkpoints'):
+            self._records[row[0]] = Checkpoint(*row)
+        _log.debug('Loaded {} checkpoints from {}'.format(len(self._records), self.path))
+        self._writer = threading.Thread(name='checkpoints', target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, address):
+        return str(address) in self._records
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._records.values()))
+
+    def get(self, address):
+        """Returns the `Checkpoint` of given address or `None` if nothing is known about it."""
+        return self._records.get(str(address))
+
+    def _update(self, address, **fields):
+        address = str(address)
+        with self._lock:
+            record = self._records.get(address) or Checkpoint(address, None, None, 0, None, None)
+            self._records[address] = record._replace(**fields)
+            self._dirty.add(address)
+
+    def opened(self, address, when=None):
+        self._update(address, opened_at=when or time.time())
+
+    def synced(self, address, height, duration, when=None):
+        self._update(address, height=height, sync_duration=duration,
+                failures=0, synced_at=when or time.time())
+
+    def progress(self, address, height):
+        """Records the height of a wallet closed before getting synced."""
+        self._update(address, height=height)
+
+    def failed(self, address):
+        record = self.get(address)
+        self._update(address, failures=(record.failures if record else 0) + 1)
+
+    def flush(self):
+        """Writes all pending changes to the database."""
+        with self._lock:
+            rows = [self._records[addr] for addr in self._dirty]
+            self._dirty = set()
+        if not rows:
+            return
+        with self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO checkpoints '
+                '(address, height, sync_duration, failures, opened_at, synced_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+        _log.debug('Stored {} checkpoints.'.format(len(rows)))
+
+    def _write_loop(self):
+        while not self._closing:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                _log.error('Cannot store checkpoints: {}'.format(e))
+
+    def close(self):
+        """Stops the writer thread, flushes the pending changes and closes the database."""
+        self._closing = True
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        self._db.close()
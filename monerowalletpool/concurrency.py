@@ -0,0 +1,147 @@
+import logging
+import os
+import time
+
+_log = logging.getLogger(__name__)
+
+
+def load_per_cpu():
+    """Returns 1-minute load average divided by the number of CPUs, or None if unavailable."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory():
+    """Returns available memory in bytes as reported by `/proc/meminfo`, or None."""
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class AdaptiveConcurrency(object):
+    """Tunes `max_running` of a `WalletPool` at runtime with AIMD: every `interval` seconds
+    the limit grows by `increase` as long as it improves the throughput, and gets multiplied
+    by `decrease` when the host or the daemon is overloaded, or when the throughput of the last
+    window has dropped below `tolerance` of the previous one after growing. The limit stays
+    within `floor` and `ceiling`.
+
+    The throughput is the number of blocks scanned per second by all wallets, sampled from
+    the heights of the running wallets on every main loop cycle, so long syncs count in the
+    windows they progress in, and closed or failed wallets count as well. The host is
+    overloaded if the load average per CPU exceeds `max_load` or available memory is below
+    `min_memory` bytes; the daemon if its RPC latency exceeds `max_latency` seconds.
+    Any of these may be set to None to ignore the input.
+
+    Pass an instance as `concurrency` argument of `WalletPool`.
+    """
+    floor = 1
+    ceiling = 32
+    interval = 30
+    increase = 1
+    decrease = 0.75
+    tolerance = 0.9
+    max_load = 1.0
+    min_memory = 256 * 1024 * 1024
+    max_latency = 2.0
+
+    def __init__(self, floor=None, ceiling=None, interval=None, start=None, **kwargs):
+        self.floor = floor or self.floor
+        self.ceiling = ceiling or self.ceiling
+        if self.floor > self.ceiling:
+            raise ValueError('Floor {} is above ceiling {}.'.format(self.floor, self.ceiling))
+        self.interval = interval if interval is not None else self.interval
+        for name in ('increase', 'decrease', 'tolerance', 'max_load', 'min_memory', 'max_latency'):
+            if name in kwargs:
+                setattr(self, name, kwargs.pop(name))
+        if kwargs:
+            raise TypeError('Unexpected arguments: {}'.format(', '.join(kwargs)))
+        self.limit = self.clamp(start or self.floor)
+        self.throughput = None
+        self._last_throughput = None
+        self._grew = False
+        self._blocks = 0
+        self._window_start = None
+        self._heights = {}      # controller: wallet height at the last sample
+
+    def clamp(self, limit):
+        return max(self.floor, min(self.ceiling, int(limit)))
+
+    def scanned(self, blocks):
+        """Records blocks scanned by a wallet."""
+        self._blocks += blocks
+
+    def sample(self, ctrl):
+        """Records the blocks scanned by the controller's wallet since the last sample."""
+        height = getattr(ctrl, 'height', None)
+        if height is None:
+            return
+        last = self._heights.get(ctrl)
+        if last is not None and height > last:
+            self.scanned(height - last)
+        self._heights[ctrl] = height
+
+    def finished(self, ctrl):
+        """Records the last progress of a controller which has reached terminal state."""
+        self.sample(ctrl)
+        self._heights.pop(ctrl, None)
+
+    def overloaded(self, load=None, memory=None, latency=None):
+        """Returns the reason of overload or None."""
+        if self.max_load is not None and load is not None and load > self.max_load:
+            return 'load {:.2f}'.format(load)
+        if self.min_memory is not None and memory is not None and memory < self.min_memory:
+            return 'memory {} MiB'.format(memory // 1048576)
+        if self.max_latency is not None and latency is not None and latency > self.max_latency:
+            return 'daemon latency {:.2f}s'.format(latency)
+        return None
+
+    def adjust(self, throughput, saturated=True, load=None, memory=None, latency=None):
+        """Computes the new limit from the measurements of the last window. `saturated` tells
+        whether all slots were in use; if not, the limit is not the bottleneck and won't grow.
+        Returns the new limit."""
+        self.throughput = throughput
+        reason = self.overloaded(load, memory, latency)
+        if reason is None and self._grew and self._last_throughput is not None \
+                and throughput < self._last_throughput * self.tolerance:
+            reason = 'throughput dropped {:.1f} -> {:.1f} blocks/s'.format(
+                self._last_throughput, throughput)
+        limit = self.limit
+        self._grew = False
+        if reason is not None:
+            limit = self.clamp(min(limit * self.decrease, limit - 1))
+        elif saturated:
+            limit = self.clamp(limit + self.increase)
+            self._grew = limit > self.limit
+        if limit != self.limit:
+            _log.info('Concurrency {} -> {}{}'.format(
+                self.limit, limit, ' ({})'.format(reason) if reason else ''))
+        self.limit = limit
+        self._last_throughput = throughput
+        return limit
+
+    def update(self, pool, now=None):
+        """Called by the pool on every main loop cycle. Once per `interval`, measures the last
+        window and returns the new limit. Returns None otherwise."""
+        now = now if now is not None else time.time()
+        for ctrl in list(pool.running.values()):
+            self.sample(ctrl)
+        if self._window_start is None:
+            self._window_start = now
+            return None
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return None
+        throughput = self._blocks / elapsed if elapsed > 0 else 0.0
+        self._blocks = 0
+        self._window_start = now
+        latency = pool.tip.latency if pool.tip is not None else None
+        return self.adjust(throughput,
+                saturated=len(pool.running) >= pool.max_running,
+                load=load_per_cpu(), memory=available_memory(), latency=latency)
@@ -0,0 +1,130 @@
+import http.server
+import json
+import logging
+import os
+import socketserver
+import threading
+
+import monero.address
+
+_log = logging.getLogger(__name__)
+
+
+class _ControlHandler(http.server.BaseHTTPRequestHandler):
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path.startswith('/wallets/'):
+            self.get_snapshot(path[len('/wallets/'):])
+            return
+        if path != '/status':
+            self.send_error(404)
+            return
+        pool = self.server.pool
+        status = {
+            'height': pool.bc_height,
+            'max_running': pool.max_running,
+            'wallets': [{
+                'address': str(ctrl.address),
+                'status': ctrl.status,
+                'height': ctrl.height,
+                'priority': ctrl.priority,
+            } for ctrl in list(pool.running.values())]}
+        if pool.supervisor is not None:
+            status['quarantined'] = [{
+                'address': str(address),
+                'kind': kind,
+                'error': error,
+                'since': since,
+            } for address, (kind, error, since) in list(pool.supervisor.quarantined.items())]
+        self.send_json(200, status)
+
+    def get_snapshot(self, address):
+        snapshots = self.server.pool.snapshots
+        snapshot = snapshots.get(address) if snapshots is not None else None
+        if snapshot is None:
+            self.send_json(404, {'error': 'No snapshot of {}'.format(address)})
+            return
+        self.send_json(200, snapshot.as_dict())
+
+    def do_POST(self):
+        if self.path.split('?')[0] != '/sync':
+            self.send_error(404)
+            return
+        try:
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            address = params['address']
+            monero.address.address(address)
+            priority = int(params.get('priority', 1))
+            deadline = params.get('deadline')
+            deadline = float(deadline) if deadline is not None else None
+        except (ValueError, TypeError, KeyError) as e:
+            self.send_json(400, {'error': 'Invalid request: {}'.format(e)})
+            return
+        request = self.server.pool.request_sync(address, priority=priority, deadline=deadline)
+        if not params.get('wait'):
+            self.send_json(202, {'address': address, 'status': None})
+            return
+        # the pool expires the request at the deadline; allow for its loop cycle
+        request.wait(deadline + self.server.pool.main_loop_sleep_time + 1
+                if deadline is not None else None)
+        self.send_json(200, {'address': address, 'status': request.status,
+                'height': request.height})
+
+    def log_message(self, format, *args):
+        _log.debug(format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # `BaseHTTPRequestHandler` expects a `(host, port)` client address
+        request, _ = super(_UnixHTTPServer, self).get_request()
+        return request, ('local', 0)
+
+
+class ControlServer(threading.Thread):
+    """Serves the control API of the pool over HTTP, on `host:port` or on a Unix socket at
+    `path`:
+        * `POST /sync` with JSON `{"address": ..., "priority": 1, "deadline": 30, "wait": true}`
+          requests an immediate sync, see `WalletPool.request_sync()`. Responds with
+          `{"address": ..., "status": ..., "height": ...}` once the request is resolved, or
+          at once with 202 if `wait` is false,
+        * `GET /status` lists the running wallets, and the quarantined ones if the pool has
+          a `supervisor`,
+        * `GET /wallets/<address>` returns the last snapshot of the wallet with its `staleness`
+          in seconds, if the pool keeps `snapshots` (see `monerowalletpool.snapshots`). No wallet
+          gets opened for that.
+    """
+    host = '127.0.0.1'
+    port = 9091
+
+    def __init__(self, pool, host=None, port=None, path=None):
+        super(ControlServer, self).__init__(name='control', daemon=True)
+        self.path = path
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.httpd = _UnixHTTPServer(path, _ControlHandler)
+        else:
+            self.httpd = http.server.ThreadingHTTPServer(
+                (host or self.host, port if port is not None else self.port), _ControlHandler)
+            self.port = self.httpd.server_address[1]
+        self.httpd.pool = pool
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
@@ -0,0 +1,130 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import monero.backends.jsonrpc
+import monero.daemon
+
+from . import CommunicationError
+
+_log = logging.getLogger(__name__)
+
+
+class DaemonNode(object):
+    """A daemon in the rotation of `DaemonBalancer`. Exposes fields:
+        * `address` - the `host:port` string, as passed to wallets with `--daemon-address`,
+        * `healthy` - whether the node is in rotation,
+        * `height` - the chain height reported by the last check, or `None` if it failed,
+        * `latency` - the duration of the last successful check in seconds,
+        * `load` - the number of wallets assigned to the node,
+        * `failures` - the number of consecutive failed checks.
+    """
+    healthy = True
+    height = None
+    latency = None
+    failures = 0
+
+    def __init__(self, host, port, timeout=5):
+        self.host = host
+        self.port = int(port)
+        self.address = '{}:{}'.format(host, self.port)
+        self.load = 0
+        self.daemon = monero.daemon.Daemon(monero.backends.jsonrpc.JSONRPCDaemon(
+                host=host, port=self.port, timeout=timeout))
+
+    def __repr__(self):
+        return '<DaemonNode {} height={} load={}{}>'.format(
+            self.address, self.height, self.load, '' if self.healthy else ' unhealthy')
+
+    def check(self):
+        """Queries the height of the daemon. Returns it or `None` on failure."""
+        started = time.time()
+        try:
+            self.height = self.daemon.height()
+            self.latency = time.time() - started
+            self.failures = 0
+        except Exception as e:
+            _log.debug('Daemon {} check failed: {}'.format(self.address, e))
+            self.height = None
+            self.failures += 1
+        return self.height
+
+
+class DaemonBalancer(object):
+    """Spreads wallets over several daemons. `daemons` is a sequence of `host:port` strings
+    or `(host, port)` tuples.
+
+    `check()` queries all daemons in parallel and takes those which time out (after `timeout`
+    seconds) or lag more than `max_lag` blocks behind the highest one out of rotation, until
+    they catch up. `acquire()` picks the least loaded healthy daemon for a wallet. Wallets
+    count as synced once they reach the height of their daemon, even if it lags a few blocks.
+
+    Pass an instance as `daemons` argument of `WalletPool`, which then checks the daemons
+    on every poll of its tip tracker.
+    """
+    max_lag = 3
+    timeout = 5
+
+    def __init__(self, daemons, max_lag=None, timeout=None):
+        self.max_lag = max_lag if max_lag is not None else self.max_lag
+        self.timeout = timeout or self.timeout
+        self.nodes = []
+        for daemon in daemons:
+            if isinstance(daemon, str):
+                host, _, port = daemon.rpartition(':')
+                daemon = (host, port)
+            self.nodes.append(DaemonNode(*daemon, timeout=self.timeout))
+        if not self.nodes:
+            raise ValueError('No daemons given.')
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.nodes), thread_name_prefix='daemon-check')
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @property
+    def latency(self):
+        """The mean check latency of healthy daemons, or `None`."""
+        latencies = [n.latency for n in self.nodes if n.healthy and n.latency is not None]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def check(self):
+        """Checks all daemons and updates their health. Returns the highest chain height
+        or raises `CommunicationError` if no daemon answers."""
+        heights = list(self._executor.map(lambda n: n.check(), self.nodes))
+        alive = [h for h in heights if h is not None]
+        if not alive:
+            for node in self.nodes:
+                node.healthy = False
+            raise CommunicationError('None of {} daemon(s) is available.'.format(len(self.nodes)))
+        tip = max(alive)
+        with self._lock:
+            for node in self.nodes:
+                healthy = node.height is not None and tip - node.height <= self.max_lag
+                if healthy != node.healthy:
+                    if healthy:
+                        _log.info('Daemon {} is back in rotation.'.format(node.address))
+                    else:
+                        _log.warning('Daemon {} taken out of rotation (height {}, tip {}).'.format(
+                            node.address, node.height, tip))
+                node.healthy = healthy
+        return tip
+
+    def acquire(self):
+        """Assigns a wallet to the least loaded healthy daemon and returns its node. If none
+        is healthy, the least loaded of all is returned."""
+        with self._lock:
+            nodes = [n for n in self.nodes if n.healthy] or self.nodes
+            node = min(nodes, key=lambda n: (n.load, n.latency or 0))
+            node.load += 1
+            return node
+
+    def release(self, node):
+        """Unassigns a wallet from the node."""
+        with self._lock:
+            node.load = max(node.load - 1, 0)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
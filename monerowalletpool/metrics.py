@@ -0,0 +1,241 @@
+import bisect
+import http.server
+import logging
+import threading
+
+from . import (WALLET_STARTING, WALLET_CREATING, WALLET_SYNCING, WALLET_SYNCED, WALLET_CLOSING,
+        WALLET_CLOSED, WALLET_FAILED)
+
+_log = logging.getLogger(__name__)
+
+WALLET_STATES = (WALLET_STARTING, WALLET_CREATING, WALLET_SYNCING, WALLET_SYNCED, WALLET_CLOSING,
+        WALLET_CLOSED, WALLET_FAILED)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())))
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base of all metrics. Subclasses implement `samples()` yielding
+    `(suffix, labels, value)` tuples. The `HELP` and `TYPE` lines name the metric by
+    `family`, which is `name` unless a subclass adds a suffix."""
+    kind = 'untyped'
+    suffix = ''
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.family = name + self.suffix
+        self.doc = doc
+        self._lock = threading.Lock()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.family, self.doc),
+                '# TYPE {} {}'.format(self.family, self.kind)]
+        for suffix, labels, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.family, suffix, _labels(labels), _value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+    suffix = '_total'
+
+    def __init__(self, name, doc):
+        super(Counter, self).__init__(name, doc)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self):
+        yield '', None, self.value
+
+
+class Gauge(Metric):
+    """A gauge. Instead of setting values, a `collect` callable may be given, returning
+    a list of `(labels, value)` pairs at the time of scraping."""
+    kind = 'gauge'
+
+    def __init__(self, name, doc, collect=None):
+        super(Gauge, self).__init__(name, doc)
+        self.value = 0
+        self.collect = collect
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        if self.collect is None:
+            yield '', None, self.value
+            return
+        for labels, value in self.collect():
+            yield '', labels, value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets):
+        super(Histogram, self).__init__(name, doc)
+        self.buckets = sorted(buckets) + [float('inf')]
+        self._counts = [0] * len(self.buckets)
+        self._sum = 0
+        self._count = 0
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sum += value
+            self._count += 1
+
+    def samples(self):
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield '_bucket', {'le': _value(bound)}, cumulative
+        yield '_sum', None, total
+        yield '_count', None, count
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(m.render() for m in self.metrics) + '\n'
+
+
+class PoolMetrics(Registry):
+    """The metrics of a `WalletPool`. Pass an instance as `metrics` argument of the pool,
+    which binds it and reports the lifecycle of controllers to it."""
+    prefix = 'monerowalletpool'
+    duration_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 14400)
+    latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    rate_buckets = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, prefix=None):
+        super(PoolMetrics, self).__init__()
+        self.prefix = prefix or self.prefix
+        self.pool = None
+        self.ready_seconds = self._histogram(
+            'rpc_ready_seconds', 'Time from spawning wallet RPC to its readiness.',
+            self.duration_buckets)
+        self.sync_seconds = self._histogram(
+            'sync_seconds', 'Time from controller start to wallet being synced.',
+            self.duration_buckets)
+        self.scan_rate = self._histogram(
+            'scan_blocks_per_second', 'Blocks scanned per second while syncing.',
+            self.rate_buckets)
+        self.daemon_latency = self._histogram(
+            'daemon_rpc_seconds', 'Latency of daemon RPC calls.', self.latency_buckets)
+        self.wallet_latency = self._histogram(
+            'wallet_rpc_seconds', 'Latency of wallet RPC calls.', self.latency_buckets)
+        self.started = self.register(Counter(
+            self._name('wallets_started'), 'Number of controllers started.'))
+        self.synced = self.register(Counter(
+            self._name('wallets_synced'), 'Number of wallets synced.'))
+        self.failed = self.register(Counter(
+            self._name('wallets_failed'), 'Number of controllers failed.'))
+        self.register(Gauge(
+            self._name('controllers'), 'Number of running controllers by state.',
+            collect=self._collect_states))
+        self.register(Gauge(
+            self._name('slots'), 'Number of running slots available.',
+            collect=lambda: [(None, self.pool.max_running if self.pool else 0)]))
+        self.register(Gauge(
+            self._name('slot_utilization'), 'Ratio of occupied running slots.',
+            collect=self._collect_utilization))
+        self.register(Gauge(
+            self._name('daemon_height'), 'Blockchain height as seen by the pool.',
+            collect=lambda: [(None, self.pool.bc_height if self.pool else 0)]))
+
+    def _name(self, name):
+        return '{}_{}'.format(self.prefix, name)
+
+    def _histogram(self, name, doc, buckets):
+        return self.register(Histogram(self._name(name), doc, buckets))
+
+    def bind(self, pool):
+        self.pool = pool
+
+    def _collect_states(self):
+        counts = dict((state, 0) for state in WALLET_STATES)
+        if self.pool is not None:
+            for ctrl in list(self.pool.running.values()):
+                counts[ctrl.status] = counts.get(ctrl.status, 0) + 1
+        return [({'state': state}, count) for state, count in counts.items()]
+
+    def _collect_utilization(self):
+        if self.pool is None or not self.pool.max_running:
+            return [(None, 0)]
+        return [(None, len(self.pool.running) / self.pool.max_running)]
+
+    def controller_started(self, ctrl):
+        self.started.inc()
+
+    def controller_finished(self, ctrl):
+        """Records the timings of a controller which has reached terminal state."""
+        if ctrl.ready_time is not None:
+            self.ready_seconds.observe(ctrl.ready_time.total_seconds())
+        if ctrl.status == WALLET_FAILED:
+            self.failed.inc()
+            return
+        if ctrl.sync_time is not None:
+            self.synced.inc()
+            self.sync_seconds.observe(ctrl.sync_time.total_seconds())
+        if ctrl.scan_rate is not None:
+            self.scan_rate.observe(ctrl.scan_rate)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _log.debug(format % args)
+
+
+class MetricsServer(threading.Thread):
+    """Serves the registry over HTTP at `/metrics` in Prometheus text format."""
+    host = '127.0.0.1'
+    port = 9090
+
+    def __init__(self, registry, host=None, port=None):
+        super(MetricsServer, self).__init__(name='metrics', daemon=True)
+        self.httpd = http.server.ThreadingHTTPServer(
+            (host or self.host, port if port is not None else self.port), _MetricsHandler)
+        self.httpd.registry = registry
+        self.port = self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
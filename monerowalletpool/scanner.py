@@ -0,0 +1,322 @@
+import collections
+import json
+import logging
+import struct
+import threading
+
+import monero.address
+import monero.backends.jsonrpc
+import nacl.bindings
+import nacl.exceptions
+import varint
+from monero import ed25519
+from monero.keccak import keccak_256
+from monero.transaction.extra import ExtraParser
+
+from . import DaemonClient
+
+_log = logging.getLogger(__name__)
+
+
+def hash_to_scalar(data):
+    return ed25519.scalar_reduce(keccak_256(data).digest())
+
+
+def subaddress_spend_keys(view_secret, spend_public, accounts=1, minors=1):
+    """Returns a dict of public spend keys of the subaddresses `(major, minor)` within
+    the `accounts` x `minors` range, keyed by the key bytes. `(0, 0)` is the main address."""
+    keys = {spend_public: (0, 0)}
+    for major in range(accounts):
+        for minor in range(minors):
+            if (major, minor) == (0, 0):
+                continue
+            m = hash_to_scalar(b'SubAddr\0' + view_secret + struct.pack('<II', major, minor))
+            keys[ed25519.edwards_add(spend_public, ed25519.scalarmult_B(m))] = (major, minor)
+    return keys
+
+
+class ViewKey(object):
+    """The view key of a wallet registered with `ViewKeyScanner`. `height` is the next block to
+    scan for it. `recent` holds the transfers found in the blocks which may still get
+    reorganized away."""
+
+    def __init__(self, address, view_secret, height=0, accounts=1, minors=1):
+        self.address = address
+        self.height = self.start_height = height
+        self.recent = []
+        self.view_secret = bytes.fromhex(view_secret)
+        view8 = ed25519.scalar_add(self.view_secret, self.view_secret)
+        view8 = ed25519.scalar_add(view8, view8)
+        self.view8 = ed25519.scalar_add(view8, view8)
+        spend_public = bytes.fromhex(monero.address.address(str(address)).spend_key())
+        self.spend_keys = subaddress_spend_keys(self.view_secret, spend_public, accounts, minors)
+
+    def derive(self, tx_pubkey):
+        """Returns the key derivation shared with the transaction key."""
+        return ed25519.scalarmult(self.view8, tx_pubkey)
+
+    def match(self, derivation, index, output_key, view_tag=None):
+        """Returns `(shared_scalar, (major, minor))` if the output is ours, `None` otherwise."""
+        index = varint.encode(index)
+        if view_tag and keccak_256(b'view_tag' + derivation + index).digest()[:1] != view_tag:
+            return None
+        hs = hash_to_scalar(derivation + index)
+        spend_key = nacl.bindings.crypto_core_ed25519_sub(output_key, ed25519.scalarmult_B(hs))
+        subaddress = self.spend_keys.get(spend_key)
+        return (hs, subaddress) if subaddress is not None else None
+
+
+def decode_amount(hs, encrypted, commitment):
+    """Decrypts an RCT output amount and checks it against the commitment. Returns the amount
+    in atomic units or `None` if it doesn't match."""
+    mask = keccak_256(b'amount' + hs).digest()[:len(encrypted)]
+    amount = bytes(a ^ b for a, b in zip(encrypted, mask))
+    y = hash_to_scalar(b'commitment_mask' + hs)
+    if ed25519.edwards_add(ed25519.scalarmult_B(y),
+            ed25519.scalarmult_H(ed25519.scalar_reduce(amount))) != commitment:
+        return None
+    return struct.unpack('<Q', amount.ljust(8, b'\0'))[0]
+
+
+def _outputs(tx):
+    """Yields `(index, output_key, view_tag, amount, encrypted_amount, commitment)`."""
+    rct = tx.get('rct_signatures') or {}
+    coinbase = 'gen' in tx['vin'][0]
+    for index, vout in enumerate(tx['vout']):
+        target = vout['target']
+        if 'tagged_key' in target:
+            key = target['tagged_key']['key']
+            view_tag = bytes.fromhex(target['tagged_key']['view_tag'])
+        else:
+            key, view_tag = target['key'], None
+        if tx.get('version', 1) == 2 and not coinbase:
+            yield (index, bytes.fromhex(key), view_tag, None,
+                    bytes.fromhex(rct['ecdhInfo'][index]['amount']),
+                    bytes.fromhex(rct['outPk'][index]))
+        else:
+            yield index, bytes.fromhex(key), view_tag, vout['amount'], None, None
+
+
+class ViewKeyScanner(DaemonClient):
+    """Watches view-only wallets without running wallet RPC. Blocks are fetched from the daemon
+    once, in batches of `batch_size`, and every output is tested against the view keys of all
+    wallets behind it, so the daemon traffic doesn't grow with the number of wallets.
+    Key derivations are computed once per transaction and wallet, and matched outputs are
+    looked up among the subaddresses of `accounts` x `minors` range (the main address only
+    by default).
+
+    Like `WalletPool`, it takes the view keys from `keys_for_address()` of the addresses
+    added with `add()`. Found incoming transfers, in the format of `get_transfers`, are passed
+    to `transfers_received()` hook and to `transfers` stream, if given (see
+    `monerowalletpool.transfers.TransferStream`). `wallet_synced()` hook is called when
+    a wallet reaches the tip. Unconfirmed and outgoing transfers are out of reach of view keys
+    alone and aren't reported.
+
+    The hashes of the last `reorg_depth` scanned blocks are kept and checked against the daemon
+    before each pass. If the chain has been reorganized, the wallets are rewound to the fork
+    point and the transfers found in the orphaned blocks go to `transfers_reverted()` hook and
+    to the stream's `revert()`, before the replacing blocks are scanned.
+    """
+    batch_size = 100
+    reorg_depth = 100
+    main_loop_sleep_time = 5
+    accounts = 1
+    minors = 1
+    transfers = None
+    timeout = 30
+
+    def __init__(self, batch_size=None, accounts=None, minors=None, transfers=None, **kwargs):
+        self.batch_size = batch_size or self.batch_size
+        self.accounts = accounts or self.accounts
+        self.minors = minors or self.minors
+        self.transfers = transfers if transfers is not None else self.transfers
+        self.wallets = collections.OrderedDict()
+        self.block_hashes = {}      # height: hash of the last `reorg_depth` scanned blocks
+        self.bc_height = 0
+        self._stopping = threading.Event()
+        super(ViewKeyScanner, self).__init__(**kwargs)
+        self.backend = monero.backends.jsonrpc.JSONRPCDaemon(
+                host=self.daemon_host, port=self.daemon_port, timeout=self.timeout)
+
+    def keys_for_address(self, addr):
+        """Method returning (secret_view, secret_spend) keys for given address. Only the view
+        key is used; if it's None, the address is skipped."""
+        raise NotImplementedError(
+            'Subclass {cls} to implement keys_for_address()'.format(cls=type(self)))
+
+    def transfers_received(self, address, transfers):
+        """Hook called with new incoming transfers of a wallet."""
+        pass
+
+    def transfers_reverted(self, address, transfers):
+        """Hook called with transfers of a wallet from blocks orphaned by a chain
+        reorganization."""
+        pass
+
+    def wallet_synced(self, address, height):
+        """Hook called when the wallet has been scanned up to the tip."""
+        pass
+
+    def add(self, address, height=0):
+        """Starts watching the wallet, scanning from `height`."""
+        view_secret, _ = self.keys_for_address(address)
+        if view_secret is None:
+            _log.warning('No view key for {}, skipping.'.format(address))
+            return
+        self.wallets[address] = ViewKey(
+                address, view_secret, height, accounts=self.accounts, minors=self.minors)
+
+    def remove(self, address):
+        self.wallets.pop(address, None)
+
+    def fetch_blocks(self, start, end):
+        """Returns blocks of heights `[start, end)` as `(height, hash, timestamp, transactions)`,
+        where transactions are `(txid, tx_json, output_indices)`."""
+        blocks, hashes = [], []
+        for height in range(start, end):
+            result = self.backend.raw_jsonrpc_request('get_block', {'height': height})
+            block = json.loads(result['json'])
+            header = result['block_header']
+            blocks.append((height, header['hash'], header['timestamp'],
+                    [(header['miner_tx_hash'], block['miner_tx'], None)]))
+            hashes.extend(block['tx_hashes'])
+        by_height = dict((b[0], b[3]) for b in blocks)
+        for offset in range(0, len(hashes), 100):
+            result = self.backend.raw_request('/get_transactions', {
+                'txs_hashes': hashes[offset:offset + 100], 'decode_as_json': True, 'prune': True})
+            for tx in result.get('txs', []):
+                by_height[tx['block_height']].append(
+                    (tx['tx_hash'], json.loads(tx['as_json']), tx.get('output_indices')))
+        return blocks
+
+    def scan_transaction(self, txid, tx, output_indices, height, timestamp, wallets):
+        """Returns a dict of `address: transfers` found in the transaction."""
+        found = {}
+        parser = ExtraParser(tx['extra'])
+        try:
+            pubkeys = parser.parse().get('pubkeys', [])
+        except (ValueError, IndexError) as e:
+            # e.g. a merge mining tag unknown to the parser; keep the keys found before it
+            pubkeys = parser.data.get('pubkeys', [])
+            _log.debug('Cannot parse extra of {}: {}'.format(txid, e))
+        outputs = list(_outputs(tx))
+        if not pubkeys or not outputs:
+            return found
+        # the main key is followed by additional per-output keys, if any
+        additional = pubkeys[1:] if len(pubkeys) == len(outputs) + 1 else []
+        for wallet in wallets:
+            derivations = {}
+            for index, key, view_tag, amount, encrypted, commitment in outputs:
+                for pubkey in [pubkeys[0]] + additional[index:index + 1]:
+                    try:
+                        if pubkey not in derivations:
+                            derivations[pubkey] = wallet.derive(pubkey)
+                        match = wallet.match(derivations[pubkey], index, key, view_tag)
+                    except nacl.exceptions.RuntimeError:
+                        # not a valid point
+                        continue
+                    if match is None:
+                        continue
+                    hs, (major, minor) = match
+                    if amount is None:
+                        amount = decode_amount(hs, encrypted, commitment)
+                    if amount is None:
+                        _log.warning('Output {}:{} has a bad commitment.'.format(txid, index))
+                        break
+                    transfers = found.setdefault(wallet.address, collections.OrderedDict())
+                    transfer = transfers.setdefault((major, minor), {
+                        'txid': txid, 'type': 'in', 'amount': 0, 'height': height,
+                        'timestamp': timestamp, 'unlock_time': tx.get('unlock_time', 0),
+                        'fee': (tx.get('rct_signatures') or {}).get('txnFee', 0),
+                        'subaddr_index': {'major': major, 'minor': minor},
+                        'global_indices': []})
+                    transfer['amount'] += amount
+                    if output_indices:
+                        transfer['global_indices'].append(output_indices[index])
+                    break
+        return dict((address, list(t.values())) for address, t in found.items())
+
+    def check_reorg(self):
+        """Compares the hashes of the last scanned blocks with the daemon's chain. If they
+        differ, rewinds the wallets to the first differing block and reports the transfers
+        found from there on as reverted. Returns the height of that block or `None`."""
+        if not self.block_hashes:
+            return None
+        heights = sorted(self.block_hashes)
+        hashes = {}
+        if heights[0] < self.bc_height:
+            result = self.backend.raw_jsonrpc_request('get_block_headers_range', {
+                'start_height': heights[0], 'end_height': min(heights[-1], self.bc_height - 1)})
+            hashes = dict((h['height'], h['hash']) for h in result['headers'])
+        fork = next((h for h in heights if hashes.get(h) != self.block_hashes[h]), None)
+        if fork is None:
+            return None
+        if fork == heights[0] and len(heights) >= self.reorg_depth:
+            _log.error('Chain reorganization deeper than {} blocks, rescanning only those.'.format(
+                self.reorg_depth))
+        _log.warning('Chain reorganization at height {}, rescanning from there.'.format(fork))
+        for height in heights:
+            if height >= fork:
+                del self.block_hashes[height]
+        for wallet in list(self.wallets.values()):
+            if wallet.height > fork:
+                wallet.height = max(fork, wallet.start_height)
+            reverted = [t for t in wallet.recent if t['height'] >= fork]
+            if not reverted:
+                continue
+            wallet.recent = [t for t in wallet.recent if t['height'] < fork]
+            if self.transfers is not None:
+                self.transfers.revert(wallet.address, fork, reverted)
+            self.transfers_reverted(wallet.address, reverted)
+        return fork
+
+    def scan(self):
+        """Scans the blocks up to the tip for all wallets behind it, after rewinding them
+        if the chain has been reorganized. Returns the tip height."""
+        self.bc_height = self.backend.raw_request('/get_height')['height']
+        self.check_reorg()
+        behind = [w for w in list(self.wallets.values()) if w.height < self.bc_height]
+        start = min(w.height for w in behind) if behind else self.bc_height
+        while start < self.bc_height and not self._stopping.is_set():
+            end = min(start + self.batch_size, self.bc_height)
+            found = collections.OrderedDict()
+            for height, block_hash, timestamp, txs in self.fetch_blocks(start, end):
+                wallets = [w for w in behind if w.height <= height]
+                for txid, tx, output_indices in txs:
+                    for address, transfers in self.scan_transaction(
+                            txid, tx, output_indices, height, timestamp, wallets).items():
+                        found.setdefault(address, []).extend(transfers)
+                self.block_hashes[height] = block_hash
+            oldest = max(self.block_hashes) - self.reorg_depth + 1
+            for height in [h for h in self.block_hashes if h < oldest]:
+                del self.block_hashes[height]
+            for wallet in behind:
+                wallet.height = max(wallet.height, end)
+                wallet.recent = [t for t in wallet.recent if t['height'] >= oldest]
+            for address, transfers in found.items():
+                self.wallets[address].recent.extend(transfers)
+                if self.transfers is not None:
+                    self.transfers.deliver(address, transfers)
+                self.transfers_received(address, transfers)
+            _log.debug('Scanned blocks {}-{} for {} wallet(s).'.format(start, end - 1, len(behind)))
+            start = end
+        for wallet in behind:
+            if wallet.height >= self.bc_height:
+                self.wallet_synced(wallet.address, wallet.height)
+        if self.transfers is not None:
+            self.transfers.flush(force=False)
+        return self.bc_height
+
+    def main_loop(self):
+        """Scans until `stop()`, waiting `main_loop_sleep_time` seconds at the tip."""
+        while not self._stopping.is_set():
+            try:
+                self.scan()
+            except Exception as e:
+                _log.error('Scanning failed: {}'.format(e))
+            self._stopping.wait(self.main_loop_sleep_time)
+        if self.transfers is not None:
+            self.transfers.close()
+
+    def stop(self, *args):
+        self._stopping.set()
@@ -0,0 +1,96 @@
+import hashlib
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+class ShardCoordinator(object):
+    """Splits the wallets of a shared directory among several pool instances, which may run
+    on different hosts as long as they share the SQLite database at `path` on a filesystem with
+    working locks.
+
+    Every instance heartbeats into the database every `ttl / 3` seconds and considers the
+    instances seen within `ttl` seconds alive. Each address is owned by one of them, chosen by
+    rendezvous hashing, so an instance joining or dying only moves its share of the wallets.
+    On top of that, a wallet is opened only under a lease held in the database, which keeps
+    two instances from opening it at once while their views of the membership differ. Leases
+    are renewed with the heartbeat and expire after `ttl` seconds if their owner dies.
+
+    Pass an instance as `shards` argument of `WalletPool`.
+    """
+    ttl = 30
+
+    def __init__(self, path, instance=None, ttl=None):
+        self.path = path
+        self.instance = instance or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.ttl = ttl or self.ttl
+        self.members = ()
+        self._heartbeat_at = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=self.ttl / 3.0, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS members (instance TEXT PRIMARY KEY, heartbeat REAL)')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'address TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+
+    def update(self, now=None):
+        """Heartbeats if due, renewing the leases of this instance. Returns `True` if
+        the membership has changed since the last call."""
+        now = now or time.time()
+        if self._heartbeat_at is not None and now - self._heartbeat_at < self.ttl / 3.0:
+            return False
+        self._heartbeat_at = now
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO members VALUES (?, ?)', (self.instance, now))
+            self._db.execute('DELETE FROM members WHERE heartbeat < ?', (now - self.ttl,))
+            self._db.execute('UPDATE leases SET expires = ? WHERE owner = ?',
+                    (now + self.ttl, self.instance))
+            self._db.execute('DELETE FROM leases WHERE expires < ?', (now,))
+            members = tuple(sorted(
+                row[0] for row in self._db.execute('SELECT instance FROM members')))
+        if members == self.members:
+            return False
+        _log.info('Shard members: {}'.format(', '.join(members)))
+        self.members = members
+        return True
+
+    def owner(self, address):
+        """Returns the instance owning the address."""
+        address = str(address).encode('utf-8')
+        return max(self.members or (self.instance,), key=lambda member: hashlib.sha1(
+            member.encode('utf-8') + b'/' + address).digest())
+
+    def owns(self, address):
+        return self.owner(address) == self.instance
+
+    def acquire(self, address, now=None):
+        """Takes the lease of an owned address. Returns `True` on success."""
+        if not self.owns(address):
+            return False
+        now = now or time.time()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (address) DO UPDATE '
+                'SET owner = excluded.owner, expires = excluded.expires '
+                'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+                (str(address), self.instance, now + self.ttl, now))
+            return cursor.rowcount == 1
+
+    def release(self, address):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM leases WHERE address = ? AND owner = ?',
+                    (str(address), self.instance))
+
+    def close(self):
+        """Leaves the shard, handing over the wallets to the other instances at once."""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM leases WHERE owner = ?', (self.instance,))
+            self._db.execute('DELETE FROM members WHERE instance = ?', (self.instance,))
+        self._db.close()
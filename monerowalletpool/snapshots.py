@@ -0,0 +1,140 @@
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from .transfers import CONFIRMED, UNCONFIRMED, transfer_key
+
+_log = logging.getLogger(__name__)
+
+
+class WalletSnapshot(object):
+    """State of a wallet as of its last sync: `height`, `balance` and `unlocked_balance`
+    in atomic units, and the most `recent` transfers as returned by `get_transfers`, newest last.
+    `taken_at` is a UNIX timestamp."""
+
+    def __init__(self, address, height, balance, unlocked_balance, transfers=(), taken_at=None):
+        self.address = str(address)
+        self.height = height
+        self.balance = balance
+        self.unlocked_balance = unlocked_balance
+        self.transfers = list(transfers)
+        self.taken_at = taken_at if taken_at is not None else time.time()
+
+    def __repr__(self):
+        return '<WalletSnapshot {} height={} balance={}>'.format(
+            self.address[:6], self.height, self.balance)
+
+    def staleness(self, now=None):
+        """Seconds since the snapshot was taken."""
+        return (now if now is not None else time.time()) - self.taken_at
+
+    def as_dict(self, now=None):
+        return {
+            'address': self.address,
+            'height': self.height,
+            'balance': self.balance,
+            'unlocked_balance': self.unlocked_balance,
+            'transfers': self.transfers,
+            'taken_at': self.taken_at,
+            'staleness': self.staleness(now),
+        }
+
+
+class SnapshotCache(object):
+    """Snapshots of synced wallets, for answering queries without starting wallet RPC.
+    The `size` most recently used snapshots are held in memory; all of them are stored in SQLite
+    database at `path`, if given, which other processes may open for reading too.
+
+    Pass an instance as `snapshots` argument of `WalletPool`, which makes the controllers take
+    a snapshot of each wallet before reporting it synced.
+    """
+    size = 10000
+    recent = 20
+
+    def __init__(self, path=None, size=None, recent=None):
+        self.path = path
+        self.size = size or self.size
+        self.recent = recent or self.recent
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is None:
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS snapshots ('
+            'address TEXT PRIMARY KEY, height INTEGER, balance INTEGER, '
+            'unlocked_balance INTEGER, transfers TEXT, taken_at REAL)')
+        self._db.commit()
+
+    def _remember(self, snapshot):
+        self._cache[snapshot.address] = snapshot
+        self._cache.move_to_end(snapshot.address)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def get(self, address):
+        """Returns the latest snapshot of the wallet, or `None`."""
+        address = str(address)
+        with self._lock:
+            snapshot = self._cache.get(address)
+            if snapshot is not None:
+                self._cache.move_to_end(address)
+                return snapshot
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                'SELECT height, balance, unlocked_balance, transfers, taken_at '
+                'FROM snapshots WHERE address = ?', (address,)).fetchone()
+            if row is None:
+                return None
+            height, balance, unlocked, transfers, taken_at = row
+            snapshot = WalletSnapshot(
+                address, height, balance, unlocked, json.loads(transfers), taken_at)
+            self._remember(snapshot)
+            return snapshot
+
+    def put(self, snapshot):
+        with self._lock:
+            self._remember(snapshot)
+            if self._db is None:
+                return
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)', (
+                    snapshot.address, snapshot.height, snapshot.balance,
+                    snapshot.unlocked_balance, json.dumps(snapshot.transfers, sort_keys=True),
+                    snapshot.taken_at))
+
+    def take(self, address, backend):
+        """Takes a snapshot of an open wallet from its RPC backend and stores it. Only the
+        transfers since the previous snapshot are requested."""
+        previous = self.get(address)
+        balance = backend.raw_request('get_balance', {'all_accounts': True})
+        height = backend.raw_request('get_height', {})['height']
+        last = max([t.get('height') or 0 for t in previous.transfers]) if previous else 0
+        result = backend.raw_request('get_transfers', {
+            'in': True, 'out': True, 'pool': True, 'pending': True,
+            'filter_by_height': True,
+            'min_height': max(last - 1, 0),
+            'all_accounts': True})
+        transfers = collections.OrderedDict()
+        # unconfirmed transfers may have been confirmed or dropped since
+        for transfer in previous.transfers if previous else ():
+            if transfer['type'] in CONFIRMED:
+                transfers[transfer_key(transfer)] = transfer
+        for category in CONFIRMED + UNCONFIRMED:
+            for transfer in result.get(category, []):
+                transfers[transfer_key(transfer)] = transfer
+        recent = sorted(transfers.values(),
+                key=lambda t: t.get('height') or float('inf'))[-self.recent:]
+        snapshot = WalletSnapshot(address, height, balance.get('balance', 0),
+                balance.get('unlocked_balance', 0), recent)
+        self.put(snapshot)
+        return snapshot
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
@@ -0,0 +1,215 @@
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+class IOBudget(object):
+    """Limits writes to `rate` bytes per second on average, allowing bursts of up to `burst`
+    bytes (one second worth of `rate` by default). Shared by all threads writing through it."""
+    burst = None
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or self.burst or self.rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        """Takes `nbytes` from the budget. Returns the number of seconds to wait before
+        writing them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            return max(-self._tokens / self.rate, 0)
+
+    def consume(self, nbytes):
+        """Blocks until `nbytes` may be written."""
+        delay = self.reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+
+class StagingArea(object):
+    """Keeps the files of open wallets under `root`, typically on tmpfs, so the wallet RPC
+    processes read and store their caches in RAM instead of on the shared disk.
+
+    `stage()` copies the wallet files there before the wallet is opened and `write_back()`
+    copies those which have changed back to the wallet directory after it's closed. Each file
+    is written to a temporary file next to its destination, fsynced and renamed over it, so
+    a crash leaves either the old or the new version, never a partial one. The writes go
+    through `budget` (an `IOBudget`), if given, unless `throttle=False` is passed.
+
+    Each instance keeps its files in a subdirectory of `root` of its own, `path`, locked
+    through a lock file next to it for as long as the instance lives, so several pools may
+    share `root`. Subdirectories left by crashed instances, whose locks are free, are removed
+    on start, as their state is unknown; the copies in the wallet directory are intact.
+
+    Pass an instance as `staging` argument of `WalletsManager`.
+    """
+    suffixes = ('', '.keys', '.address.txt')
+    chunk_size = 1 << 20
+
+    def __init__(self, root, budget=None):
+        self.root = root
+        self.budget = budget
+        self.staged = {}    # name: {file name: (size, mtime_ns)} as copied
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        self._lockfile, self._lockname = self._acquire()
+        self.path = self._lockname[:-len('.lock')]
+        os.mkdir(self.path)
+        self.remove_stale()
+
+    def _acquire(self):
+        """Creates and locks a new lock file. Returns it open and its path."""
+        while True:
+            fd, name = tempfile.mkstemp(prefix='staging-', suffix='.lock', dir=self.root)
+            lockfile = os.fdopen(fd, 'w')
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                # another instance may have taken it for stale before it got locked
+                if os.path.samestat(os.fstat(lockfile.fileno()), os.stat(name)):
+                    return lockfile, name
+            except FileNotFoundError:
+                pass
+            lockfile.close()
+
+    def remove_stale(self):
+        """Removes the subdirectories of instances which are gone."""
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith('.lock') or entry.path == self._lockname:
+                continue
+            try:
+                lockfile = open(entry.path)
+            except OSError:
+                continue
+            with lockfile:
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # the instance is alive
+                    continue
+                stale = entry.path[:-len('.lock')]
+                _log.warning('Removing stale staging directory {}'.format(stale))
+                shutil.rmtree(stale, ignore_errors=True)
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def close(self):
+        """Removes the staging directory, with the files of wallets not written back, and
+        releases the lock."""
+        if self._lockfile.closed:
+            return
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.unlink(self._lockname)
+        self._lockfile.close()
+
+    def _files(self, name):
+        return ['{}{}'.format(name, suffix) for suffix in self.suffixes]
+
+    def stage(self, directory, name):
+        """Copies the files of wallet `name` from `directory` to the staging area. Files kept
+        after a failed write-back are newer than those in `directory`, so they are used instead."""
+        name = str(name)
+        if self.is_staged(name):
+            _log.warning('Wallet {} has not been written back, reusing its staged files'.format(
+                name))
+            return
+        copied = {}
+        for fname in self._files(name):
+            source = os.path.join(directory, fname)
+            if not os.path.exists(source):
+                continue
+            target = os.path.join(self.path, fname)
+            shutil.copyfile(source, target)
+            stat = os.stat(target)
+            copied[fname] = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            self.staged[name] = copied
+        _log.debug('Staged {} file(s) of wallet {}'.format(len(copied), name))
+
+    def is_staged(self, name):
+        with self._lock:
+            return str(name) in self.staged
+
+    def write_back(self, directory, name, throttle=True):
+        """Atomically copies the changed files of wallet `name` back to `directory` and removes
+        them from the staging area. Returns the number of bytes written. If writing fails,
+        the files stay staged, so it may be retried."""
+        name = str(name)
+        with self._lock:
+            copied = self.staged.get(name)
+        if copied is None:
+            return 0
+        written = 0
+        for fname in self._files(name):
+            staged = os.path.join(self.path, fname)
+            if not os.path.exists(staged):
+                continue
+            stat = os.stat(staged)
+            if copied.get(fname) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            written += self._replace(staged, os.path.join(directory, fname), throttle)
+            # a retry needn't write it again
+            copied[fname] = (stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            self.staged.pop(name, None)
+        for fname in self._files(name):
+            try:
+                os.unlink(os.path.join(self.path, fname))
+            except FileNotFoundError:
+                pass
+        _log.debug('Wrote back {} bytes of wallet {}'.format(written, name))
+        return written
+
+    def discard(self, name):
+        """Removes the staged files of wallet `name` without writing them back."""
+        name = str(name)
+        with self._lock:
+            self.staged.pop(name, None)
+        for fname in self._files(name):
+            try:
+                os.unlink(os.path.join(self.path, fname))
+            except FileNotFoundError:
+                pass
+
+    def _replace(self, source, target, throttle):
+        directory = os.path.dirname(target) or '.'
+        tmp = os.path.join(directory, '.{}.tmp'.format(os.path.basename(target)))
+        written = 0
+        try:
+            with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+                while True:
+                    chunk = src.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    if throttle and self.budget is not None:
+                        self.budget.consume(len(chunk))
+                    dst.write(chunk)
+                    written += len(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:
+                pass
+            raise
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return written
@@ -0,0 +1,228 @@
+import logging
+import os
+import signal
+import threading
+import time
+
+from . import (OWNER_ENV, AddressMismatchError, RPCTimeoutError, WalletCreationError,
+        process_token)
+
+_log = logging.getLogger(__name__)
+
+CREATION = 'creation'
+TIMEOUT = 'timeout'
+MISMATCH = 'address'
+OTHER = 'other'
+
+
+def classify(error):
+    """Returns the kind of a wallet failure: `CREATION`, `TIMEOUT`, `MISMATCH` or `OTHER`."""
+    if isinstance(error, WalletCreationError):
+        return CREATION
+    if isinstance(error, RPCTimeoutError):
+        return TIMEOUT
+    if isinstance(error, AddressMismatchError):
+        return MISMATCH
+    return OTHER
+
+
+def _listening_inodes(ports):
+    """Returns a dict of socket inodes listening on any of `ports`, as found in `/proc/net`."""
+    inodes = {}
+    for name in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(name) as table:
+                next(table)
+                for line in table:
+                    fields = line.split()
+                    port = int(fields[1].rsplit(':', 1)[1], 16)
+                    # 0A is TCP_LISTEN
+                    if fields[3] == '0A' and port in ports:
+                        inodes[fields[9]] = port
+        except (OSError, ValueError, IndexError, StopIteration):
+            continue
+    return inodes
+
+
+def _is_running(pid):
+    return process_token(pid) is not None
+
+
+def _owner(pid):
+    """Returns the `process_token()` of the pool which has spawned the process, as marked in
+    its environment, or `None` if it isn't marked."""
+    try:
+        with open('/proc/{}/environ'.format(pid), 'rb') as environ:
+            variables = environ.read().split(b'\0')
+    except OSError:
+        return None
+    prefix = '{}='.format(OWNER_ENV).encode()
+    for variable in variables:
+        if variable.startswith(prefix):
+            return variable[len(prefix):].decode('ascii', 'replace')
+    return None
+
+
+def is_orphan(pid):
+    """Returns `True` if the pool which has spawned the process is gone. Processes not
+    spawned by a pool aren't orphans."""
+    owner = _owner(pid)
+    if not owner:
+        return False
+    try:
+        return process_token(int(owner.split(':')[0])) != owner
+    except ValueError:
+        return False
+
+
+def find_orphans(port_range, cmd_rpc, orphans_only=True):
+    """Returns a dict of `pid: port` of wallet RPC processes listening on ports of `port_range`
+    (like in range()). Processes are recognized by `cmd_rpc` being their executable or script.
+    Unless `orphans_only` is unset, only those spawned by a pool which is gone, as marked in
+    their environment, are returned; their parent pid is no clue under subreapers and in pid
+    namespaces. Reads `/proc`, so finds nothing on other systems."""
+    inodes = _listening_inodes(range(*port_range))
+    if not inodes:
+        return {}
+    name = os.path.basename(cmd_rpc)
+    found = {}
+    try:
+        pids = [int(pid) for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return {}
+    for pid in pids:
+        if pid == os.getpid():
+            continue
+        try:
+            with open('/proc/{}/cmdline'.format(pid), 'rb') as cmdline:
+                args = cmdline.read().decode('utf-8', 'replace').split('\0')
+            fds = os.listdir('/proc/{}/fd'.format(pid))
+        except OSError:
+            continue
+        # the executable itself or a script run by an interpreter
+        if name not in (os.path.basename(arg) for arg in args[:2]):
+            continue
+        if not _is_running(pid) or (orphans_only and not is_orphan(pid)):
+            continue
+        for fd in fds:
+            try:
+                link = os.readlink('/proc/{}/fd/{}'.format(pid, fd))
+            except OSError:
+                continue
+            if link.startswith('socket:[') and link[8:-1] in inodes:
+                found[pid] = inodes[link[8:-1]]
+                break
+    return found
+
+
+def reap_orphans(port_range, cmd_rpc, timeout=5, orphans_only=True):
+    """Terminates the processes found by `find_orphans()`, killing those still running after
+    `timeout` seconds. Returns the list of their pids."""
+    orphans = find_orphans(port_range, cmd_rpc, orphans_only=orphans_only)
+    for pid, port in orphans.items():
+        _log.warning('Terminating stale wallet RPC process {} on port {}.'.format(pid, port))
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    deadline = time.time() + timeout
+    while any(_is_running(pid) for pid in orphans) and time.time() < deadline:
+        time.sleep(0.1)
+    for pid in orphans:
+        if _is_running(pid):
+            _log.warning('Killing stale wallet RPC process {}.'.format(pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+    return list(orphans)
+
+
+class FailureSupervisor(object):
+    """Keeps failing wallets from taking slots over and over. After a failure the address is
+    held back for `base_delay` seconds, doubling with each consecutive failure up to
+    `max_delay`. Once an address has failed `quarantine_after[kind]` times in a row with the
+    same kind of error (see `classify()`), it's quarantined until `release()`: a wrong address
+    in the wallet file won't fix itself, unlike a timeout on a loaded host.
+
+    On start it reaps `monero-wallet-rpc` processes left on the port range by a crashed pool,
+    unless `reap` is unset.
+
+    Pass an instance as `supervisor` argument of `WalletPool`.
+    """
+    base_delay = 30
+    max_delay = 3600
+    quarantine_after = {CREATION: 3, TIMEOUT: 5, MISMATCH: 1, OTHER: 5}
+    reap = True
+    reap_timeout = 5
+
+    def __init__(self, base_delay=None, max_delay=None, quarantine_after=None, reap=None):
+        self.base_delay = base_delay if base_delay is not None else self.base_delay
+        self.max_delay = max_delay if max_delay is not None else self.max_delay
+        self.quarantine_after = dict(self.quarantine_after, **(quarantine_after or {}))
+        self.reap = reap if reap is not None else self.reap
+        self.failures = {}      # address: (kind, count of that kind, total) in a row
+        self.retry_at = {}      # address: time the backoff ends
+        self.quarantined = {}   # address: (kind, error message, time)
+        self._lock = threading.Lock()
+
+    def start(self, port_range, cmd_rpc):
+        """Called by the pool before starting any wallet."""
+        if self.reap:
+            reap_orphans(port_range, cmd_rpc, timeout=self.reap_timeout)
+
+    def delay(self, count):
+        return min(self.base_delay * 2 ** (count - 1), self.max_delay)
+
+    def failed(self, address, error, now=None):
+        """Records a failure of the wallet. Returns `True` if it's got quarantined."""
+        now = now or time.time()
+        kind = classify(error)
+        with self._lock:
+            last_kind, count, total = self.failures.get(address, (kind, 0, 0))
+            count = count + 1 if last_kind == kind else 1
+            total += 1
+            self.failures[address] = (kind, count, total)
+            if count >= self.quarantine_after.get(kind, self.quarantine_after[OTHER]):
+                self.retry_at.pop(address, None)
+                self.quarantined[address] = (kind, str(error), now)
+                _log.error('Wallet {} quarantined after {} {} failure(s): {}'.format(
+                    address, count, kind, error))
+                return True
+            delay = self.delay(total)
+            self.retry_at[address] = now + delay
+        _log.warning('Wallet {} failed ({}), retrying in {} sec.'.format(address, kind, delay))
+        return False
+
+    def succeeded(self, address):
+        with self._lock:
+            self.failures.pop(address, None)
+            self.retry_at.pop(address, None)
+
+    def admits(self, address, now=None):
+        """Returns `True` if the wallet may be started."""
+        now = now or time.time()
+        with self._lock:
+            return address not in self.quarantined and self.retry_at.get(address, 0) <= now
+
+    def is_quarantined(self, address):
+        with self._lock:
+            return address in self.quarantined
+
+    def due(self, now=None):
+        """Returns the addresses whose backoff has ended since the last call, to be scheduled
+        again."""
+        now = now or time.time()
+        with self._lock:
+            due = [address for address, at in self.retry_at.items() if at <= now]
+            for address in due:
+                del self.retry_at[address]
+        return due
+
+    def release(self, address):
+        """Lifts the quarantine or backoff of the wallet. May be called from any thread."""
+        with self._lock:
+            held = self.quarantined.pop(address, None) is not None or address in self.retry_at
+            self.failures.pop(address, None)
+            if held:
+                self.retry_at[address] = 0
@@ -0,0 +1,150 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+
+class Span(object):
+    """Records the time between entering and leaving it as a span of the tracer."""
+    __slots__ = ('tracer', 'name', 'address', 'args', 'profile', 'start')
+
+    def __init__(self, tracer, name, address, args, profile):
+        self.tracer = tracer
+        self.name = name
+        self.address = address
+        self.args = args
+        self.profile = profile
+
+    def __enter__(self):
+        if self.profile and self.tracer.profiler is not None:
+            self.tracer.profiler.enable()
+        self.start = time.monotonic_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.monotonic_ns()
+        if self.profile and self.tracer.profiler is not None:
+            self.tracer.profiler.disable()
+        if exc_type is not None:
+            self.args = dict(self.args, error=repr(exc_value))
+        self.tracer.record(self.name, self.start, end, self.address, self.args)
+        return False
+
+
+class Tracer(object):
+    """Records timestamped spans of wallet lifecycle phases, e.g. `create`, `spawn`,
+    `rpc_ready`, `address_check`, `sync_wait`, `handler` and `close`, in a ring buffer of
+    the last `size` spans. Appending a span takes a tuple and a `deque.append()`, so tracing
+    can stay on in production.
+
+    `dump(path)` writes the buffer as Chrome trace-event JSON, to be opened in `chrome://tracing`
+    or Perfetto. Each thread, so each wallet controller, gets its own track. With `path` given,
+    every span is also streamed there, in batches of `batch_size` or every `flush_interval`
+    seconds, as a trace-event array; the trace viewers load it even before `close()`
+    terminates the array.
+
+    If `profiler` is given, it's enabled for the duration of the handler calls of the pool only,
+    so its statistics show where the handlers spend the slot time across all cycles. Anything
+    with `enable()` and `disable()` fits, e.g. `cProfile.Profile()`.
+
+    Pass an instance as `tracer` argument of `WalletPool`; the pool hands it over to its
+    manager and controllers.
+    """
+    size = 100000
+    batch_size = 1000
+    flush_interval = 5
+
+    def __init__(self, size=None, path=None, profiler=None):
+        self.size = size or self.size
+        self.path = path
+        self.profiler = profiler
+        self.spans = collections.deque(maxlen=self.size)
+        self.pid = os.getpid()
+        self._origin = time.monotonic_ns() - int(time.time() * 1e9)
+        self._pending = collections.deque()
+        self._flushed_at = time.time()
+        self._threads = {}      # tid: thread name
+        self._tids = itertools.count(1)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stream = None
+        self._separator = '['
+        if self.path is not None:
+            self._stream = open(self.path, 'w')
+
+    def _tid(self):
+        try:
+            return self._local.tid
+        except AttributeError:
+            tid = self._local.tid = next(self._tids)
+            self._threads[tid] = threading.current_thread().name
+            if self._stream is not None:
+                self._pending.append(self._thread_event(tid))
+            return tid
+
+    def span(self, name, address=None, profile=False, **args):
+        """Returns a context manager recording a span of the phase `name`."""
+        return Span(self, name, address, args, profile)
+
+    def record(self, name, start, end, address=None, args=None):
+        """Records a span between `time.monotonic_ns()` stamps `start` and `end`."""
+        span = (name, start, end, self._tid(), address, args)
+        self.spans.append(span)
+        if self._stream is not None:
+            self._pending.append(span)
+
+    def _event(self, span):
+        name, start, end, tid, address, args = span
+        args = dict(args or {})
+        if address is not None:
+            args['address'] = str(address)
+        return {
+            'name': name, 'cat': 'wallet', 'ph': 'X', 'pid': self.pid, 'tid': tid,
+            'ts': (start - self._origin) / 1000.0, 'dur': (end - start) / 1000.0, 'args': args}
+
+    def _thread_event(self, tid):
+        return {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid,
+                'args': {'name': self._threads[tid]}}
+
+    def events(self):
+        """Returns the buffered spans as a list of trace events."""
+        events = [self._thread_event(tid) for tid in list(self._threads)]
+        events.extend(self._event(span) for span in list(self.spans))
+        return events
+
+    def dump(self, path):
+        """Writes the buffered spans to `path` as Chrome trace-event JSON."""
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, fp)
+
+    def flush(self, force=True):
+        """Writes pending spans to the stream. Unless `force` is set, does so only if the batch
+        is full or due."""
+        if self._stream is None:
+            return
+        with self._lock:
+            if not force and len(self._pending) < self.batch_size \
+                    and time.time() - self._flushed_at < self.flush_interval:
+                return
+            self._flushed_at = time.time()
+            lines = []
+            while self._pending:
+                event = self._pending.popleft()
+                lines.append(json.dumps(event if isinstance(event, dict) else self._event(event)))
+            if lines:
+                self._stream.write(self._separator + '\n' + ',\n'.join(lines))
+                self._stream.flush()
+                self._separator = ','
+
+    def close(self):
+        if self._stream is not None:
+            self.flush()
+            with self._lock:
+                self._stream.write('[\n]\n' if self._separator == '[' else '\n]\n')
+                self._stream.close()
+                self._stream = None
@@ -0,0 +1,259 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+_log = logging.getLogger(__name__)
+
+# `get_transfers` categories: confirmed incoming and outgoing, unconfirmed incoming (`pool`)
+# and outgoing (`pending`)
+CONFIRMED = ('in', 'out')
+UNCONFIRMED = ('pool', 'pending')
+
+
+def transfer_key(transfer):
+    """Identifies a transfer of a wallet. A transaction may pay several subaddresses."""
+    index = transfer.get('subaddr_index') or {}
+    return '{}:{}:{}:{}'.format(
+        transfer['txid'], 'out' if transfer['type'] in ('out', 'pending') else 'in',
+        index.get('major', 0), index.get('minor', 0))
+
+
+class Cursor(object):
+    """Position of the transfer stream of a wallet: the `height` of the last delivered
+    confirmed transfers, the keys of transfers at that height and the keys of delivered
+    unconfirmed transfers."""
+
+    def __init__(self, height=0, keys=(), unconfirmed=()):
+        self.height = height
+        self.keys = set(keys)
+        self.unconfirmed = set(unconfirmed)
+
+    def advance(self, transfers):
+        """Returns transfers not delivered yet and the cursor after delivering them."""
+        new = []
+        cursor = Cursor(self.height, self.keys)
+        pool = set()
+        for transfer in transfers:
+            key = transfer_key(transfer)
+            if transfer['type'] in UNCONFIRMED:
+                pool.add(key)
+                if key not in self.unconfirmed:
+                    new.append(transfer)
+                continue
+            if transfer['height'] < self.height or \
+                    (transfer['height'] == self.height and key in self.keys):
+                continue
+            new.append(transfer)
+            if transfer['height'] > cursor.height:
+                cursor.height = transfer['height']
+                cursor.keys = set()
+            if transfer['height'] == cursor.height:
+                cursor.keys.add(key)
+        # forget transactions which have left the pool, either confirmed or dropped
+        cursor.unconfirmed = pool
+        return new, cursor
+
+
+class CursorStore(object):
+    """Keeps transfer cursors in SQLite database, or in memory if `path` is `None`."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path is None:
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cursors ('
+            'address TEXT PRIMARY KEY, height INTEGER, keys TEXT, unconfirmed TEXT)')
+        self._db.commit()
+        for address, height, keys, unconfirmed in self._db.execute('SELECT * FROM cursors'):
+            self._cursors[address] = Cursor(height, json.loads(keys), json.loads(unconfirmed))
+
+    def get(self, address):
+        return self._cursors.get(str(address)) or Cursor()
+
+    def update(self, cursors):
+        """Stores a dict of `address: Cursor`."""
+        with self._lock:
+            self._cursors.update((str(a), c) for a, c in cursors.items())
+            if self._db is None:
+                return
+            with self._db:
+                self._db.executemany('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)', [
+                    (str(a), c.height, json.dumps(sorted(c.keys)),
+                        json.dumps(sorted(c.unconfirmed)))
+                    for a, c in cursors.items()])
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+class CallbackSink(object):
+    """Passes each batch to a callable."""
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, batch):
+        self.callback(batch)
+
+    def close(self):
+        pass
+
+
+class JSONLSink(object):
+    """Appends transfers to a file, one JSON object per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def write(self, batch):
+        self._file.write(''.join(json.dumps(t, sort_keys=True) + '\n' for t in batch))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class SQLiteSink(object):
+    """Stores transfers in `transfers` table of SQLite database. Unconfirmed transfers get
+    replaced once confirmed, reverted ones get deleted."""
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS transfers ('
+            'key TEXT, address TEXT, txid TEXT, type TEXT, amount INTEGER, fee INTEGER, '
+            'height INTEGER, timestamp INTEGER, payment_id TEXT, confirmed INTEGER, data TEXT, '
+            'PRIMARY KEY (address, key))')
+        self._db.commit()
+
+    def write(self, batch):
+        with self._db:
+            for t in batch:
+                if t.get('reverted'):
+                    self._db.execute('DELETE FROM transfers WHERE address = ? AND key = ?',
+                            (t['address'], transfer_key(t)))
+                    continue
+                self._db.execute(
+                    'INSERT OR REPLACE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (transfer_key(t), t['address'], t['txid'], t['type'], t.get('amount'),
+                        t.get('fee'), t.get('height') or None, t.get('timestamp'),
+                        t.get('payment_id'), int(t['type'] in CONFIRMED),
+                        json.dumps(t, sort_keys=True)))
+
+    def close(self):
+        self._db.close()
+
+
+class TransferStream(object):
+    """Delivers transfers of synced wallets incrementally. For each wallet only transfers above
+    its cursor are requested from the wallet RPC, with a single `get_transfers` call, and
+    the unconfirmed ones are delivered once while in the pool and once again after being
+    confirmed. Transfers are the dicts returned by `get_transfers`, with `address` of the wallet
+    added and `type` one of `in`, `out`, `pool` and `pending`.
+
+    Transfers are buffered and written to all `sinks` (having `write(batch)` and `close()`
+    methods, see `CallbackSink`, `JSONLSink` and `SQLiteSink`) in batches of `batch_size`,
+    or older than `flush_interval` seconds. The cursors advance only after their transfers
+    have been written, so after a crash transfers may be delivered again but never lost.
+
+    Pass an instance as `transfers` argument of `WalletPool`, which makes the controllers
+    collect the transfers of each wallet before reporting it synced.
+    """
+    batch_size = 500
+    flush_interval = 5
+
+    def __init__(self, sinks=(), cursors=None, batch_size=None, flush_interval=None):
+        self.sinks = list(sinks)
+        self.cursors = cursors if cursors is not None else CursorStore()
+        self.batch_size = batch_size or self.batch_size
+        self.flush_interval = flush_interval if flush_interval is not None else self.flush_interval
+        self._buffer = []
+        self._pending_cursors = {}
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def fetch(self, backend, cursor):
+        """Requests the transfers above the cursor from a wallet RPC backend."""
+        result = backend.raw_request('get_transfers', {
+            'in': True, 'out': True, 'pool': True, 'pending': True,
+            'filter_by_height': True,
+            # the height filter is exclusive; refetch the cursor block to catch up on it
+            'min_height': max(cursor.height - 1, 0),
+            'all_accounts': True})
+        return [t for category in CONFIRMED + UNCONFIRMED for t in result.get(category, [])]
+
+    def _cursor(self, address):
+        with self._lock:
+            return self._pending_cursors.get(address) or self.cursors.get(address)
+
+    def collect(self, address, backend):
+        """Fetches new transfers of the wallet and queues them for the sinks. Returns the
+        list of new transfers."""
+        return self.deliver(address, self.fetch(backend, self._cursor(str(address))))
+
+    def deliver(self, address, transfers):
+        """Queues the transfers of the wallet not delivered yet for the sinks, e.g. those found
+        by `monerowalletpool.scanner.ViewKeyScanner`. Returns the list of new transfers."""
+        address = str(address)
+        transfers, cursor = self._cursor(address).advance(transfers)
+        for transfer in transfers:
+            transfer['address'] = address
+        with self._lock:
+            self._buffer.extend(transfers)
+            self._pending_cursors[address] = cursor
+            if self._oldest is None:
+                self._oldest = time.time()
+        self.flush(force=False)
+        return transfers
+
+    def revert(self, address, height, transfers):
+        """Queues the transfers of the wallet reverted by a chain reorganization at `height`
+        for the sinks, with `reverted` set, and rolls its cursor back, so the transfers of
+        the replacing blocks get delivered."""
+        address = str(address)
+        transfers = [dict(t, address=address, reverted=True) for t in transfers]
+        with self._lock:
+            cursor = self._pending_cursors.get(address) or self.cursors.get(address)
+            if cursor.height >= height:
+                cursor = Cursor(height, (), cursor.unconfirmed)
+            self._buffer.extend(transfers)
+            self._pending_cursors[address] = cursor
+            if self._oldest is None:
+                self._oldest = time.time()
+        self.flush(force=False)
+
+    def flush(self, force=True):
+        """Writes buffered transfers to the sinks and stores the cursors. Unless `force` is set,
+        does so only if the batch is full or due."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending_cursors or not force and len(self._buffer) < self.batch_size \
+                        and time.time() - self._oldest < self.flush_interval:
+                    return
+                buffer, self._buffer = self._buffer, []
+                cursors, self._pending_cursors = self._pending_cursors, {}
+                self._oldest = None
+            for start in range(0, len(buffer), self.batch_size):
+                batch = buffer[start:start + self.batch_size]
+                for sink in self.sinks:
+                    sink.write(batch)
+            self.cursors.update(cursors)
+            _log.debug('Delivered {} transfer(s) of {} wallet(s).'.format(
+                len(buffer), len(cursors)))
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+        self.cursors.close()
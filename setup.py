@@ -36,7 +36,7 @@ setup(
     setup_requires=[
         'pytest-runner',
     ],
-    packages = find_packages('.', exclude=['tests']),
+    packages = find_packages('.', exclude=['tests', 'benchmarks']),
     include_package_data = True,
     author = 'Michał Sałaban',
     author_email = 'michal@salaban.info',
@@ -1 +1,17 @@
 from . import test_monerowalletpool
+from . import test_checkpoints
+from . import test_metrics
+from . import test_benchmark
+from . import test_aio
+from . import test_concurrency
+from . import test_daemons
+from . import test_output
+from . import test_transfers
+from . import test_control
+from . import test_snapshots
+from . import test_shards
+from . import test_scanner
+from . import test_staging
+from . import test_supervisor
+from . import test_tracing
+from . import test_workers
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from monerowalletpool import WalletsManager
+from benchmarks.fakes import FakeDaemon, FAKE_WALLET_RPC, FAKE_WALLET_CLI
+
+
+class FakeDaemonTestCase(unittest.TestCase):
+    """Runs a fake daemon and a manager of the fake wallet binaries, keeping the wallets in
+    a temporary directory. The environment is restored after each test."""
+    daemon_height = 1000
+    block_time = 1000
+    payments_per_block = None
+    fake_env = {
+        'FAKE_STARTUP_DELAY': '0.05',
+        'FAKE_SYNC_SPEED': '1000',
+        'FAKE_FAILURE_RATE': '0',
+    }
+
+    def setUp(self):
+        self.set_env(**self.fake_env)
+        self.walletdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.walletdir.cleanup)
+        self.daemon = self.start_daemon(self.daemon_height)
+        self.manager = self.make_manager(self.daemon)
+
+    def set_env(self, **env):
+        """Sets the environment variables for the rest of the test."""
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def start_daemon(self, height):
+        daemon = FakeDaemon(height=height, block_time=self.block_time,
+                payments_per_block=self.payments_per_block)
+        daemon.start()
+        self.addCleanup(daemon.stop)
+        return daemon
+
+    def make_manager(self, daemon):
+        return WalletsManager(directory=self.walletdir.name, net='stagenet',
+                cmd_rpc=FAKE_WALLET_RPC, cmd_cli=FAKE_WALLET_CLI, log_dir=self.walletdir.name,
+                daemon_host='127.0.0.1', daemon_port=daemon.port)
@@ -0,0 +1,90 @@
+import asyncio
+
+from monerowalletpool import SyncScheduler, WALLET_CLOSED, WALLET_SYNCING
+from monerowalletpool.aio import AsyncWalletPool
+from benchmarks.bench_pool import make_wallets
+from .fixtures import FakeDaemonTestCase
+
+
+class CountingPool(AsyncWalletPool):
+    rpc_port_range = (28690, 28720)
+    tip_poll_interval = 0.5
+
+    def __init__(self, manager, target, **kwargs):
+        self.target = target
+        self.synced = []
+        self.closed = []
+        super(CountingPool, self).__init__(manager, **kwargs)
+
+    async def wallet_synced(self, ctrl):
+        self.synced.append(ctrl.address)
+        ctrl.shut_down = True
+        if len(self.synced) >= self.target:
+            self.stop()
+
+    async def wallet_closed(self, ctrl):
+        self.closed.append(ctrl)
+
+
+class AsyncPoolTestCase(FakeDaemonTestCase):
+    block_time = 1
+    payments_per_block = 0
+
+    def test_sync_wallets(self):
+        addresses = make_wallets(self.walletdir.name, 4, 950)
+        scheduler = SyncScheduler()
+        pool = CountingPool(self.manager, len(addresses), max_running=2, scheduler=scheduler,
+                daemon_host='127.0.0.1', daemon_port=self.daemon.port)
+        for address in addresses:
+            scheduler.add(address, height=950)
+        asyncio.run(asyncio.wait_for(pool.main_loop(), 60))
+        self.assertEqual(set(pool.synced), set(addresses))
+        self.assertEqual(pool.running, {})
+        self.assertEqual(len(pool.closed), len(addresses))
+        for ctrl in pool.closed:
+            self.assertEqual(ctrl.status, WALLET_CLOSED)
+            self.assertFalse(ctrl.is_alive())
+            self.assertGreaterEqual(ctrl.height, 999)
+
+    def test_stop_while_syncing(self):
+        self.set_env(FAKE_SYNC_SPEED='20')
+        addresses = make_wallets(self.walletdir.name, 2, 0)
+        scheduler = SyncScheduler()
+        pool = CountingPool(self.manager, len(addresses), max_running=2, scheduler=scheduler,
+                daemon_host='127.0.0.1', daemon_port=self.daemon.port)
+        for address in addresses:
+            scheduler.add(address, height=0)
+
+        async def run():
+            loop = asyncio.ensure_future(pool.main_loop())
+            while len([c for c in pool.running.values() if c.status == WALLET_SYNCING]) < 2:
+                await asyncio.sleep(0.05)
+            pool.stop()
+            await asyncio.wait_for(loop, 10)
+
+        asyncio.run(asyncio.wait_for(run(), 30))
+        self.assertEqual(pool.synced, [])
+        self.assertEqual(pool.running, {})
+        for ctrl in pool.closed:
+            self.assertEqual(ctrl.status, WALLET_CLOSED)
+            self.assertFalse(ctrl.is_alive())
+
+    def test_unknown_tip(self):
+        addresses = make_wallets(self.walletdir.name, 1, 0)
+        scheduler = SyncScheduler()
+        # no daemon there, the tip stays unknown
+        pool = CountingPool(self.manager, 1, max_running=1, scheduler=scheduler,
+                daemon_host='127.0.0.1', daemon_port=1)
+        scheduler.add(addresses[0], height=0)
+
+        async def run():
+            loop = asyncio.ensure_future(pool.main_loop())
+            while not [c for c in pool.running.values() if c.status == WALLET_SYNCING]:
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(1)
+            pool.stop()
+            await asyncio.wait_for(loop, 10)
+
+        asyncio.run(asyncio.wait_for(run(), 30))
+        self.assertEqual(pool.bc_height, 0)
+        self.assertEqual(pool.synced, [])
@@ -0,0 +1,48 @@
+import json
+import os
+import tempfile
+import unittest
+
+from benchmarks import bench_pool
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def test_worker_pool(self):
+        result = bench_pool.main([
+            '--wallets', '6', '--max-running', '2', '--duration', '4', '--workers',
+            '--block-time', '1', '--startup-delay', '0.05', '--port-base', '28590'])
+        self.assertGreater(result['synced'], 0)
+        self.assertGreater(result['wallets_per_hour'], 0)
+
+    def test_drain(self):
+        result = bench_pool.main([
+            '--wallets', '4', '--max-running', '2', '--duration', '2', '--behind', '50000',
+            '--block-time', '1', '--startup-delay', '0.05', '--port-base', '28630'])
+        self.assertEqual(result['synced'], 0)
+        self.assertEqual(result['drained'], 2)
+        self.assertLess(result['drain_seconds'], 5)
+
+    def test_spares(self):
+        result = bench_pool.main([
+            '--wallets', '6', '--max-running', '2', '--duration', '4', '--spares', '2',
+            '--block-time', '1', '--startup-delay', '0.05', '--port-base', '28650'])
+        self.assertGreater(result['synced'], 0)
+
+    def test_staging(self):
+        result = bench_pool.main([
+            '--wallets', '4', '--max-running', '2', '--duration', '3', '--staging',
+            '--io-budget', '1', '--block-time', '1', '--startup-delay', '0.05',
+            '--port-base', '28760'])
+        self.assertGreater(result['synced'], 0)
+
+    def test_trace(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace.json')
+            result = bench_pool.main([
+                '--wallets', '4', '--max-running', '2', '--duration', '3', '--trace', path,
+                '--block-time', '1', '--startup-delay', '0.05', '--port-base', '28810'])
+            with open(path) as fp:
+                phases = set(event['name'] for event in json.load(fp))
+        self.assertGreater(result['synced'], 0)
+        self.assertTrue(set(['spawn', 'rpc_ready', 'address_check', 'sync_wait', 'handler',
+                'close']) <= phases)
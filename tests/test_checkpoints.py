@@ -0,0 +1,61 @@
+import os
+import tempfile
+import time
+import unittest
+
+from monerowalletpool.checkpoints import CheckpointStore
+
+
+class CheckpointStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dbdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dbdir.name, 'checkpoints.sqlite')
+
+    def tearDown(self):
+        self.dbdir.cleanup()
+
+    def test_persistence(self):
+        store = CheckpointStore(self.path)
+        store.opened('addr1', when=100.0)
+        store.synced('addr1', 1500, 12.5, when=112.5)
+        store.failed('addr2')
+        store.failed('addr2')
+        store.close()
+
+        store = CheckpointStore(self.path)
+        self.assertEqual(len(store), 2)
+        cp = store.get('addr1')
+        self.assertEqual(cp.height, 1500)
+        self.assertEqual(cp.sync_duration, 12.5)
+        self.assertEqual(cp.opened_at, 100.0)
+        self.assertEqual(cp.synced_at, 112.5)
+        self.assertEqual(cp.failures, 0)
+        self.assertEqual(store.get('addr2').failures, 2)
+        self.assertIsNone(store.get('addr2').height)
+        self.assertIsNone(store.get('addr3'))
+        store.close()
+
+    def test_sync_resets_failures(self):
+        store = CheckpointStore(self.path)
+        store.failed('addr1')
+        store.synced('addr1', 10, 1.0)
+        self.assertEqual(store.get('addr1').failures, 0)
+        store.close()
+
+    def test_progress(self):
+        store = CheckpointStore(self.path)
+        store.synced('addr1', 10, 1.0, when=50.0)
+        store.progress('addr1', 20)
+        cp = store.get('addr1')
+        self.assertEqual(cp.height, 20)
+        self.assertEqual(cp.synced_at, 50.0)
+        store.close()
+
+    def test_background_flush(self):
+        store = CheckpointStore(self.path, flush_interval=0.05)
+        store.synced('addr1', 10, 1.0)
+        time.sleep(0.3)
+        reader = CheckpointStore(self.path)
+        self.assertEqual(reader.get('addr1').height, 10)
+        reader.close()
+        store.close()
@@ -0,0 +1,90 @@
+import unittest
+
+from monerowalletpool.concurrency import AdaptiveConcurrency
+
+
+class FakeTip(object):
+    latency = 0.01
+
+
+class HeightController(object):
+    def __init__(self, height):
+        self.height = height
+
+
+class FakePool(object):
+    def __init__(self, running, max_running):
+        self.tip = FakeTip()
+        self.running = dict((i, None) for i in range(running))
+        self.max_running = max_running
+
+
+class AdaptiveConcurrencyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cc = AdaptiveConcurrency(floor=2, ceiling=10, interval=10,
+                max_load=None, min_memory=None)
+
+    def test_additive_increase(self):
+        self.assertEqual(self.cc.limit, 2)
+        self.assertEqual(self.cc.adjust(100), 3)
+        self.assertEqual(self.cc.adjust(150), 4)
+        self.assertEqual(self.cc.adjust(200), 5)
+
+    def test_ceiling(self):
+        for i in range(20):
+            self.cc.adjust(100 + i)
+        self.assertEqual(self.cc.limit, 10)
+
+    def test_hold_when_not_saturated(self):
+        self.assertEqual(self.cc.adjust(100, saturated=False), 2)
+
+    def test_decrease_on_throughput_drop(self):
+        self.cc.limit = 8
+        self.assertEqual(self.cc.adjust(200), 9)
+        self.assertEqual(self.cc.adjust(150), 6)
+        # no growth happened last time, so a drop does not count against the limit
+        self.assertEqual(self.cc.adjust(100), 7)
+
+    def test_decrease_on_overload(self):
+        cc = AdaptiveConcurrency(floor=1, ceiling=10, start=8, max_load=1.0,
+                min_memory=1024, max_latency=1.0)
+        self.assertEqual(cc.adjust(100, load=2.0), 6)
+        self.assertEqual(cc.adjust(100, memory=512), 4)
+        self.assertEqual(cc.adjust(100, latency=5), 3)
+        self.assertEqual(cc.adjust(100, latency=5), 2)
+        self.assertEqual(cc.adjust(100, latency=5), 1)
+        self.assertEqual(cc.adjust(100, latency=5), 1)
+        self.assertEqual(cc.adjust(100, load=0.5, memory=4096, latency=0.1), 2)
+
+    def test_update_window(self):
+        pool = FakePool(2, 2)
+        self.assertIsNone(self.cc.update(pool, now=1000))
+        self.cc.scanned(500)
+        self.assertIsNone(self.cc.update(pool, now=1005))
+        self.cc.scanned(500)
+        self.assertEqual(self.cc.update(pool, now=1010), 3)
+        self.assertEqual(self.cc.throughput, 100)
+        pool.tip.latency = 10
+        self.assertEqual(self.cc.update(pool, now=1020), 2)
+        self.assertEqual(self.cc.throughput, 0)
+
+    def test_sampled_progress(self):
+        pool = FakePool(0, 1)
+        ctrl = pool.running['a'] = HeightController(None)
+        self.assertIsNone(self.cc.update(pool, now=1000))
+        ctrl.height = 100
+        self.assertIsNone(self.cc.update(pool, now=1005))
+        # the progress of a long sync counts in the window it's made in
+        ctrl.height = 600
+        self.assertEqual(self.cc.update(pool, now=1010), 3)
+        self.assertEqual(self.cc.throughput, 50)
+        # as does that of a closed wallet
+        ctrl.height = 800
+        del pool.running['a']
+        self.cc.finished(ctrl)
+        self.cc.update(pool, now=1020)
+        self.assertEqual(self.cc.throughput, 20)
+
+    def test_invalid_range(self):
+        with self.assertRaises(ValueError):
+            AdaptiveConcurrency(floor=5, ceiling=2)
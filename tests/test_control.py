@@ -0,0 +1,90 @@
+import http.client
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+from monerowalletpool import WalletsManager, WALLET_SYNCED
+from monerowalletpool.control import ControlServer
+from monerowalletpool.snapshots import SnapshotCache, WalletSnapshot
+from .test_monerowalletpool import RequestPool
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(UnixHTTPConnection, self).__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+class ControlServerTestCase(unittest.TestCase):
+    address = '548wjYLqNPdNcSPFk3xLSZNGLLHWkwZdvikDftDqeXHJdNZRkh6hNtd9NwVsKeNvAZNwooxGbPa7yZr4tpteBwpHLwnZ6gV'
+
+    def setUp(self):
+        self.walletdir = tempfile.TemporaryDirectory()
+        self.pool = RequestPool(WalletsManager(directory=self.walletdir.name), max_running=2)
+        self.server = ControlServer(self.pool, port=0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.walletdir.cleanup()
+
+    def request(self, method, path, body=None, conn=None):
+        conn = conn or http.client.HTTPConnection('127.0.0.1', self.server.port, timeout=5)
+        conn.request(method, path, json.dumps(body) if body is not None else None)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_sync_without_waiting(self):
+        status, result = self.request('POST', '/sync', {'address': self.address, 'priority': 3})
+        self.assertEqual(status, 202)
+        self.pool.handle_requests()
+        self.assertEqual(self.pool.running[self.address].priority, 3)
+        status, result = self.request('GET', '/status')
+        self.assertEqual(result['wallets'][0]['address'], self.address)
+
+    def test_sync_waiting(self):
+        self.pool.start_controller(self.address)
+        self.pool.running[self.address].status = WALLET_SYNCED
+        self.pool.running[self.address].height = 100
+        # the pool loop is not running here, handle the request once queued
+        orig_put = self.pool._requests.put
+        def put(request):
+            orig_put(request)
+            self.pool.handle_requests()
+        self.pool._requests.put = put
+        status, result = self.request('POST', '/sync',
+                {'address': self.address, 'wait': True, 'deadline': 5})
+        self.assertEqual((status, result['status'], result['height']), (200, WALLET_SYNCED, 100))
+
+    def test_snapshot(self):
+        status, result = self.request('GET', '/wallets/' + self.address)
+        self.assertEqual(status, 404)
+        self.pool.snapshots = SnapshotCache()
+        self.pool.snapshots.put(WalletSnapshot(self.address, 100, 7, 5))
+        status, result = self.request('GET', '/wallets/' + self.address)
+        self.assertEqual((status, result['height'], result['balance']), (200, 100, 7))
+        self.assertGreaterEqual(result['staleness'], 0)
+        self.assertEqual(self.pool.running, {})
+
+    def test_invalid(self):
+        status, result = self.request('POST', '/sync', {'address': 'nonsense'})
+        self.assertEqual(status, 400)
+        status, result = self.request('POST', '/sync', {})
+        self.assertEqual(status, 400)
+
+    def test_unix_socket(self):
+        path = os.path.join(self.walletdir.name, 'control.sock')
+        server = ControlServer(self.pool, path=path)
+        server.start()
+        try:
+            status, result = self.request('GET', '/status', conn=UnixHTTPConnection(path))
+            self.assertEqual((status, result['wallets']), (200, []))
+        finally:
+            server.stop()
+        self.assertFalse(os.path.exists(path))
@@ -0,0 +1,108 @@
+import tempfile
+import unittest
+
+from monerowalletpool import (CommunicationError, WalletsManager, WalletPool, WalletController,
+        TipTracker, WALLET_SYNCING)
+from monerowalletpool.daemons import DaemonBalancer
+from benchmarks.fakes import FakeDaemon
+from .test_monerowalletpool import HeightWallet
+
+
+class SwitchingController(object):
+    worker = None
+    port = None
+    height = None
+    sync_time = None
+
+    def __init__(self, address, node, status=WALLET_SYNCING):
+        self.address = address
+        self.node = node
+        self.status = status
+        self.switched = []
+
+    def switch_daemon(self, node):
+        self.switched.append(node)
+
+    def join(self):
+        pass
+
+
+class DaemonBalancerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.daemons = [FakeDaemon(height=1000, block_time=1000) for i in range(3)]
+        for daemon in self.daemons:
+            daemon.start()
+        self.balancer = DaemonBalancer(
+            ['127.0.0.1:{}'.format(d.port) for d in self.daemons], timeout=1)
+
+    def tearDown(self):
+        for daemon in self.daemons:
+            daemon.stop()
+        self.balancer.close()
+
+    def test_least_loaded(self):
+        self.assertEqual(self.balancer.check(), 1000)
+        nodes = [self.balancer.acquire() for i in range(6)]
+        self.assertEqual(sorted(n.load for n in self.balancer.nodes), [2, 2, 2])
+        self.balancer.release(nodes[0])
+        self.assertIs(self.balancer.acquire(), nodes[0])
+
+    def test_lagging(self):
+        self.daemons[1].start_height = 990
+        self.assertEqual(self.balancer.check(), 1000)
+        self.assertEqual([n.healthy for n in self.balancer.nodes], [True, False, True])
+        for i in range(4):
+            self.assertIsNot(self.balancer.acquire(), self.balancer.nodes[1])
+        self.daemons[1].start_height = 999
+        self.balancer.check()
+        self.assertTrue(self.balancer.nodes[1].healthy)
+
+    def test_failover(self):
+        self.daemons[0].stop()
+        self.assertEqual(self.balancer.check(), 1000)
+        self.assertFalse(self.balancer.nodes[0].healthy)
+        self.assertEqual(self.balancer.nodes[0].failures, 1)
+        for daemon in self.daemons[1:]:
+            daemon.stop()
+        with self.assertRaises(CommunicationError):
+            self.balancer.check()
+        self.assertEqual(self.balancer.acquire().load, 1)
+        self.daemons = []
+
+    def test_lagging_node_synced(self):
+        self.daemons[1].start_height = 998
+        tip = TipTracker(balancer=self.balancer)
+        self.assertEqual(tip.poll(), 1000)
+        node = self.balancer.nodes[1]
+        self.assertTrue(node.healthy)
+        with tempfile.TemporaryDirectory() as walletdir:
+            ctrl = WalletController('a', 0, WalletsManager(directory=walletdir), tip=tip,
+                    node=node)
+        # as high as the node it syncs from gets, 2 blocks behind the tip
+        ctrl.wallet = HeightWallet(998)
+        ctrl.sync_max_sleep = 0.05
+        self.assertTrue(ctrl.sync())
+
+    def test_tip_tracker(self):
+        tip = TipTracker(balancer=self.balancer)
+        self.assertEqual(tip.poll(), 1000)
+        self.assertIsNotNone(tip.latency)
+
+    def test_rebalance(self):
+        with tempfile.TemporaryDirectory() as walletdir:
+            pool = WalletPool(WalletsManager(directory=walletdir), daemons=self.balancer)
+            self.balancer.check()
+            first = self.balancer.acquire()
+            ctrl = SwitchingController('a', first)
+            pool.running = {'a': ctrl}
+            pool.rebalance()
+            self.assertEqual(ctrl.switched, [])
+            self.daemons.pop(self.balancer.nodes.index(first)).stop()
+            self.balancer.check()
+            pool.rebalance()
+            self.assertEqual(len(ctrl.switched), 1)
+            self.assertIsNot(ctrl.node, first)
+            self.assertEqual(first.load, 0)
+            self.assertEqual(ctrl.node.load, 1)
+            pool.remove_controller(ctrl)
+            self.assertEqual(sum(n.load for n in self.balancer.nodes), 0)
@@ -0,0 +1,65 @@
+import datetime
+import tempfile
+import unittest
+import urllib.request
+
+from monerowalletpool import WalletsManager, WalletPool, WALLET_SYNCING, WALLET_SYNCED, WALLET_CLOSED
+from monerowalletpool.metrics import Counter, Histogram, PoolMetrics, MetricsServer
+
+
+class DummyController(object):
+    ready_time = datetime.timedelta(seconds=0.3)
+    sync_time = datetime.timedelta(seconds=42)
+    scan_rate = 120.0
+
+    def __init__(self, status):
+        self.status = status
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_histogram(self):
+        hist = Histogram('test_seconds', 'Test.', [1, 5])
+        hist.observe(0.5)
+        hist.observe(1)
+        hist.observe(7)
+        self.assertEqual(hist.render().splitlines(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{le="1.0"} 2.0',
+            'test_seconds_bucket{le="5.0"} 2.0',
+            'test_seconds_bucket{le="+Inf"} 3.0',
+            'test_seconds_sum 8.5',
+            'test_seconds_count 3.0'])
+
+    def test_counter(self):
+        counter = Counter('test_events', 'Test.')
+        counter.inc(2)
+        self.assertEqual(counter.render().splitlines(), [
+            '# HELP test_events_total Test.',
+            '# TYPE test_events_total counter',
+            'test_events_total 2.0'])
+
+    def test_pool_metrics(self):
+        metrics = PoolMetrics()
+        with tempfile.TemporaryDirectory() as walletdir:
+            pool = WalletPool(WalletsManager(directory=walletdir), max_running=4, metrics=metrics)
+        pool.running = {'a': DummyController(WALLET_SYNCING), 'b': DummyController(WALLET_SYNCED)}
+        metrics.controller_finished(DummyController(WALLET_CLOSED))
+        text = metrics.render()
+        self.assertIn('monerowalletpool_controllers{state="syncing"} 1.0', text)
+        self.assertIn('monerowalletpool_controllers{state="failed"} 0.0', text)
+        self.assertIn('monerowalletpool_slot_utilization 0.5', text)
+        self.assertIn('monerowalletpool_wallets_synced_total 1.0', text)
+        self.assertIn('monerowalletpool_sync_seconds_bucket{le="60.0"} 1.0', text)
+        self.assertIn('monerowalletpool_scan_blocks_per_second_sum 120.0', text)
+
+    def test_server(self):
+        metrics = PoolMetrics()
+        server = MetricsServer(metrics, port=0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.port)
+            with urllib.request.urlopen(url) as rsp:
+                self.assertIn(b'monerowalletpool_slots 0.0', rsp.read())
+        finally:
+            server.stop()
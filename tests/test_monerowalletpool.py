@@ -1,8 +1,19 @@
+import datetime
+import io
 import os
+import queue
+import socket
 import tempfile
+import threading
+import time
 import unittest
 
-from monerowalletpool import WalletsManager, WalletCreationError
+import monero.address
+from monerowalletpool import (WalletsManager, WalletPool, WalletController, WalletCreationError,
+        CommunicationError, AddressMismatchError, PortAllocator,
+        SyncScheduler, SyncRequest, TipTracker, DateHeightIndex, WalletIndex, backoff,
+        read_wallet_records, WALLET_CREATING, WALLET_SYNCING, WALLET_SYNCED, WALLET_CLOSING, WALLET_CLOSED,
+        WALLET_FAILED)
 
 class CreateManagers(object):
     def setUp(self):
@@ -87,3 +98,468 @@ class CreateInvalidTestCase(CreateManagers, unittest.TestCase):
             self.testnet_mgr.create_wallet,
             'A1fXttm6hSXKjpPwTQjQac7kJSiSDPKWeCaHCtDtaeenSN3cZiVxsFuMz6cLAQvL3QiQetyEfDGoKRAK5rNm1dLLEWBgqeH',
             '1111111111111111111111111111111111111111111111111111111111111111')
+
+
+class SyncSchedulerTestCase(unittest.TestCase):
+    def test_most_behind_first(self):
+        sched = SyncScheduler(time_weight=0)
+        sched.add('a', height=900)
+        sched.add('b', height=100)
+        sched.add('c')
+        sched.set_tip(1000)
+        self.assertEqual(sched.pop(), 'c')
+        self.assertEqual(sched.pop(), 'b')
+        self.assertEqual(sched.pop(), 'a')
+        self.assertIsNone(sched.pop())
+
+    def test_weight(self):
+        sched = SyncScheduler(time_weight=0)
+        sched.add('a', height=500)
+        sched.add('b', weight=10.0, height=900)
+        sched.set_tip(1000)
+        self.assertEqual(sched.pop(), 'b')
+        self.assertEqual(sched.pop(), 'a')
+
+    def test_time_since_sync(self):
+        sched = SyncScheduler(block_weight=0)
+        sched.add('a', synced_at=time.time() - 10)
+        sched.add('b', synced_at=time.time() - 1000)
+        self.assertEqual(sched.pop(), 'b')
+
+    def test_skip_synced_until_tip_moves(self):
+        sched = SyncScheduler()
+        sched.set_tip(1000)
+        sched.add('a', height=1000)
+        sched.add('b', height=10)
+        self.assertEqual(sched.pop(), 'b')
+        self.assertIsNone(sched.pop())
+        sched.done('b', height=1000)
+        self.assertIsNone(sched.pop())
+        sched.set_tip(1001)
+        self.assertEqual(set([sched.pop(), sched.pop()]), set(['a', 'b']))
+        self.assertIsNone(sched.pop())
+
+    def test_checked_out(self):
+        sched = SyncScheduler()
+        sched.add('a')
+        self.assertEqual(sched.pop(), 'a')
+        self.assertEqual(len(sched), 0)
+        sched.add('a', weight=2.0)
+        self.assertIsNone(sched.pop())
+        sched.done('a')
+        self.assertEqual(len(sched), 1)
+        self.assertEqual(sched.pop(), 'a')
+
+    def test_checkout(self):
+        sched = SyncScheduler()
+        sched.add('a')
+        sched.add('b', height=10)
+        sched.checkout('a')
+        self.assertEqual(sched.pop(), 'b')
+        self.assertIsNone(sched.pop())
+        sched.done('a')
+        self.assertEqual(sched.pop(), 'a')
+
+    def test_requeue_keeps_staleness(self):
+        sched = SyncScheduler(block_weight=0)
+        sched.add('a', synced_at=time.time() - 1000)
+        sched.add('b', synced_at=time.time() - 10)
+        self.assertEqual(sched.pop(), 'a')
+        # not synced, so it stays the most stale
+        sched.requeue('a')
+        self.assertEqual(sched.pop(), 'a')
+        sched.done('a')
+        self.assertEqual(sched.pop(), 'b')
+
+
+class DummyController(object):
+    worker = None
+    port = None
+    node = None
+    height = None
+    sync_time = None
+    priority = 0
+    shut_down = False
+    error = None
+
+    def __init__(self, address, status):
+        self.address = address
+        self.status = status
+
+    def join(self):
+        pass
+
+
+class EventPool(WalletPool):
+    def __init__(self, *args, **kwargs):
+        self.handled = []
+        super(EventPool, self).__init__(*args, **kwargs)
+
+    def wallet_synced(self, ctrl):
+        self.handled.append(('synced', ctrl.address))
+
+    def wallet_closed(self, ctrl):
+        self.handled.append(('closed', ctrl.address))
+
+
+class PoolEventsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.walletdir = tempfile.TemporaryDirectory()
+        self.pool = EventPool(WalletsManager(directory=self.walletdir.name))
+        self.pool.main_loop_sleep_time = 0.01
+
+    def tearDown(self):
+        self.walletdir.cleanup()
+
+    def test_events(self):
+        ctrl_a = DummyController('a', WALLET_SYNCED)
+        ctrl_b = DummyController('b', WALLET_CLOSED)
+        self.pool.running = {'a': ctrl_a, 'b': ctrl_b}
+        self.pool._events.put((ctrl_a, WALLET_SYNCED))
+        self.pool._events.put((ctrl_b, WALLET_CLOSED))
+        for ctrl, status in self.pool.wait_events():
+            self.pool.handle_event(ctrl, status)
+        self.assertEqual(self.pool.handled, [('synced', 'a'), ('closed', 'b')])
+        self.assertEqual(list(self.pool.running), ['a'])
+        self.assertEqual(self.pool.wait_events(), [])
+
+    def test_stale_synced_event(self):
+        ctrl = DummyController('a', WALLET_CLOSING)
+        self.pool.running = {'a': ctrl}
+        self.pool.handle_event(ctrl, WALLET_SYNCED)
+        self.assertEqual(self.pool.handled, [])
+
+    def test_stop(self):
+        self.pool.next_addr = lambda: None
+        # as from a signal handler, only asks the main loop to drain
+        threading.Timer(0.1, self.pool.stop).start()
+        with self.assertRaises(SystemExit):
+            self.pool.main_loop()
+        self.assertTrue(self.pool.draining)
+
+
+class RequestPool(WalletPool):
+    def start_controller(self, address, priority=0):
+        ctrl = self.running[address] = DummyController(address, WALLET_SYNCING)
+        ctrl.priority = priority
+        return ctrl
+
+
+class SyncRequestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.walletdir = tempfile.TemporaryDirectory()
+        self.pool = RequestPool(WalletsManager(directory=self.walletdir.name), max_running=2)
+
+    def tearDown(self):
+        self.walletdir.cleanup()
+
+    def test_free_slot(self):
+        request = self.pool.request_sync('a', priority=5)
+        self.pool.handle_requests()
+        ctrl = self.pool.running['a']
+        self.assertEqual(ctrl.priority, 5)
+        self.assertFalse(request.resolved)
+        ctrl.status = WALLET_SYNCED
+        ctrl.height = 100
+        self.pool.handle_event(ctrl, WALLET_SYNCED)
+        self.assertEqual((request.status, request.height), (WALLET_SYNCED, 100))
+        self.assertEqual(self.pool.sync_requests, {})
+
+    def test_attach_to_running(self):
+        self.pool.start_controller('a')
+        request = self.pool.request_sync('a', priority=3)
+        self.pool.handle_requests()
+        self.assertEqual(list(self.pool.running), ['a'])
+        self.assertEqual(self.pool.running['a'].priority, 3)
+        self.pool.running['a'].status = WALLET_FAILED
+        self.pool.handle_event(self.pool.running['a'], WALLET_FAILED)
+        self.assertEqual(request.status, WALLET_FAILED)
+
+    def test_already_synced(self):
+        self.pool.start_controller('a').status = WALLET_SYNCED
+        request = self.pool.request_sync('a')
+        self.pool.handle_requests()
+        self.assertEqual(request.status, WALLET_SYNCED)
+
+    def test_preemption(self):
+        self.pool.start_controller('a', priority=0)
+        self.pool.start_controller('b', priority=2)
+        request = self.pool.request_sync('c', priority=1)
+        self.pool.handle_requests()
+        self.assertTrue(self.pool.running['a'].shut_down)
+        self.assertFalse(self.pool.running['b'].shut_down)
+        # doesn't preempt again while the victim is closing
+        self.pool.request_sync('d', priority=1)
+        self.pool.handle_requests()
+        self.assertFalse(self.pool.running['b'].shut_down)
+        self.pool.running['a'].status = WALLET_CLOSED
+        self.pool.handle_event(self.pool.running['a'], WALLET_CLOSED)
+        self.pool.handle_requests()
+        self.assertEqual(sorted(self.pool.running), ['b', 'c'])
+        self.assertFalse(request.resolved)
+
+    def test_no_preemption_while_creating(self):
+        self.pool.start_controller('a', priority=0).status = WALLET_CREATING
+        self.pool.start_controller('b', priority=0)
+        self.pool.request_sync('c', priority=1)
+        self.pool.handle_requests()
+        self.assertFalse(self.pool.running['a'].shut_down)
+        self.assertTrue(self.pool.running['b'].shut_down)
+
+    def test_deadline(self):
+        self.pool.start_controller('a', priority=5)
+        self.pool.start_controller('b', priority=5)
+        request = self.pool.request_sync('c', deadline=-1)
+        self.pool.handle_requests()
+        self.assertEqual(request.status, SyncRequest.EXPIRED)
+        self.assertNotIn('c', self.pool.running)
+
+    def test_draining(self):
+        request = self.pool.request_sync('a')
+        self.pool.draining = True
+        self.pool.handle_requests()
+        self.assertEqual(request.status, WALLET_CLOSED)
+
+
+class PortAllocatorTestCase(unittest.TestCase):
+    def test_skip_used(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        try:
+            ports = PortAllocator(port, port + 2)
+            self.assertEqual(ports.acquire(), port + 1)
+            with self.assertRaises(CommunicationError):
+                ports.acquire()
+            ports.release(port + 1)
+            self.assertEqual(ports.acquire(), port + 1)
+        finally:
+            sock.close()
+
+    def test_release_to_end(self):
+        ports = PortAllocator(28740, 28743)
+        first = ports.acquire()
+        ports.release(first)
+        self.assertEqual([ports.acquire() for i in range(3)], [28741, 28742, 28740])
+        self.assertEqual(len(ports), 0)
+
+
+class TipTrackerTestCase(unittest.TestCase):
+    def test_update(self):
+        tip = TipTracker()
+        heights = []
+        tip.subscribe(heights.append)
+        self.assertTrue(tip.update(100))
+        self.assertFalse(tip.update(100))
+        self.assertTrue(tip.update(101))
+        self.assertEqual(heights, [100, 101])
+
+    def test_wait_for_change(self):
+        tip = TipTracker()
+        tip.update(100)
+        self.assertEqual(tip.wait_for_change(100, timeout=0.01), 100)
+        threading.Timer(0.05, tip.update, args=(101,)).start()
+        self.assertEqual(tip.wait_for_change(100, timeout=5), 101)
+
+
+    def test_unknown_tip(self):
+        # no daemon there, the first poll fails
+        tip = TipTracker(daemon_port=1)
+        self.assertEqual(tip.poll(), 0)
+        with tempfile.TemporaryDirectory() as walletdir:
+            ctrl = WalletController('a', 0, WalletsManager(directory=walletdir), tip=tip)
+        ctrl.wallet = HeightWallet(100)
+        ctrl.sync_max_sleep = 0.05
+        result = []
+        thread = threading.Thread(target=lambda: result.append(ctrl.sync()))
+        thread.start()
+        thread.join(0.3)
+        # not reported synced against the unknown tip
+        self.assertEqual(result, [])
+        tip.update(101)
+        thread.join(5)
+        self.assertEqual(result, [True])
+
+
+    def test_shut_down_wakes_sync(self):
+        tip = TipTracker(daemon_port=1)
+        tip.update(200)
+        with tempfile.TemporaryDirectory() as walletdir:
+            ctrl = WalletController('a', 0, WalletsManager(directory=walletdir), tip=tip)
+        ctrl.wallet = HeightWallet(100)
+        ctrl.sync_min_sleep = ctrl.sync_max_sleep = 60
+        result = []
+        thread = threading.Thread(target=lambda: result.append(ctrl.sync()))
+        thread.start()
+        time.sleep(0.1)
+        started = time.time()
+        ctrl.shut_down = True
+        thread.join(5)
+        self.assertEqual(result, [False])
+        self.assertLess(time.time() - started, 1)
+
+    def test_address_mismatch(self):
+        events = queue.Queue()
+        with tempfile.TemporaryDirectory() as walletdir:
+            ctrl = WalletController('a', 0, WalletsManager(directory=walletdir),
+                    tip=TipTracker(daemon_port=1), events=events)
+        ctrl._spawn_time = time.time()
+        with self.assertRaises(AddressMismatchError):
+            ctrl.check_wallet(AddressWallet('b'))
+        # the failure is published by closing, after the RPC server has stopped
+        self.assertTrue(events.empty())
+
+class HeightWallet(object):
+    def __init__(self, height):
+        self._height = height
+
+    def height(self):
+        return self._height
+
+
+class AddressWallet(object):
+    def __init__(self, address):
+        self._address = address
+
+    def address(self):
+        return self._address
+
+
+class BackoffTestCase(unittest.TestCase):
+    def test_backoff(self):
+        self.assertEqual(list(backoff(1, 4, timeout=20)), [1, 2, 4, 4, 4, 4])
+        self.assertEqual(list(backoff(0.5, 10, factor=3, timeout=6)), [0.5, 1.5])
+
+    def test_sync_delay(self):
+        with tempfile.TemporaryDirectory() as walletdir:
+            ctrl = WalletController('a', 18090, WalletsManager(directory=walletdir))
+        ctrl.height = 100
+        self.assertEqual(ctrl.sync_delay(1000, now=10.0), ctrl.sync_min_sleep)
+        # no progress, back off
+        self.assertEqual(ctrl.sync_delay(1000, now=11.0), ctrl.sync_min_sleep * 2)
+        # 100 blocks per second with 9 blocks to go
+        ctrl.height = 890
+        self.assertEqual(ctrl.sync_delay(900, now=18.9), ctrl.sync_min_sleep)
+        # 10 blocks per second with 99 blocks to go
+        ctrl.height = 900
+        self.assertAlmostEqual(ctrl.sync_delay(1000, now=19.9), 9.9)
+        # far behind, capped
+        ctrl.height = 910
+        self.assertEqual(ctrl.sync_delay(100000, now=20.9), ctrl.sync_max_sleep)
+
+
+class FakeChainDaemon(object):
+    genesis = 1500000000    # 2017-07-14 02:40 UTC
+
+    def __init__(self, height):
+        self._height = height
+        self.requests = 0
+
+    def height(self):
+        return self._height
+
+    def headers(self, start_height, end_height=None):
+        self.requests += 1
+        return [{'height': start_height, 'timestamp': self.genesis + 120 * start_height}]
+
+
+class DateHeightIndexTestCase(unittest.TestCase):
+    def test_height(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dates.json')
+            index = DateHeightIndex(path=path, margin=0)
+            index.daemon = FakeChainDaemon(1000000)
+            # 2017-07-15 00:00 UTC is 76800 s after genesis, the last block before is 639
+            self.assertEqual(index.height(datetime.date(2017, 7, 15)), 639)
+            requests = index.daemon.requests
+            self.assertEqual(index.height(datetime.date(2017, 7, 15)), 639)
+            self.assertEqual(index.daemon.requests, requests)
+            self.assertEqual(index.height(datetime.date(2017, 7, 1)), 0)
+            self.assertEqual(index.height(datetime.date(2030, 1, 1)), 999999)
+
+            index = DateHeightIndex(path=path, margin=100)
+            index.daemon = FakeChainDaemon(1000000)
+            self.assertEqual(index.height(datetime.date(2017, 7, 15)), 539)
+            self.assertEqual(index.daemon.requests, 0)
+
+    def test_restore_height(self):
+        with tempfile.TemporaryDirectory() as walletdir:
+            mgr = WalletsManager(directory=walletdir)
+            self.assertEqual(mgr.restore_height(None), 0)
+            self.assertEqual(mgr.restore_height(1234), 1234)
+
+
+class BulkCreateTestCase(unittest.TestCase):
+    stagenet_addr = '548wjYLqNPdNcSPFk3xLSZNGLLHWkwZdvikDftDqeXHJdNZRkh6hNtd9NwVsKeNvAZNwooxGbPa7yZr4tpteBwpHLwnZ6gV'
+    stagenet_key = '36307366e846ee42110e2fa75a04f9e38f6bf49839da79f96568deae7cfaec0b'
+
+    def test_read_records(self):
+        stream = io.StringIO(
+            'address,viewkey,spendkey,restore_height\n'
+            '{},{},,1000\n'
+            '\n'
+            '{{"address": "{}", "viewkey": "{}", "restore_height": "2019-01-02"}}\n'.format(
+                self.stagenet_addr, self.stagenet_key, self.stagenet_addr, self.stagenet_key))
+        records = list(read_wallet_records(stream))
+        self.assertEqual(records, [
+            (self.stagenet_addr, self.stagenet_key, None, 1000),
+            (self.stagenet_addr, self.stagenet_key, None, datetime.date(2019, 1, 2))])
+
+    def test_skip_existing(self):
+        with tempfile.TemporaryDirectory() as walletdir:
+            mgr = WalletsManager(directory=walletdir, net='stagenet')
+            open(os.path.join(walletdir, '{}.keys'.format(self.stagenet_addr)), 'w').close()
+            done = []
+            result = mgr.bulk_create(
+                [(self.stagenet_addr, self.stagenet_key, None, None)],
+                progress=lambda *args: done.append(args))
+            self.assertEqual(result.skipped, [self.stagenet_addr])
+            self.assertEqual(result.created, [])
+            self.assertEqual(done, [(self.stagenet_addr, 'skipped', 1)])
+
+
+class WalletIndexTestCase(CreateManagers, unittest.TestCase):
+    mainnet_addr = '4ABJ7nTkWCuUnLSvcMasWS4XFLQefSrbqDMC5kuV9JSVeye8fbe6C6NQNMx3VLPvBqLQV9GzsJEkLBu9PxC9o95W8RSSnUQ'
+    stagenet_addr = '548wjYLqNPdNcSPFk3xLSZNGLLHWkwZdvikDftDqeXHJdNZRkh6hNtd9NwVsKeNvAZNwooxGbPa7yZr4tpteBwpHLwnZ6gV'
+    stagenet_addr2 = '51sq76MNNYDcKRudSh9kqrQJ3MhFgKgH4X39GcEb2uGK2EZuEQ7DqfJNXHRNCaYFkx8AVBorSKRGZL9FaXiMCZH3SkDEw9d'
+
+    def touch(self, name):
+        open(os.path.join(self.walletdir.name, name), 'w').close()
+
+    def test_list(self):
+        self.touch('{}.keys'.format(self.mainnet_addr))
+        self.touch('{}.keys'.format(self.stagenet_addr))
+        self.touch(self.stagenet_addr)
+        self.touch('{}.keys'.format(self.stagenet_addr2))
+        self.touch('garbage.keys')
+        self.assertEqual(list(self.mainnet_mgr.iter_wallets()), [self.mainnet_addr])
+        self.assertEqual(list(self.testnet_mgr.iter_wallets()), [])
+        self.assertEqual(list(self.stagenet_mgr.list_wallets()), [self.stagenet_addr2, self.stagenet_addr])
+        self.assertIsInstance(self.stagenet_mgr.list_wallets()[0], monero.address.Address)
+
+        os.unlink(os.path.join(self.walletdir.name, self.stagenet_addr))
+        os.unlink(os.path.join(self.walletdir.name, '{}.keys'.format(self.stagenet_addr2)))
+        self.assertEqual(list(self.stagenet_mgr.iter_wallets()), [self.stagenet_addr])
+
+    def test_batches(self):
+        self.touch('{}.keys'.format(self.stagenet_addr))
+        self.touch(self.stagenet_addr)
+        self.touch('{}.keys'.format(self.stagenet_addr2))
+        self.stagenet_mgr.index.batch_size = 1
+        self.assertEqual(list(self.stagenet_mgr.iter_wallets()), [self.stagenet_addr2, self.stagenet_addr])
+
+    def test_persistent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'index.sqlite')
+            self.touch('{}.keys'.format(self.stagenet_addr))
+            index = WalletIndex(self.walletdir.name, path=path)
+            self.assertTrue(index.update())
+            # pretend the last scan was long after the last change
+            index._db.execute("UPDATE meta SET value = value + 1e10 WHERE key = 'scanned'")
+            index._db.commit()
+            index.close()
+            index = WalletIndex(self.walletdir.name, path=path)
+            self.assertFalse(index.update())
+            self.assertEqual(list(index.addresses('stagenet')), [self.stagenet_addr])
+            index.close()
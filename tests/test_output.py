@@ -0,0 +1,100 @@
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from monerowalletpool import OutputBuffer, OutputPump, WalletCreationError
+from .fixtures import FakeDaemonTestCase
+
+
+class OutputBufferTestCase(unittest.TestCase):
+    def test_ring(self):
+        buf = OutputBuffer(size=8)
+        buf.feed(b'0123456')
+        buf.feed(b'789abc')
+        self.assertEqual(buf.getvalue(), b'56789abc')
+
+    def test_matching(self):
+        buf = OutputBuffer(size=16, patterns=[b'Refresh done', br'Error:.*'])
+        buf.feed(b'Starting\nRefr')
+        self.assertEqual(buf.matches, {})
+        buf.feed(b'esh done, blocks received: 10\nError: bo')
+        self.assertEqual(list(buf.matches), [b'Refresh done'])
+        self.assertIsNone(buf.wait_for(br'Error:.*', timeout=0.01))
+        buf.feed(b'om\n')
+        self.assertEqual(buf.wait_for(br'Error:.*'), (br'Error:.*', 'Error: boom'))
+        self.assertEqual(buf.wait_for(br'Error:.*', b'Refresh done'),
+                (b'Refresh done', 'Refresh done'))
+
+    def test_unterminated_line(self):
+        buf = OutputBuffer(patterns=[br'Error:.*'])
+        buf.feed(b'Error: no newline')
+        self.assertEqual(buf.matches, {})
+        buf.close()
+        self.assertEqual(buf.wait_for(br'Error:.*'), (br'Error:.*', 'Error: no newline'))
+
+    def test_closed_without_match(self):
+        buf = OutputBuffer(patterns=[b'Logging'])
+        buf.close()
+        self.assertIsNone(buf.wait_for(b'Logging'))
+
+
+class OutputPumpTestCase(unittest.TestCase):
+    def test_chatty_children(self):
+        procs = [subprocess.Popen([sys.executable, '-c',
+                'import sys; sys.stdout.write("x" * 1000000); sys.stdout.flush(); '
+                'sys.stderr.write("done {}\\n")'.format(i)],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE) for i in range(5)]
+        pump = OutputPump.default()
+        for proc in procs:
+            pump.attach(proc, size=1024, patterns=[br'done \d'])
+        for i, proc in enumerate(procs):
+            proc.wait(timeout=10)
+            self.assertEqual(proc.output.wait_for(br'done \d', timeout=5),
+                    (br'done \d', 'done {}'.format(i)))
+            proc.output.wait(timeout=5)
+            self.assertTrue(proc.output.closed)
+            self.assertEqual(len(proc.output.getvalue()), 1024)
+
+
+class FakeCLITestCase(FakeDaemonTestCase):
+    stagenet_addr = '548wjYLqNPdNcSPFk3xLSZNGLLHWkwZdvikDftDqeXHJdNZRkh6hNtd9NwVsKeNvAZNwooxGbPa7yZr4tpteBwpHLwnZ6gV'
+    stagenet_key = '36307366e846ee42110e2fa75a04f9e38f6bf49839da79f96568deae7cfaec0b'
+
+    def test_create(self):
+        self.manager.create_wallet(self.stagenet_addr, self.stagenet_key, None,
+                wait_for_sync=True, restore_height=900)
+        self.assertTrue(self.manager.wallet_exists(self.stagenet_addr))
+
+    def test_create_invalid(self):
+        with self.assertRaises(WalletCreationError) as ctx:
+            self.manager.create_wallet(self.stagenet_addr, 'invalid', None, wait_for_sync=True)
+        self.assertIn('Error:', str(ctx.exception))
+        self.assertFalse(self.manager.wallet_exists(self.stagenet_addr))
+
+    def test_kill_creation(self):
+        manager = self.make_manager(self.start_daemon(100000))
+        errors = []
+
+        def _create():
+            try:
+                manager.create_wallet(self.stagenet_addr, self.stagenet_key, None,
+                        wait_for_sync=True)
+            except WalletCreationError as e:
+                errors.append(e)
+        thread = threading.Thread(target=_create)
+        thread.start()
+        # the fake CLI takes 100 sec to sync
+        while not manager.kill_creation(self.stagenet_addr):
+            time.sleep(0.05)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(manager.wallet_exists(self.stagenet_addr))
+        self.assertFalse(manager.kill_creation(self.stagenet_addr))
+
+    def test_generate(self):
+        address = self.manager.generate_wallet()
+        self.assertEqual(address.net, 'stage')
+        self.assertTrue(self.manager.wallet_exists(address))
@@ -0,0 +1,156 @@
+import threading
+import time
+import unittest
+
+import monero.wallet
+from monero.backends.offline import OfflineWallet
+from monero.seed import Seed
+
+from monerowalletpool.scanner import ViewKeyScanner
+from monerowalletpool.transfers import TransferStream, CallbackSink
+from benchmarks.fakes import FakeDaemon, fake_transaction
+
+
+class SeedScanner(ViewKeyScanner):
+    def __init__(self, seeds, **kwargs):
+        self.seeds = dict((str(s.public_address(net='stage')), s) for s in seeds)
+        self.received = []
+        self.reverted = []
+        self.synced = []
+        super(SeedScanner, self).__init__(**kwargs)
+
+    def keys_for_address(self, addr):
+        return self.seeds[addr].secret_view_key(), None
+
+    def transfers_received(self, address, transfers):
+        self.received.extend((address, t['txid'], t['amount']) for t in transfers)
+
+    def transfers_reverted(self, address, transfers):
+        self.reverted.extend((address, t['txid'], t['amount']) for t in transfers)
+
+    def wallet_synced(self, address, height):
+        self.synced.append((address, height))
+
+
+class ScanTransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.seeds = [Seed() for i in range(3)]
+        self.addresses = [str(s.public_address(net='stage')) for s in self.seeds]
+        self.scanner = SeedScanner(self.seeds, minors=3)
+        for address in self.addresses:
+            self.scanner.add(address)
+        self.wallets = list(self.scanner.wallets.values())
+
+    def test_single_pass(self):
+        tx = fake_transaction(self.addresses[1], 12345, b'seed')
+        found = self.scanner.scan_transaction('ab' * 32, tx, [77], 10, 1000, self.wallets)
+        self.assertEqual(list(found), [self.addresses[1]])
+        transfer, = found[self.addresses[1]]
+        self.assertEqual((transfer['amount'], transfer['height'], transfer['global_indices']),
+                (12345, 10, [77]))
+        self.assertEqual(transfer['subaddr_index'], {'major': 0, 'minor': 0})
+
+    def test_subaddress(self):
+        wallet = monero.wallet.Wallet(OfflineWallet(self.addresses[0],
+                view_key=self.seeds[0].secret_view_key()))
+        subaddress = wallet.get_address(0, 2)
+        tx = fake_transaction(subaddress, 5, b'sub', subaddress=True)
+        found = self.scanner.scan_transaction('cd' * 32, tx, None, 10, 1000, self.wallets)
+        self.assertEqual(found[self.addresses[0]][0]['subaddr_index'], {'major': 0, 'minor': 2})
+        # outside of the lookahead
+        tx = fake_transaction(wallet.get_address(0, 3), 5, b'sub', subaddress=True)
+        self.assertEqual(self.scanner.scan_transaction('ef' * 32, tx, None, 10, 1000,
+                self.wallets), {})
+
+    def test_unknown_extra_tag(self):
+        tx = fake_transaction(self.addresses[2], 7, b'mm')
+        # a merge mining tag after the tx key
+        tx['extra'] = tx['extra'] + [3, 33] + [0] * 33
+        found = self.scanner.scan_transaction('ab' * 32, tx, None, 10, 1000, self.wallets)
+        self.assertEqual(found[self.addresses[2]][0]['amount'], 7)
+        tx['extra'] = [3, 33] + [0] * 33 + tx['extra']
+        self.assertEqual(self.scanner.scan_transaction('ab' * 32, tx, None, 10, 1000,
+                self.wallets), {})
+
+    def test_bad_commitment(self):
+        tx = fake_transaction(self.addresses[0], 100, b'bad')
+        tx['rct_signatures']['outPk'][0] = '00' * 32
+        self.assertEqual(self.scanner.scan_transaction('ab' * 32, tx, None, 10, 1000,
+                self.wallets), {})
+
+
+class ViewKeyScannerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.daemon = FakeDaemon(height=1000, block_time=0.05, payments_per_block=2, seed=1)
+        self.daemon.start()
+        self.seeds = [Seed() for i in range(4)]
+        for seed in self.seeds:
+            self.daemon.add_address(seed.public_address(net='stage'))
+
+    def tearDown(self):
+        self.daemon.stop()
+
+    def test_scan(self):
+        time.sleep(1)
+        batches = []
+        scanner = SeedScanner(self.seeds, batch_size=7, daemon_host='127.0.0.1',
+                daemon_port=self.daemon.port,
+                transfers=TransferStream([CallbackSink(batches.append)]))
+        for address in scanner.seeds:
+            scanner.add(address, height=1000)
+        tip = scanner.scan()
+        self.assertEqual(sorted(scanner.synced), sorted((a, tip) for a in scanner.seeds))
+        expected = sorted((t['address'], t['txid'], t['amount'])
+                for transfers in self.daemon.transfers.values()
+                for t in transfers if t['height'] < tip)
+        self.assertTrue(expected)
+        self.assertEqual(sorted(scanner.received), expected)
+        scanner.transfers.flush()
+        self.assertEqual(sum(len(b) for b in batches), len(expected))
+
+    def test_late_wallet(self):
+        time.sleep(0.5)
+        scanner = SeedScanner(self.seeds, daemon_host='127.0.0.1', daemon_port=self.daemon.port)
+        first, second = list(scanner.seeds)[:2]
+        scanner.add(first, height=1000)
+        tip = scanner.scan()
+        scanner.add(second, height=1000)
+        tip = scanner.scan()
+        self.assertIn((second, tip), scanner.synced)
+        self.assertEqual(scanner.wallets[first].height, scanner.wallets[second].height)
+        # the first wallet doesn't get its transfers reported twice
+        for address in (first, second):
+            self.assertEqual(
+                sorted(txid for a, txid, amount in scanner.received if a == address),
+                sorted(t['txid'] for t in self.daemon.transfers.get(address, [])
+                    if t['height'] < tip))
+
+    def test_reorganization(self):
+        time.sleep(1)
+        scanner = SeedScanner(self.seeds, daemon_host='127.0.0.1', daemon_port=self.daemon.port)
+        for address in scanner.seeds:
+            scanner.add(address, height=1000)
+        tip = scanner.scan()
+        self.daemon.reorganize(tip - 5)
+        orphaned = sorted(r for r in scanner.received
+                if self.daemon._payments.get(r[1]) is None)
+        self.assertTrue(orphaned)
+        tip = scanner.scan()
+        self.assertEqual(sorted(scanner.reverted), orphaned)
+        # what's left equals the payments of the current chain
+        received = sorted(set(scanner.received) - set(scanner.reverted))
+        self.assertEqual(received, sorted((t['address'], t['txid'], t['amount'])
+                for transfers in self.daemon.transfers.values()
+                for t in transfers if t['height'] < tip))
+
+    def test_main_loop(self):
+        scanner = SeedScanner(self.seeds, daemon_host='127.0.0.1', daemon_port=self.daemon.port)
+        scanner.main_loop_sleep_time = 0.05
+        scanner.add(list(scanner.seeds)[0], height=1000)
+        thread = threading.Thread(target=scanner.main_loop)
+        thread.start()
+        time.sleep(0.5)
+        scanner.stop()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(scanner.synced)
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from monerowalletpool import SyncScheduler
+from monerowalletpool.shards import ShardCoordinator
+
+
+class ShardCoordinatorTestCase(unittest.TestCase):
+    addresses = ['addr{}'.format(i) for i in range(200)]
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'shards.db')
+        self.a = ShardCoordinator(self.path, instance='a', ttl=30)
+        self.b = ShardCoordinator(self.path, instance='b', ttl=30)
+
+    def tearDown(self):
+        for coordinator in (self.a, self.b):
+            try:
+                coordinator.close()
+            except Exception:
+                pass
+        self.tmpdir.cleanup()
+
+    def test_split(self):
+        self.assertTrue(self.a.update(now=1000))
+        self.assertTrue(self.b.update(now=1000))
+        self.assertTrue(self.a.update(now=1010))
+        self.assertEqual(self.a.members, ('a', 'b'))
+        owned_a = set(a for a in self.addresses if self.a.owns(a))
+        owned_b = set(a for a in self.addresses if self.b.owns(a))
+        self.assertEqual(owned_a | owned_b, set(self.addresses))
+        self.assertEqual(owned_a & owned_b, set())
+        self.assertTrue(50 < len(owned_a) < 150)
+
+    def test_rebalance_on_death(self):
+        self.a.update(now=1000)
+        self.b.update(now=1000)
+        self.a.update(now=1010)
+        owned_a = set(a for a in self.addresses if self.a.owns(a))
+        owned_b = set(a for a in self.addresses if self.b.owns(a))
+        self.assertEqual(owned_a & owned_b, set())
+        self.assertEqual(owned_a | owned_b, set(self.addresses))
+        # b stops heartbeating and falls out after ttl
+        self.assertFalse(self.a.update(now=1020))
+        self.assertTrue(self.a.update(now=1035))
+        self.assertEqual(self.a.members, ('a',))
+        self.assertTrue(all(self.a.owns(a) for a in self.addresses))
+        # a joining instance takes over only its own share
+        c = ShardCoordinator(self.path, instance='c', ttl=30)
+        c.update(now=1040)
+        self.assertTrue(self.a.update(now=1045))
+        moved = set(a for a in self.addresses if not self.a.owns(a))
+        self.assertTrue(moved)
+        self.assertTrue(all(c.owns(a) for a in moved))
+        c.close()
+
+    def test_leases(self):
+        self.a.update(now=1000)
+        address = self.addresses[0]
+        self.assertTrue(self.a.acquire(address, now=1000))
+        self.assertTrue(self.a.acquire(address, now=1001))
+        # b thinks it owns everything until it sees a
+        self.assertTrue(self.b.owns(address))
+        self.assertFalse(self.b.acquire(address, now=1001))
+        self.a.release(address)
+        self.assertTrue(self.b.acquire(address, now=1002))
+        self.b.release(address)
+        # a lease of a dead instance expires
+        self.a.acquire(address, now=1003)
+        self.assertTrue(self.b.acquire(address, now=1040))
+
+
+class ShardedSchedulerTestCase(unittest.TestCase):
+    def test_foreign(self):
+        sched = SyncScheduler()
+        sched.add('a', height=1)
+        sched.add('b', height=2)
+        owned = set(['b'])
+        self.assertEqual(sched.pop(owns=owned.__contains__), 'b')
+        self.assertIsNone(sched.pop(owns=owned.__contains__))
+        owned.add('a')
+        self.assertIsNone(sched.pop(owns=owned.__contains__))
+        sched.release_foreign()
+        self.assertEqual(sched.pop(owns=owned.__contains__), 'a')
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from monerowalletpool.snapshots import SnapshotCache, WalletSnapshot
+from .test_transfers import FakeBackend, transfer
+
+
+class SnapshotBackend(FakeBackend):
+    height = 100
+    balance = 5
+
+    def raw_request(self, method, params):
+        if method == 'get_balance':
+            return {'balance': self.balance, 'unlocked_balance': self.balance - 1}
+        if method == 'get_height':
+            return {'height': self.height}
+        return super(SnapshotBackend, self).raw_request(method, params)
+
+
+class SnapshotCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'snapshots.db')
+        self.backend = SnapshotBackend()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_take(self):
+        cache = SnapshotCache(recent=2)
+        self.backend.transfers = [transfer('a', 10), transfer('b', 20), transfer('p', type='pool')]
+        snapshot = cache.take('addr', self.backend)
+        self.assertEqual((snapshot.height, snapshot.balance, snapshot.unlocked_balance),
+                (100, 5, 4))
+        self.assertEqual([t['txid'] for t in snapshot.transfers], ['b', 'p'])
+        # only transfers since the newest one are requested; the pool one got confirmed
+        self.backend.transfers = [transfer('a', 10), transfer('b', 20), transfer('p', 30)]
+        snapshot = cache.take('addr', self.backend)
+        self.assertEqual(self.backend.requests[-1]['min_height'], 19)
+        self.assertEqual([(t['txid'], t['type']) for t in snapshot.transfers],
+                [('b', 'in'), ('p', 'in')])
+        self.assertIs(cache.get('addr'), snapshot)
+
+    def test_lru_and_disk(self):
+        cache = SnapshotCache(self.path, size=2)
+        for i, address in enumerate('abc'):
+            cache.put(WalletSnapshot(address, i, i * 10, i * 10, taken_at=1000))
+        self.assertEqual(list(cache._cache), ['b', 'c'])
+        self.assertEqual(cache.get('a').balance, 0)
+        self.assertEqual(list(cache._cache), ['c', 'a'])
+        self.assertIsNone(cache.get('x'))
+        cache.close()
+
+        reader = SnapshotCache(self.path)
+        snapshot = reader.get('c')
+        self.assertEqual((snapshot.height, snapshot.balance), (2, 20))
+        self.assertEqual(snapshot.as_dict(now=1030)['staleness'], 30)
+        reader.close()
@@ -0,0 +1,123 @@
+import os
+import tempfile
+import time
+import unittest
+
+from monerowalletpool import WalletsManager
+from monerowalletpool.staging import IOBudget, StagingArea
+
+
+class IOBudgetTestCase(unittest.TestCase):
+    def test_reserve(self):
+        budget = IOBudget(1000, burst=500)
+        self.assertEqual(budget.reserve(500), 0)
+        self.assertAlmostEqual(budget.reserve(500), 0.5, places=1)
+
+    def test_consume(self):
+        budget = IOBudget(10000, burst=1000)
+        started = time.monotonic()
+        for i in range(4):
+            budget.consume(1000)
+        self.assertGreater(time.monotonic() - started, 0.25)
+
+
+class StagingAreaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.walletdir = os.path.join(self.tmpdir.name, 'wallets')
+        self.stagingdir = os.path.join(self.tmpdir.name, 'staging')
+        os.mkdir(self.walletdir)
+        self.write(self.walletdir, 'addr', b'cache')
+        self.write(self.walletdir, 'addr.keys', b'keys')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, directory, name, data):
+        with open(os.path.join(directory, name), 'wb') as fp:
+            fp.write(data)
+
+    def read(self, directory, name):
+        with open(os.path.join(directory, name), 'rb') as fp:
+            return fp.read()
+
+    def test_write_back(self):
+        staging = StagingArea(self.stagingdir)
+        staging.stage(self.walletdir, 'addr')
+        self.assertTrue(staging.is_staged('addr'))
+        self.assertEqual(sorted(os.listdir(staging.path)), ['addr', 'addr.keys'])
+        keys_mtime = os.stat(os.path.join(self.walletdir, 'addr.keys')).st_mtime_ns
+        self.write(staging.path, 'addr', b'new cache')
+        self.assertEqual(staging.write_back(self.walletdir, 'addr'), 9)
+        self.assertEqual(self.read(self.walletdir, 'addr'), b'new cache')
+        # unchanged files are left alone
+        self.assertEqual(os.stat(os.path.join(self.walletdir, 'addr.keys')).st_mtime_ns, keys_mtime)
+        self.assertEqual(sorted(os.listdir(self.walletdir)), ['addr', 'addr.keys'])
+        self.assertEqual(os.listdir(staging.path), [])
+        self.assertFalse(staging.is_staged('addr'))
+        self.assertEqual(staging.write_back(self.walletdir, 'addr'), 0)
+
+    def test_failed_write_back(self):
+        staging = StagingArea(self.stagingdir)
+        staging.stage(self.walletdir, 'addr')
+        self.write(staging.path, 'addr', b'new cache')
+        with self.assertRaises(OSError):
+            staging.write_back(os.path.join(self.tmpdir.name, 'missing'), 'addr')
+        self.assertTrue(staging.is_staged('addr'))
+        self.assertEqual(self.read(staging.path, 'addr'), b'new cache')
+        # reopening the wallet keeps the newer staged files
+        staging.stage(self.walletdir, 'addr')
+        self.assertEqual(self.read(staging.path, 'addr'), b'new cache')
+        self.assertEqual(staging.write_back(self.walletdir, 'addr'), 9)
+        self.assertEqual(self.read(self.walletdir, 'addr'), b'new cache')
+        self.assertFalse(staging.is_staged('addr'))
+
+    def test_new_file(self):
+        os.unlink(os.path.join(self.walletdir, 'addr'))
+        staging = StagingArea(self.stagingdir)
+        staging.stage(self.walletdir, 'addr')
+        self.write(staging.path, 'addr', b'first cache')
+        staging.write_back(self.walletdir, 'addr')
+        self.assertEqual(self.read(self.walletdir, 'addr'), b'first cache')
+
+    def test_budget(self):
+        staging = StagingArea(self.stagingdir, budget=IOBudget(20000, burst=1))
+        staging.chunk_size = 1000
+        staging.stage(self.walletdir, 'addr')
+        self.write(staging.path, 'addr', b'x' * 4000)
+        started = time.monotonic()
+        staging.write_back(self.walletdir, 'addr')
+        self.assertGreater(time.monotonic() - started, 0.15)
+        staging.stage(self.walletdir, 'addr')
+        self.write(staging.path, 'addr', b'y' * 4000)
+        started = time.monotonic()
+        staging.write_back(self.walletdir, 'addr', throttle=False)
+        self.assertLess(time.monotonic() - started, 0.15)
+
+    def test_discard_and_stale(self):
+        staging = StagingArea(self.stagingdir)
+        staging.stage(self.walletdir, 'addr')
+        self.write(staging.path, 'addr', b'lost')
+        staging.discard('addr')
+        self.assertEqual(os.listdir(staging.path), [])
+        self.assertEqual(self.read(self.walletdir, 'addr'), b'cache')
+        # leftovers of a crashed run are removed, those of a live one are not
+        os.mkdir(os.path.join(self.stagingdir, 'staging-crashed'))
+        self.write(self.stagingdir, 'staging-crashed.lock', b'')
+        self.write(self.stagingdir, 'staging-crashed/addr', b'stale')
+        staging.stage(self.walletdir, 'addr')
+        other = StagingArea(self.stagingdir)
+        self.assertNotEqual(other.path, staging.path)
+        self.assertFalse(os.path.exists(os.path.join(self.stagingdir, 'staging-crashed')))
+        self.assertFalse(os.path.exists(os.path.join(self.stagingdir, 'staging-crashed.lock')))
+        self.assertEqual(sorted(os.listdir(staging.path)), ['addr', 'addr.keys'])
+        other.close()
+        name = os.path.basename(staging.path)
+        self.assertEqual(sorted(os.listdir(self.stagingdir)), [name, name + '.lock'])
+
+    def test_manager(self):
+        staging = StagingArea(self.stagingdir)
+        manager = WalletsManager(directory=self.walletdir, staging=staging)
+        args = manager.open_wallet_args('addr', 18090)
+        self.assertEqual(args[args.index('--wallet-file') + 1], os.path.join(staging.path, 'addr'))
+        self.assertTrue(manager.wallet_exists('addr'))
@@ -0,0 +1,145 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from monerowalletpool import (WalletsManager, SyncScheduler, SyncRequest, RPCTimeoutError,
+        AddressMismatchError, WalletCreationError, OWNER_ENV, process_token, WALLET_FAILED,
+        WALLET_CLOSED)
+from monerowalletpool.supervisor import (FailureSupervisor, classify, find_orphans, is_orphan,
+        reap_orphans, CREATION, TIMEOUT, MISMATCH, OTHER)
+from benchmarks.fakes import FAKE_WALLET_RPC
+from .test_monerowalletpool import RequestPool
+
+
+class FailureSupervisorTestCase(unittest.TestCase):
+    def test_classify(self):
+        self.assertEqual(classify(WalletCreationError('x')), CREATION)
+        self.assertEqual(classify(RPCTimeoutError('x')), TIMEOUT)
+        self.assertEqual(classify(AddressMismatchError('x')), MISMATCH)
+        self.assertEqual(classify(RuntimeError('x')), OTHER)
+        self.assertEqual(classify(None), OTHER)
+
+    def test_backoff(self):
+        supervisor = FailureSupervisor(base_delay=10, max_delay=25)
+        self.assertFalse(supervisor.failed('a', RPCTimeoutError('x'), now=100))
+        self.assertFalse(supervisor.admits('a', now=109))
+        self.assertEqual(supervisor.due(now=109), [])
+        self.assertEqual(supervisor.due(now=110), ['a'])
+        self.assertTrue(supervisor.admits('a', now=110))
+        supervisor.failed('a', RPCTimeoutError('x'), now=200)
+        self.assertEqual(supervisor.retry_at['a'], 220)
+        supervisor.failed('a', RuntimeError('x'), now=300)
+        self.assertEqual(supervisor.retry_at['a'], 325)
+        supervisor.succeeded('a')
+        self.assertTrue(supervisor.admits('a'))
+        self.assertNotIn('a', supervisor.failures)
+
+    def test_quarantine(self):
+        supervisor = FailureSupervisor(base_delay=0)
+        self.assertTrue(supervisor.failed('a', AddressMismatchError('x')))
+        self.assertFalse(supervisor.admits('a'))
+        self.assertEqual(supervisor.due(), [])
+        for i in range(2):
+            self.assertFalse(supervisor.failed('b', WalletCreationError('x')))
+        # another kind of error breaks the streak
+        self.assertFalse(supervisor.failed('b', RPCTimeoutError('x')))
+        self.assertFalse(supervisor.failed('b', WalletCreationError('x')))
+        self.assertFalse(supervisor.failed('b', WalletCreationError('x')))
+        self.assertTrue(supervisor.failed('b', WalletCreationError('bad keys')))
+        self.assertEqual(supervisor.quarantined['b'][:2], (CREATION, 'bad keys'))
+        supervisor.release('b')
+        self.assertTrue(supervisor.admits('b'))
+        self.assertEqual(supervisor.due(), ['b'])
+        supervisor.release('c')
+        self.assertEqual(supervisor.due(), [])
+
+
+class SupervisedPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.walletdir = tempfile.TemporaryDirectory()
+        self.supervisor = FailureSupervisor(base_delay=60)
+        self.pool = RequestPool(WalletsManager(directory=self.walletdir.name), max_running=2,
+                scheduler=SyncScheduler(), supervisor=self.supervisor)
+        self.pool.schedule('a')
+
+    def tearDown(self):
+        self.walletdir.cleanup()
+
+    def fail(self, address, error):
+        ctrl = self.pool.running[address]
+        ctrl.status = WALLET_FAILED
+        ctrl.error = error
+        self.pool.handle_event(ctrl, WALLET_FAILED)
+
+    def test_backoff(self):
+        self.pool.start_wallets()
+        self.fail('a', RPCTimeoutError('x'))
+        self.pool.start_wallets()
+        self.assertEqual(self.pool.running, {})
+        self.supervisor.retry_at['a'] = 0
+        self.pool.start_wallets()
+        self.assertIn('a', self.pool.running)
+        # a failed sync doesn't count as one
+        self.assertIsNone(self.pool.scheduler._wallets['a'][2])
+        ctrl = self.pool.running['a']
+        ctrl.status = WALLET_CLOSED
+        ctrl.sync_time = 1
+        self.pool.handle_event(ctrl, WALLET_CLOSED)
+        self.assertNotIn('a', self.supervisor.failures)
+        self.assertIsNotNone(self.pool.scheduler._wallets['a'][2])
+
+    def test_quarantined_request(self):
+        self.pool.start_wallets()
+        self.fail('a', AddressMismatchError('x'))
+        request = self.pool.request_sync('a')
+        self.pool.handle_requests()
+        self.assertEqual(request.status, SyncRequest.QUARANTINED)
+        self.supervisor.release('a')
+        self.pool.start_wallets()
+        self.assertIn('a', self.pool.running)
+
+
+class ReapTestCase(unittest.TestCase):
+    port_range = (28800, 28805)
+
+    def spawn(self, walletdir, port, owner):
+        env = dict(os.environ, FAKE_STARTUP_DELAY='0', **{OWNER_ENV: owner})
+        proc = subprocess.Popen([FAKE_WALLET_RPC, '--wallet-dir', walletdir,
+                '--rpc-bind-port', str(port), '--disable-rpc-login',
+                '--daemon-address', '127.0.0.1:1'], env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(self.kill, proc)
+        return proc
+
+    def kill(self, proc):
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def test_reap(self):
+        with tempfile.TemporaryDirectory() as walletdir:
+            # spawned by a live pool, and by one whose pid has been reused since
+            alive = self.spawn(walletdir, self.port_range[0], process_token())
+            orphan = self.spawn(walletdir, self.port_range[0] + 1, '{}:0'.format(os.getpid()))
+            deadline = time.time() + 10
+            while len(find_orphans(self.port_range, FAKE_WALLET_RPC, orphans_only=False)) < 2:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            self.assertEqual(find_orphans(self.port_range, FAKE_WALLET_RPC),
+                    {orphan.pid: self.port_range[0] + 1})
+            self.assertEqual(find_orphans(self.port_range, 'monero-wallet-rpc',
+                    orphans_only=False), {})
+            self.assertEqual(reap_orphans(self.port_range, FAKE_WALLET_RPC), [orphan.pid])
+            self.assertIsNotNone(orphan.wait(timeout=5))
+            self.assertIsNone(alive.poll())
+
+    def test_unmarked(self):
+        env = dict(os.environ)
+        env.pop(OWNER_ENV, None)
+        proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'], env=env)
+        self.addCleanup(self.kill, proc)
+        self.assertFalse(is_orphan(proc.pid))
+        self.assertFalse(is_orphan(os.getpid()))
@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from monerowalletpool import WalletsManager, WALLET_SYNCED, trace_span
+from monerowalletpool.tracing import Tracer
+from .test_monerowalletpool import RequestPool
+
+
+class DummyProfiler(object):
+    def __init__(self):
+        self.calls = []
+
+    def enable(self):
+        self.calls.append('enable')
+
+    def disable(self):
+        self.calls.append('disable')
+
+
+class TracerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_spans(self):
+        tracer = Tracer(size=2)
+        with tracer.span('create', 'a'):
+            pass
+        with self.assertRaises(ValueError):
+            with tracer.span('spawn', 'a', port=18090):
+                raise ValueError('boom')
+        def close():
+            with tracer.span('close', 'b'):
+                pass
+        thread = threading.Thread(target=close, name='b')
+        thread.start()
+        thread.join()
+        # the ring buffer keeps the last spans only
+        self.assertEqual([span[0] for span in tracer.spans], ['spawn', 'close'])
+        events = tracer.events()
+        self.assertEqual(sorted(e['args']['name'] for e in events if e['ph'] == 'M'),
+                ['MainThread', 'b'])
+        spawn = [e for e in events if e['name'] == 'spawn'][0]
+        self.assertEqual(spawn['args'], {'port': 18090, 'error': "ValueError('boom')", 'address': 'a'})
+        self.assertGreaterEqual(spawn['dur'], 0)
+        path = os.path.join(self.tmpdir.name, 'dump.json')
+        tracer.dump(path)
+        with open(path) as fp:
+            self.assertEqual(len(json.load(fp)['traceEvents']), 4)
+
+    def test_stream(self):
+        path = os.path.join(self.tmpdir.name, 'stream.json')
+        tracer = Tracer(path=path)
+        # the thread name comes along with the first span of a thread
+        tracer.batch_size = 3
+        with tracer.span('create', 'a'):
+            pass
+        tracer.flush(force=False)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), '')
+        with tracer.span('spawn', 'a'):
+            pass
+        tracer.flush(force=False)
+        with open(path) as fp:
+            self.assertEqual(len(json.loads(fp.read() + ']')), 3)
+        with tracer.span('close', 'a'):
+            pass
+        tracer.close()
+        with open(path) as fp:
+            events = json.load(fp)
+        self.assertEqual([e['name'] for e in events],
+                ['thread_name', 'create', 'spawn', 'close'])
+        empty = os.path.join(self.tmpdir.name, 'empty.json')
+        Tracer(path=empty).close()
+        with open(empty) as fp:
+            self.assertEqual(json.load(fp), [])
+
+    def test_no_tracer(self):
+        with trace_span(None, 'create', 'a'):
+            pass
+
+    def test_pool_handlers(self):
+        profiler = DummyProfiler()
+        tracer = Tracer(profiler=profiler)
+        with tempfile.TemporaryDirectory() as walletdir:
+            manager = WalletsManager(directory=walletdir)
+            pool = RequestPool(manager, max_running=2, tracer=tracer)
+            self.assertIs(manager.tracer, tracer)
+            ctrl = pool.start_controller('a')
+            ctrl.status = WALLET_SYNCED
+            pool.handle_event(ctrl, WALLET_SYNCED)
+        self.assertEqual(profiler.calls, ['enable', 'disable'])
+        event = tracer.events()[-1]
+        self.assertEqual((event['name'], event['args']),
+                ('handler', {'handler': 'wallet_synced', 'address': 'a'}))
@@ -0,0 +1,122 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from monerowalletpool.transfers import (Cursor, CursorStore, TransferStream, CallbackSink,
+        JSONLSink, SQLiteSink)
+
+
+def transfer(txid, height=None, type='in', minor=0, amount=1):
+    return {'txid': txid, 'height': height or 0, 'type': type, 'amount': amount,
+            'subaddr_index': {'major': 0, 'minor': minor}}
+
+
+class FakeBackend(object):
+    """Returns transfers the way `get_transfers` RPC does, filtered by `min_height`."""
+    def __init__(self):
+        self.transfers = []
+        self.requests = []
+
+    def raw_request(self, method, params):
+        self.requests.append(params)
+        result = {}
+        for t in self.transfers:
+            if t['type'] in ('in', 'out') and t['height'] <= params['min_height']:
+                continue
+            result.setdefault(t['type'], []).append(dict(t))
+        return result
+
+
+class CursorTestCase(unittest.TestCase):
+    def test_advance(self):
+        new, cursor = Cursor().advance([transfer('a', 10), transfer('b', 12), transfer('c', 12)])
+        self.assertEqual([t['txid'] for t in new], ['a', 'b', 'c'])
+        self.assertEqual(cursor.height, 12)
+        new, cursor = cursor.advance([transfer('b', 12), transfer('c', 12), transfer('c', 12, minor=1)])
+        self.assertEqual([(t['txid'], t['subaddr_index']['minor']) for t in new], [('c', 1)])
+        self.assertEqual(len(cursor.keys), 3)
+
+    def test_unconfirmed(self):
+        new, cursor = Cursor(5).advance([transfer('p', type='pool')])
+        self.assertEqual(len(new), 1)
+        new, cursor = cursor.advance([transfer('p', type='pool')])
+        self.assertEqual(new, [])
+        new, cursor = cursor.advance([transfer('p', 6)])
+        self.assertEqual([t['type'] for t in new], ['in'])
+        self.assertEqual(cursor.unconfirmed, set())
+
+
+class TransferStreamTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.backend = FakeBackend()
+        self.batches = []
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def test_incremental(self):
+        stream = TransferStream([CallbackSink(self.batches.append)], batch_size=2)
+        self.backend.transfers = [transfer('a', 10), transfer('b', 11), transfer('p', type='pool')]
+        new = stream.collect('addr', self.backend)
+        self.assertEqual(len(new), 3)
+        self.assertEqual([len(b) for b in self.batches], [2, 1])
+        self.assertEqual(self.batches[0][0]['address'], 'addr')
+        self.backend.transfers.append(transfer('c', 15))
+        stream.collect('addr', self.backend)
+        self.assertEqual(self.backend.requests[-1]['min_height'], 10)
+        self.assertEqual([t['txid'] for t in stream.collect('addr', self.backend)], [])
+        stream.flush()
+        self.assertEqual([t['txid'] for b in self.batches for t in b], ['a', 'b', 'p', 'c'])
+        self.assertEqual(self.backend.requests[-1]['min_height'], 14)
+
+    def test_cursor_waits_for_delivery(self):
+        stream = TransferStream([CallbackSink(self.batches.append)], batch_size=10,
+                flush_interval=1000)
+        self.backend.transfers = [transfer('a', 10)]
+        stream.collect('addr', self.backend)
+        self.assertEqual(self.batches, [])
+        self.assertEqual(stream.cursors.get('addr').height, 0)
+        # collecting again before flushing continues from the pending cursor
+        self.assertEqual(stream.collect('addr', self.backend), [])
+        stream.flush()
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(stream.cursors.get('addr').height, 10)
+
+    def test_sinks_and_persistence(self):
+        stream = TransferStream([JSONLSink(self.path('t.jsonl')), SQLiteSink(self.path('t.db'))],
+                cursors=CursorStore(self.path('cursors.db')))
+        self.backend.transfers = [transfer('a', 10), transfer('p', type='pool')]
+        stream.collect('addr', self.backend)
+        stream.close()
+        with open(self.path('t.jsonl')) as f:
+            self.assertEqual([json.loads(l)['txid'] for l in f], ['a', 'p'])
+
+        self.backend.transfers = [transfer('a', 10), transfer('p', 11)]
+        stream = TransferStream([SQLiteSink(self.path('t.db'))],
+                cursors=CursorStore(self.path('cursors.db')))
+        self.assertEqual([t['txid'] for t in stream.collect('addr', self.backend)], ['p'])
+        stream.close()
+        db = sqlite3.connect(self.path('t.db'))
+        self.assertEqual(
+            db.execute('SELECT txid, height, confirmed FROM transfers ORDER BY txid').fetchall(),
+            [('a', 10, 1), ('p', 11, 1)])
+        db.close()
+
+    def test_revert(self):
+        stream = TransferStream([SQLiteSink(self.path('t.db'))])
+        stream.deliver('addr', [transfer('a', 10), transfer('b', 12)])
+        stream.flush()
+        stream.revert('addr', 12, [transfer('b', 12)])
+        # the replacing block is delivered although below the cursor
+        self.assertEqual([t['txid'] for t in stream.deliver('addr', [transfer('c', 12)])], ['c'])
+        stream.close()
+        db = sqlite3.connect(self.path('t.db'))
+        self.assertEqual(db.execute('SELECT txid FROM transfers ORDER BY txid').fetchall(),
+                [('a',), ('c',)])
+        db.close()
@@ -0,0 +1,66 @@
+import time
+
+from monerowalletpool import WalletPool, WALLET_SYNCED
+from benchmarks.bench_pool import make_wallets
+from .fixtures import FakeDaemonTestCase
+
+
+class WorkerPool(WalletPool):
+    rpc_port_range = (28830, 28840)
+
+
+class WorkerPoolTestCase(FakeDaemonTestCase):
+    payments_per_block = 0
+
+    def setUp(self):
+        super(WorkerPoolTestCase, self).setUp()
+        self.addresses = make_wallets(self.walletdir.name, 2, 950)
+        self.pool = WorkerPool(self.manager, max_running=1, use_workers=True,
+                daemon_host='127.0.0.1', daemon_port=self.daemon.port)
+        self.pool.start_tip()
+        self.pool.start_workers()
+
+    def tearDown(self):
+        self.pool.drain(timeout=5)
+
+    def run_until(self, predicate, timeout=20):
+        deadline = time.time() + timeout
+        while not predicate():
+            self.assertLess(time.time(), deadline)
+            for ctrl, status in self.pool.wait_events(timeout=0.1):
+                self.pool.handle_event(ctrl, status)
+
+    def sync(self, address):
+        """Syncs the wallet in a worker and closes it. Returns the worker."""
+        ctrl = self.pool.start_controller(address)
+        self.run_until(lambda: ctrl.status == WALLET_SYNCED)
+        worker = ctrl.worker
+        self.assertEqual(worker.address, address)
+        ctrl.shut_down = True
+        self.run_until(lambda: address not in self.pool.running)
+        return worker
+
+    def test_reuse(self):
+        worker = self.pool.workers[0]
+        pid = worker._wallet_rpc.pid
+        self.assertIs(self.sync(self.addresses[0]), worker)
+        # released to the idle queue with the wallet closed
+        self.assertIsNone(worker.address)
+        self.assertEqual(list(self.pool._idle_workers), [worker])
+        self.assertIs(self.sync(self.addresses[1]), worker)
+        self.assertTrue(worker.is_alive())
+        self.assertEqual(worker._wallet_rpc.pid, pid)
+
+    def test_dead_worker(self):
+        worker = self.pool.workers[0]
+        ctrl = self.pool.start_controller(self.addresses[0])
+        self.run_until(lambda: ctrl.status == WALLET_SYNCED)
+        worker._wallet_rpc.kill()
+        worker._wallet_rpc.wait()
+        ctrl.shut_down = True
+        self.run_until(lambda: self.addresses[0] not in self.pool.running)
+        # replaced with a fresh process
+        self.assertEqual(len(self.pool.workers), 1)
+        self.assertIsNot(self.pool.workers[0], worker)
+        self.assertEqual(list(self.pool._idle_workers), self.pool.workers)
+        self.assertIs(self.sync(self.addresses[1]), self.pool.workers[0])